@@ -1,76 +1,161 @@
 import asyncio
+import base64
+import datetime as dt
 import json
 import logging
 import os
+import shutil
 import tempfile
+import threading
 import traceback
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Optional
 
 import pyarrow as pa
-import pyarrow.parquet as pq
-from fastapi import APIRouter, Body
-from huggingface_hub import HfApi
-from huggingface_hub.errors import BadRequestError
-
-from environment import storage, HUGGING_FACE_TOKEN
+from fastapi import APIRouter, Body, Depends
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, DatasetCard, HfApi
+from huggingface_hub.errors import BadRequestError, EntryNotFoundError, RepositoryNotFoundError, \
+    RevisionNotFoundError
+
+from api import token_service
+from environment import storage, execution_lanes, admission_controller, state_bulk_load_storage, artifact_cache, \
+    hf_push_connections, HUGGING_FACE_TOKEN, HF_PUSH_WORKERS, STATE_SYNC_ENCODING, STATE_SYNC_COMPRESSION
 from message_router import message_router
 from models.hg_models import ImportHgDatasetRequest, ExportHgDatasetRequest
 from models.models import BasicResponse
+from utils.admission import ADMISSION_REQUESTS, ADMISSION_MESSAGES
+from utils.envelope import encode_state_sync_message
+from utils.executors import LANE_IMPORT, LANE_EXPORT
 from utils.http_exceptions import check_null_response
+from utils.ingest_dedup import IngestDeduplicator
+from utils.parquet_schema import ParquetColumnTypeError, columns_to_table, derive_parquet_schema, \
+    deserialize_schema, serialize_schema, text_columns_of
+from utils.parquet_shards import estimate_shard_rows, is_shard_path, pin_shard_patterns, plan_shards, \
+    shard_path_in_repo, write_parquet_shard
 from datasets import load_dataset
 
 logger = logging.getLogger(__name__)
 
 dataset_router = APIRouter()
 
+# committed along with the shards, the state and rows of the last push from which the next push appends
+HF_PUSH_METADATA_PATH = "ism_push.json"
+HF_DATASET_CARD_PATH = "README.md"
+
+
 @check_null_response
 @dataset_router.post("/state/{state_id}/load/hg", response_model=BasicResponse)
 async def load_hg_dataset(
         state_id: str,
         payload: ImportHgDatasetRequest = Body(...),
+        user_id: Optional[str] = Depends(token_service.verify_caller),
 ) -> BasicResponse | None:
+    await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id)
+
     # TODO need to pull the config/vault key -- more thought is required
     # if request.vaultKeyId is None:
     token = HUGGING_FACE_TOKEN
 
-    # Load the dataset from the Hugging Face Hub — blocking I/O, offload to thread pool
+    # Load the dataset from the Hugging Face Hub — blocking I/O, offload to the import lane
     def _load():
         ds = load_dataset(payload.path, subset=payload.subset, split=payload.split, revision=payload.revision, token=token)
         return ds.to_list()
 
-    dataset = await asyncio.to_thread(_load)
+    dataset = await execution_lanes.run(LANE_IMPORT, _load)
 
     offset = 0
     block_index = 0
     block_size = 10
+    await admission_controller.admit(
+        ADMISSION_MESSAGES, user_id=user_id, amount=(len(dataset) + block_size - 1) // block_size)
+
+    state = storage.load_state_metadata(state_id=state_id) if payload.deduplicate else None
+    deduplicator = IngestDeduplicator(
+        state=state, fetch_existing_keys=state_bulk_load_storage.fetch_existing_state_keys) if state else None
+
     sync_route = message_router.find_route("processor/state/sync")
     while offset < len(dataset):
-        message_block = {
-            "type": "query_state_direct",
-            "state_id": state_id,
-            "query_state": dataset[offset:offset + block_size]
-        }
+        block = dataset[offset:offset + block_size]
         offset += block_size
         block_index += 1
 
-        message_string = json.dumps(message_block)
+        if deduplicator:
+            block = await asyncio.to_thread(deduplicator.filter, block)
+            if not block:
+                continue
+
+        message_string = encode_state_sync_message(
+            state_id=state_id,
+            rows=block,
+            encoding=STATE_SYNC_ENCODING,
+            compression=STATE_SYNC_COMPRESSION)
+
         await sync_route.publish(msg=message_string)
 
-    return BasicResponse(success=True)
+    return BasicResponse(success=True, data=deduplicator.summary() if deduplicator else None)
+
+
+def _state_chunks(state_id: str, start: int, end: int, chunk_size: int):
+    """The rows [start, end) of the state as (values by column, rows) chunks, loaded a chunk at a time."""
+    offset = start
+    while offset < end:
+        limit = min(chunk_size, end - offset)
+        chunk = storage.load_state(state_id=state_id, load_data=True, offset=offset, limit=limit)
+        if not chunk or not chunk.data:
+            print(f"[push_hg] empty chunk at offset={offset} for state_id={state_id}, stopping early")
+            break
+
+        values_by_column = {col: data.values[:limit] for col, data in chunk.data.items()}
+        yield values_by_column, max((len(values) for values in values_by_column.values()), default=0)
+        offset += limit
 
 
-def _serialize_values(values: list) -> list:
-    """Ensure all values are strings or None for a consistent parquet schema."""
-    return [
-        json.dumps(v) if v is not None and not isinstance(v, str) else v
-        for v in values
-    ]
+def _state_tables(state_id: str, schema: pa.Schema, start: int, end: int, chunk_size: int):
+    """The rows [start, end) of the state as tables of the (typed) schema."""
+    for values_by_column, rows in _state_chunks(state_id, start, end, chunk_size):
+        yield columns_to_table(values_by_column, schema=schema, num_rows=rows)
 
 
-def _write_state_to_parquet(state_id: str, chunk_size: int = 1000) -> tuple[str, str | None] | None:
+def _load_push_metadata(api: HfApi, path: str, revision: str | None, token: str) -> dict | None:
+    """The metadata of the last push to the repo, None when there was none (or the repo is new)."""
+    try:
+        metadata_file = api.hf_hub_download(repo_id=path, filename=HF_PUSH_METADATA_PATH, repo_type="dataset",
+                                            revision=revision, token=token)
+        with open(metadata_file) as file:
+            return json.load(file)
+    except (EntryNotFoundError, RepositoryNotFoundError, RevisionNotFoundError, ValueError):
+        return None
+
+
+def _dataset_card_operation(api: HfApi, path: str, revision: str | None, token: str) -> CommitOperationAdd:
+    """The dataset card of the repo (or a new one) with the data files of the shards pinned in its metadata."""
+    try:
+        card_file = api.hf_hub_download(repo_id=path, filename=HF_DATASET_CARD_PATH, repo_type="dataset",
+                                        revision=revision, token=token)
+        card = DatasetCard.load(card_file)
+    except (EntryNotFoundError, RepositoryNotFoundError, RevisionNotFoundError):
+        card = DatasetCard("---\nconfigs: []\n---\n")
+
+    pin_shard_patterns(card.data, "train")
+    return CommitOperationAdd(path_in_repo=HF_DATASET_CARD_PATH, path_or_fileobj=str(card).encode("utf-8"))
+
+
+def _push_to_huggingface(state_id: str,
+                         payload: ExportHgDatasetRequest,
+                         token: str,
+                         text_columns: frozenset = frozenset()) -> str | None:
     """
-    Load state data in chunks and write to a temp parquet file.
-    Returns (tmp_file_path, state_name) or None if state not found.
+    Write the state as parquet shards of disjoint row ranges in parallel, each shard is uploaded as soon as it is
+    written, and all of them are published in a single commit. Sync — meant to run in a thread pool.
+
+    Unless a full push is requested, only the rows appended since the last push to the repo (recorded in the
+    push metadata file of the repo) are written, as additional shards of the schema of the last push.
+
+    Columns are typed by their definitions; when a value does not fit its column type, every row is written
+    again with the column (and the text_columns of earlier attempts) as text.
     """
+    # the cached shards are of the data version loaded ahead of the data
+    data_version = artifact_cache.data_version(state_id)
     state_meta = storage.load_state_metadata(state_id=state_id)
     if not state_meta:
         print(f"[push_hg] state metadata not found for state_id={state_id}")
@@ -78,84 +163,191 @@ def _write_state_to_parquet(state_id: str, chunk_size: int = 1000) -> tuple[str,
 
     columns = list(state_meta.columns.keys())
     state_name = state_meta.config.name if state_meta.config else None
-    print(f"[push_hg] writing parquet for state_id={state_id}, count={state_meta.count}, columns={len(columns)}, chunk_size={chunk_size}")
 
-    # Build an explicit all-string schema so every chunk matches,
-    # even when sparse columns are all-None in some chunks.
-    schema = pa.schema([(col, pa.string()) for col in columns])
-
-    tmp_path = tempfile.mktemp(suffix='.parquet')
-    writer = None
-    offset = 0
+    dataset_name = payload.dataset_name or state_name or state_id[:8]
+    path = f"{payload.namespace}/{dataset_name}"
+
+    api = HfApi()
+    api.create_repo(repo_id=path, repo_type="dataset", exist_ok=True, private=payload.private, token=token)
+
+    # appending requires the rows pushed so far to be a prefix of the state, with the same columns
+    start_row = 0
+    metadata = None if payload.full else _load_push_metadata(api, path, revision=payload.revision, token=token)
+    if metadata:
+        if (metadata.get("state_id") == state_id
+                and sorted(metadata.get("columns") or []) == sorted(columns)
+                and metadata.get("schema")
+                and 0 < metadata.get("count", 0) <= state_meta.count):
+            start_row = metadata["count"]
+            columns = metadata["columns"]
+        else:
+            print(f"[push_hg] state {state_id} changed since the last push to {path}, rewriting all rows")
+
+    if start_row and start_row == state_meta.count:
+        print(f"[push_hg] no rows appended to state_id={state_id} since the last push to {path}")
+        return path
+
+    # a sample of the rows to push, to derive the column types and estimate the shard sizes from
+    sample_values, sample_rows = next(_state_chunks(
+        state_id, start_row, min(state_meta.count, start_row + payload.chunk_size), payload.chunk_size), ({}, 0))
+
+    # an explicit schema such that every chunk matches, even when sparse columns are all-None in some chunks;
+    # appended shards keep the schema of the shards pushed before
+    schema, dictionary_columns = derive_parquet_schema(
+        column_types={col: state_meta.columns[col].data_type for col in columns},
+        sample=sample_values,
+        text_columns=text_columns)
+    if start_row:
+        schema = deserialize_schema(base64.b64decode(metadata["schema"]))
+        dictionary_columns = [col for col in dictionary_columns if pa.types.is_string(schema.field(col).type)]
+
+    # shards by row count, or else by an estimate of the rows that make up the target shard size
+    shard_rows = payload.shard_rows
+    if not shard_rows:
+        try:
+            sample = columns_to_table(sample_values, schema=schema, num_rows=sample_rows)
+        except ParquetColumnTypeError:
+            sample = None
+        shard_rows = estimate_shard_rows(sample, target_bytes=payload.shard_bytes)
+
+    shards = plan_shards(state_meta.count, shard_rows, start=start_row)
+    print(f"[push_hg] writing {len(shards)} parquet shards for state_id={state_id}, rows={start_row}-{state_meta.count}, "
+          f"columns={len(columns)}, shard_rows={shard_rows}, compression={payload.compression}")
+
+    schema_text = base64.b64encode(serialize_schema(schema)).decode("ascii")
+
+    # the local files of the shards, either written by this push or cached from an earlier one
+    shard_paths = {}
+
+    def _shard_operation(index: int) -> CommitOperationAdd:
+        return CommitOperationAdd(
+            path_in_repo=shard_path_in_repo("train", index, len(shards), start_row=start_row),
+            path_or_fileobj=shard_paths[index])
+
+    def _upload(operation: CommitOperationAdd):
+        api.preupload_lfs_files(repo_id=path, additions=[operation], token=token, repo_type="dataset",
+                                revision=payload.revision, num_threads=1, free_memory=False)
+
+    def _write_and_upload(index: int, start: int, end: int) -> CommitOperationAdd:
+        # a shard depends on the state data version and on everything that shapes the file
+        variant = "|".join([str(start), str(end), str(payload.row_group_size), payload.compression,
+                            ",".join(dictionary_columns), schema_text])
+        cache_key = artifact_cache.key(state_id, data_version, "parquet", variant=variant)
+
+        shard_paths[index] = artifact_cache.checkout(cache_key, directory=tmp_dir)
+        if not shard_paths[index]:
+            local_path = os.path.join(tmp_dir, f"shard-{index:05d}.parquet")
+            with hf_push_connections:
+                if failed.is_set():
+                    return None
+                write_parquet_shard(
+                    local_path, schema,
+                    _state_tables(state_id, schema, start, end, payload.chunk_size),
+                    row_group_size=payload.row_group_size,
+                    compression=payload.compression,
+                    use_dictionary=dictionary_columns)
+            artifact_cache.put(cache_key, local_path)
+            shard_paths[index] = local_path
+
+        # a shard of a failed push is not uploaded, the push is done over or fails as a whole
+        if failed.is_set():
+            return None
+        operation = _shard_operation(index)
+        _upload(operation)
+        print(f"[push_hg] uploaded shard {index + 1}/{len(shards)} (rows {start}-{end}) to {path}")
+        return operation
+
+    def _commit(operations: list):
+        # the rows pushed, committed along with the shards such that the next push appends from there
+        metadata_operation = CommitOperationAdd(
+            path_in_repo=HF_PUSH_METADATA_PATH,
+            path_or_fileobj=json.dumps({
+                "state_id": state_id,
+                "count": state_meta.count,
+                "columns": columns,
+                "schema": schema_text,
+                "pushed_date": dt.datetime.utcnow().isoformat(),
+            }).encode("utf-8"))
+
+        # shards of an earlier push with a different number of shards (or appended) would otherwise remain
+        stale = []
+        if not start_row:
+            names = {operation.path_in_repo for operation in operations}
+            stale = [
+                CommitOperationDelete(path_in_repo=name)
+                for name in api.list_repo_files(repo_id=path, repo_type="dataset", revision=payload.revision,
+                                                token=token)
+                if is_shard_path(name, "train") and name not in names
+            ]
+
+        # the card pins the data files of the split, appended shards are not resolved by their names
+        card_operation = _dataset_card_operation(api, path, revision=payload.revision, token=token)
+
+        api.create_commit(
+            repo_id=path,
+            operations=operations + [metadata_operation, card_operation] + stale,
+            commit_message=payload.commit_message or (
+                f"Append rows {start_row} to {state_meta.count}" if start_row
+                else f"Upload {len(operations)} parquet shards"),
+            repo_type="dataset",
+            revision=payload.revision,
+            token=token)
 
+    rewrite = False
+    type_errors = set()
+    failed = threading.Event()
+    tmp_dir = tempfile.mkdtemp(prefix="push_hg_")
     try:
-        while offset < state_meta.count:
-            chunk = storage.load_state(state_id=state_id, load_data=True, offset=offset, limit=chunk_size)
-            if not chunk or not chunk.data:
-                print(f"[push_hg] empty chunk at offset={offset} for state_id={state_id}, stopping early")
-                break
-
-            chunk_dict = {
-                col: _serialize_values(chunk.data[col].values)
-                for col in columns if col in chunk.data
-            }
-            table = pa.table(chunk_dict, schema=schema)
-
-            if writer is None:
-                writer = pq.ParquetWriter(tmp_path, schema)
-
-            writer.write_table(table)
-            offset += chunk_size
-            print(f"[push_hg] wrote chunk offset={offset}/{state_meta.count} for state_id={state_id}")
+        with ThreadPoolExecutor(max_workers=HF_PUSH_WORKERS, thread_name_prefix="push-hg") as executor:
+            futures = [executor.submit(_write_and_upload, index, start, end)
+                       for index, (start, end) in enumerate(shards)]
+
+            # the first failed shard stops the others, shards not started are cancelled and running ones
+            # are neither written on nor uploaded
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            if pending:
+                failed.set()
+                for future in pending:
+                    future.cancel()
+                wait(pending)
+            futures = [future for future in futures if not future.cancelled()]
+
+            # values that do not fit their column type, the push is done over with those columns as text
+            type_errors = text_columns_of(future.exception() for future in futures)
+            if type_errors:
+                print(f"[push_hg] columns {sorted(type_errors)} of state_id={state_id} have mixed values, "
+                      f"writing them as text")
+                rewrite = True
+            else:
+                try:
+                    operations = [future.result() for future in futures]
+                    _commit(operations)
+                except BadRequestError:
+                    print(f"[push_hg] stale LFS state detected, recreating repo {path}")
+                    api.delete_repo(repo_id=path, repo_type="dataset", token=token)
+                    api.create_repo(repo_id=path, repo_type="dataset", exist_ok=True, private=payload.private,
+                                    token=token)
+
+                    if start_row:
+                        # the rows pushed before are gone with the repo, every row must be pushed again
+                        rewrite = True
+                    else:
+                        # the shards written so far are uploaded again, not rewritten
+                        operations = [_shard_operation(index) for index in range(len(shards))]
+                        list(executor.map(_upload, operations))
+                        _commit(operations)
+        if not rewrite:
+            print(f"[push_hg] upload complete for {path}")
     except Exception:
-        print(f"[push_hg] EXCEPTION writing parquet at offset={offset} for state_id={state_id}")
+        print(f"[push_hg] EXCEPTION pushing parquet shards for state_id={state_id}")
         traceback.print_exc()
         raise
     finally:
-        if writer:
-            writer.close()
-
-    print(f"[push_hg] parquet complete: {tmp_path} for state_id={state_id} ({offset} rows)")
-    return tmp_path, state_name
-
-
-def _push_to_huggingface(state_id: str, payload: ExportHgDatasetRequest, token: str) -> str | None:
-    """Write parquet + upload to HF Hub. Sync — meant to run in a thread pool."""
-    result = _write_state_to_parquet(state_id=state_id, chunk_size=payload.chunk_size)
-    if result is None:
-        return None
-
-    tmp_path, state_name = result
-    try:
-        dataset_name = payload.dataset_name or state_name or state_id[:8]
-        path = f"{payload.namespace}/{dataset_name}"
-
-        api = HfApi()
-        api.create_repo(repo_id=path, repo_type="dataset", exist_ok=True, private=payload.private, token=token)
-
-        parquet_path_in_repo = "data/train-00000-of-00001.parquet"
-        upload_kwargs = dict(
-            path_or_fileobj=tmp_path,
-            path_in_repo=parquet_path_in_repo,
-            repo_id=path,
-            repo_type="dataset",
-            token=token,
-            commit_message=payload.commit_message,
-            revision=payload.revision,
-        )
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-        print(f"[push_hg] uploading parquet to {path}")
-        try:
-            api.upload_file(**upload_kwargs)
-        except BadRequestError:
-            print(f"[push_hg] stale LFS state detected, recreating repo {path}")
-            api.delete_repo(repo_id=path, repo_type="dataset", token=token)
-            api.create_repo(repo_id=path, repo_type="dataset", exist_ok=True, private=payload.private, token=token)
-            api.upload_file(**upload_kwargs)
-        print(f"[push_hg] upload complete for {path}")
-    finally:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
+    if rewrite:
+        return _push_to_huggingface(state_id, payload.model_copy(update={"full": True}), token,
+                                    text_columns=text_columns | type_errors)
 
     return path
 
@@ -165,11 +357,13 @@ def _push_to_huggingface(state_id: str, payload: ExportHgDatasetRequest, token:
 async def push_hg_dataset(
         state_id: str,
         payload: ExportHgDatasetRequest = Body(...),
+        user_id: Optional[str] = Depends(token_service.verify_caller),
 ) -> BasicResponse | None:
+    await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id)
     token = HUGGING_FACE_TOKEN
 
     try:
-        path = await asyncio.to_thread(_push_to_huggingface, state_id, payload, token)
+        path = await execution_lanes.run(LANE_EXPORT, _push_to_huggingface, state_id, payload, token)
         if path is None:
             return None
         return BasicResponse(success=True, message=path)
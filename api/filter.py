@@ -1,8 +1,14 @@
-from typing import Optional, Dict, List
-from fastapi import APIRouter, Depends
+from typing import Optional, Dict, List, Any
+
+import pyarrow as pa
+from fastapi import APIRouter, Depends, HTTPException, Request
 from ismcore.model.filter import Filter, FilterItem, FilterOperator
+from pydantic import BaseModel
+
+from utils.batch_filter import compile_filter, rows_to_vectors, columns_to_vectors, table_to_vectors
+from utils.executors import LANE_METADATA
 from utils.http_exceptions import check_null_response
-from environment import storage
+from environment import storage, execution_lanes
 from api import token_service
 
 filter_router = APIRouter()
@@ -27,6 +33,68 @@ async def apply_filter_on_data(filter_id: str, data: Dict[str, str], user_id: st
     return storage.apply_filter_on_data(filter_id=filter_id, data=data)
 
 
+class FilterBatchRequest(BaseModel):
+    filter_id: Optional[str] = None
+    filter: Optional[Filter] = None  # an inline filter, when no filter_id is given
+    rows: Optional[List[Dict[str, Any]]] = None
+    columns: Optional[Dict[str, List[Any]]] = None  # columnar alternative to rows, column name -> values
+
+
+class FilterBatchResult(BaseModel):
+    mask: List[bool]  # whether each row matches the filter
+    matched: int
+    total: int
+    item_matches: Dict[str, int]  # by filter item key, the number of rows matching that item
+
+
+def _resolve_filter(filter_id: Optional[str], inline_filter: Optional[Filter]) -> Filter:
+    if filter_id:
+        stored_filter = storage.fetch_filter(filter_id=filter_id)
+        if not stored_filter:
+            raise HTTPException(status_code=404, detail=f"filter {filter_id} not found")
+        return stored_filter
+    if inline_filter:
+        return inline_filter
+    raise HTTPException(status_code=400, detail="either filter_id or filter is required")
+
+
+def _evaluate_batch(batch_filter: Filter, rows=None, columns=None, table: pa.Table = None) -> FilterBatchResult:
+    compiled = compile_filter(batch_filter)
+    if table is not None:
+        vectors, total = table_to_vectors(compiled, table), table.num_rows
+    elif columns is not None:
+        vectors, total = columns_to_vectors(compiled, columns)
+    else:
+        vectors, total = rows_to_vectors(compiled, rows or []), len(rows or [])
+
+    mask, item_matches = compiled.evaluate(vectors, total)
+    matched = mask.true_count
+    return FilterBatchResult(mask=mask.to_pylist(), matched=matched, total=total, item_matches=item_matches)
+
+
+@filter_router.put("/apply/batch")
+async def apply_filter_on_batch(batch: FilterBatchRequest, user_id: str = Depends(token_service.verify_jwt)) -> FilterBatchResult:
+    """Evaluate the filter on many rows (or columns of values) at once, vectorised rather than row by row."""
+    batch_filter = _resolve_filter(batch.filter_id, batch.filter)
+    try:
+        return await execution_lanes.run(LANE_METADATA, _evaluate_batch, batch_filter,
+                                         rows=batch.rows, columns=batch.columns)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@filter_router.put("/apply/batch/arrow")
+async def apply_filter_on_arrow_batch(filter_id: str, request: Request, user_id: str = Depends(token_service.verify_jwt)) -> FilterBatchResult:
+    """Evaluate a stored filter on the rows of an arrow ipc stream body, typed columns are used as they are."""
+    batch_filter = _resolve_filter(filter_id, None)
+    try:
+        table = pa.ipc.open_stream(await request.body()).read_all()
+    except (pa.ArrowInvalid, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"invalid arrow stream: {e}")
+
+    return await execution_lanes.run(LANE_METADATA, _evaluate_batch, batch_filter, table=table)
+
+
 @filter_router.get("/user")
 async def fetch_filters_by_user(user_id: str = Depends(token_service.verify_jwt)) -> List[Filter]:
     return storage.fetch_filters_by_user(user_id=user_id) or []
@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from utils.metrics import render_metrics
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("", response_class=PlainTextResponse)
+async def fetch_metrics() -> PlainTextResponse:
+    # metrics of this worker process only, in the prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -7,9 +7,12 @@ from ismcore.model.base_model import Processor, ProcessorStateDirection, Process
 from pydantic import BaseModel
 
 from api import token_service
-from environment import storage
+from environment import storage, workflow_batch_storage, admission_controller, \
+    artifact_cache, execution_lanes
+from utils.admission import ADMISSION_REQUESTS, ADMISSION_MESSAGES
+from utils.executors import LANE_BACKGROUND
 from utils.http_exceptions import check_null_response
-from models.models import ProcessorStatusUpdated
+from models.models import ProcessorStatusUpdated, DeleteProcessorOperation, WorkflowBatchResult
 from message_router import message_router
 
 processor_router = APIRouter()
@@ -22,18 +25,22 @@ async def fetch_processor(processor_id: str, user_id: str = Depends(token_servic
 
 @check_null_response
 @processor_router.delete("/{processor_id}")
-async def delete_processor(processor_id: str):
-    routes = storage.fetch_processor_state_route(processor_id=processor_id)
-    if routes:
-        for route in routes:
-            storage.delete_processor_state_route_by_id(processor_state_id=route.id)
-
-    # delete all workflow edges given the node it is connected to, in any direction.
-    storage.delete_workflow_edges_by_node_id(node_id=processor_id)
-
-    # delete the processor and the node
-    storage.delete_processor(processor_id=processor_id)
-    storage.delete_workflow_node(node_id=processor_id)
+async def delete_processor(processor_id: str) -> WorkflowBatchResult:
+    # the processor, its node and every route and edge attached to it are removed in one transaction, scoped to
+    # the project of the processor, or of its node once the processor itself is gone
+    processor = storage.fetch_processor(processor_id=processor_id)
+    if processor:
+        project_id = processor.project_id
+        if not project_id:
+            raise HTTPException(status_code=400, detail=f"processor {processor_id} is not part of a project")
+    else:
+        project_id = workflow_batch_storage.fetch_node_project_id(node_id=processor_id)
+        if not project_id:
+            raise HTTPException(status_code=404, detail=f"processor {processor_id} not found")
+
+    return workflow_batch_storage.apply_batch(
+        project_id=project_id,
+        operations=[DeleteProcessorOperation(processor_id=processor_id)])
 
 @processor_router.post("/create")
 @check_null_response
@@ -73,7 +80,16 @@ async def change_processor_status(processor_id: str, status: str = "TERMINATE")
     )
 
     # if the update was successful then set success = true
-    if updated > 0: result.success = True
+    if updated > 0:
+        result.success = True
+
+        # the output states are final, their exports are built ahead of the first download
+        if statusCode == ProcessorStatusCode.COMPLETED:
+            output_states = storage.fetch_processor_state_route(
+                processor_id=processor_id, direction=ProcessorStateDirection.OUTPUT) or []
+            artifact_cache.warm(
+                state_ids={output_state.state_id for output_state in output_states},
+                run=lambda build, state_id: execution_lanes.run(LANE_BACKGROUND, build, state_id))
     return result
 
 class TriggerOverrides(BaseModel):
@@ -104,6 +120,9 @@ async def trigger_processor(
     if not processor:
         raise HTTPException(status_code=404, detail=f'Processor {processor_id} not found')
 
+    await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id, project_id=processor.project_id)
+    await admission_controller.admit(ADMISSION_MESSAGES, user_id=user_id, project_id=processor.project_id)
+
     # Merge: processor.properties (base) + explicit fields + catch-all overrides
     props = dict(processor.properties or {})
     if request.action is not None:
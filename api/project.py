@@ -1,7 +1,12 @@
+import asyncio
+import hashlib
+import json
 import uuid
 import datetime as dt
-from typing import Optional, List
-from fastapi import APIRouter, Depends
+from typing import Optional, List, Dict
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from ismcore.model.base_model import (
     UserProject,
@@ -11,11 +16,34 @@ from ismcore.model.processor_state import State, StateConfig
 from ismcore.model.base_model_usage_and_limits import UserProjectCurrentUsageReport
 
 from api import token_service
-from environment import storage
+from db.project_change_storage import (
+    ENTITY_NODE, ENTITY_EDGE, ENTITY_PROCESSOR, ENTITY_STATE, ENTITY_ROUTE, OPERATION_DELETE, edge_entity_id)
+from db.read_replica import use_primary
+from db.state_search_storage import StateSearchPage
+from environment import storage, project_change_storage, state_search_storage, single_flight, execution_lanes, \
+    state_deletion_manager, SNAPSHOT_CONCURRENCY, ENABLED_STATE_SEARCH_INDEX
+from utils.executors import LANE_METADATA, LANE_QUERY
 from utils.http_exceptions import check_null_response
 
 project_router = APIRouter()
 
+# sections of the project snapshot document, selectable via the fields query parameter
+SNAPSHOT_SECTIONS = ("nodes", "edges", "processors", "states", "routes", "templates", "providers")
+
+
+class ProjectSnapshot(BaseModel):
+    """Everything the studio needs to open a project, in a single versioned document"""
+    project_id: str
+    version: str
+    change_version: int  # poll /changes?since=change_version for deltas after this snapshot
+    nodes: Optional[List[WorkflowNode]] = None
+    edges: Optional[List[WorkflowEdge]] = None
+    processors: Optional[List[Processor]] = None
+    states: Optional[List[State]] = None
+    routes: Optional[List[ProcessorState]] = None
+    templates: Optional[List[InstructionTemplate]] = None
+    providers: Optional[List[ProcessorProvider]] = None
+
 
 @project_router.post("/create")
 @check_null_response
@@ -50,7 +78,11 @@ async def fetch_project_instruction_templates(project_id: str) -> List[Instructi
 @project_router.get("/{project_id}/states")
 async def fetch_project_states(project_id: str) \
         -> List[State]:
-    states = storage.fetch_states(project_id=project_id)
+    return await single_flight.run("project_states", project_id, _load_project_states, project_id)
+
+
+def _load_project_states(project_id: str) -> List[State]:
+    states = state_deletion_manager.exclude_purging(storage.fetch_states(project_id=project_id))
     if not states:
         return []
 
@@ -66,9 +98,190 @@ async def fetch_project_processor_states(project_id: str) \
         -> List[ProcessorState]:
     # TODO needs caching likely, or we need to stream this to each user connected,
     #  instead of a POLL mechanism (this was the easiest fastest for now, ...)
-    processor_states = storage.fetch_processor_state_routes_by_project_id(project_id=project_id)
+    processor_states = await single_flight.run(
+        "project_processor_states", project_id,
+        storage.fetch_processor_state_routes_by_project_id, project_id=project_id)
     return processor_states or []
 
+async def _fetch_project_snapshot_sections(project_id: str, sections: List[str]) -> dict:
+    """Run the storage queries of the requested snapshot sections concurrently, bounded by SNAPSHOT_CONCURRENCY."""
+    semaphore = asyncio.Semaphore(SNAPSHOT_CONCURRENCY)
+
+    async def run(func, **kwargs):
+        async with semaphore:
+            return await execution_lanes.run(LANE_METADATA, func, **kwargs)
+
+    async def load_states():
+        states = await run(storage.fetch_states, project_id=project_id)
+        states = await run(state_deletion_manager.exclude_purging, states=states)
+        if not states:
+            return []
+
+        states = await asyncio.gather(*[
+            run(storage.load_state, state_id=state.id, load_data=False) for state in states
+        ])
+        return [state for state in states if state]
+
+    queries = {
+        "nodes": lambda: run(storage.fetch_workflow_nodes, project_id=project_id),
+        "edges": lambda: run(storage.fetch_workflow_edges, project_id=project_id),
+        "processors": lambda: run(storage.fetch_processors, project_id=project_id),
+        "states": load_states,
+        "routes": lambda: run(storage.fetch_processor_state_routes_by_project_id, project_id=project_id),
+        "templates": lambda: run(storage.fetch_templates, project_id=project_id),
+        "providers": lambda: run(storage.fetch_processor_providers, project_id=project_id),
+    }
+
+    results = await asyncio.gather(*[queries[section]() for section in sections])
+    return {section: result or [] for section, result in zip(sections, results)}
+
+
+# served by the primary, the snapshot is paired with a change log version and must not lag behind it
+@project_router.get("/{project_id}/snapshot", response_model=ProjectSnapshot, response_model_exclude_none=True,
+                    dependencies=[Depends(use_primary)])
+async def fetch_project_snapshot(
+    project_id: str,
+    request: Request,
+    fields: Optional[str] = Query(None, description=f"Comma separated sections to include: {', '.join(SNAPSHOT_SECTIONS)}"),
+    user_id: str = Depends(token_service.verify_jwt)
+):
+    """
+    Fetch the workflow nodes, edges, processors, states, routes, templates and providers of a project in one call.
+    The version is a content hash, also returned as the ETag; a matching If-None-Match yields 304 Not Modified.
+    """
+    sections = [section.strip() for section in fields.split(",") if section.strip()] if fields else list(SNAPSHOT_SECTIONS)
+    invalid = [section for section in sections if section not in SNAPSHOT_SECTIONS]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"invalid snapshot fields: {', '.join(invalid)}")
+
+    # taken before the queries, so that a concurrent change is delivered again rather than missed
+    change_version = project_change_storage.fetch_current_version(project_id=project_id)
+    content = jsonable_encoder(await _fetch_project_snapshot_sections(project_id=project_id, sections=sections))
+    version = hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+    etag = f'"{version}"'
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return JSONResponse(
+        content={"project_id": project_id, "version": version, "change_version": change_version, **content},
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
+
+
+# change log entity types and the section they are reported under
+CHANGE_SECTIONS = {
+    ENTITY_NODE: "nodes",
+    ENTITY_EDGE: "edges",
+    ENTITY_PROCESSOR: "processors",
+    ENTITY_STATE: "states",
+    ENTITY_ROUTE: "routes",
+}
+
+
+class ProjectGraphEntities(BaseModel):
+    nodes: List[WorkflowNode] = []
+    edges: List[WorkflowEdge] = []
+    processors: List[Processor] = []
+    states: List[State] = []
+    routes: List[ProcessorState] = []
+
+
+class ProjectChanges(BaseModel):
+    """Delta of a project workflow graph between the since version and the current version"""
+    project_id: str
+    since: int
+    version: int
+    inserted: ProjectGraphEntities = ProjectGraphEntities()
+    updated: ProjectGraphEntities = ProjectGraphEntities()
+    deleted: Dict[str, List[str]] = {}
+
+
+@project_router.get("/{project_id}/changes", dependencies=[Depends(use_primary)])
+async def fetch_project_changes(
+    project_id: str,
+    since: int = Query(0, description="Change version last seen by the client"),
+    user_id: str = Depends(token_service.verify_jwt)
+) -> ProjectChanges:
+    """
+    Fetch the nodes, edges, processors, states and routes inserted, updated or deleted after the since version.
+    Only entity types that actually changed are loaded, an unchanged graph costs a single query.
+    """
+    changes = project_change_storage.fetch_changes_since(project_id=project_id, since=since)
+    version = max([change.version for change in changes], default=None) \
+        or project_change_storage.fetch_current_version(project_id=project_id)
+
+    result = ProjectChanges(project_id=project_id, since=since, version=max(version, since))
+    if not changes:
+        return result
+
+    # latest upsert per entity type, the entity must be loaded and is classified by whether the client knew it
+    upserts: Dict[str, Dict[str, bool]] = {}
+    for change in changes:
+        if change.entity_type not in CHANGE_SECTIONS:
+            continue
+
+        if change.operation == OPERATION_DELETE:
+            result.deleted.setdefault(CHANGE_SECTIONS[change.entity_type], []).append(change.entity_id)
+        else:
+            upserts.setdefault(change.entity_type, {})[change.entity_id] = change.existed
+
+    loaders = {
+        ENTITY_NODE: lambda ids: [
+            node for node in storage.fetch_workflow_nodes(project_id=project_id) or [] if node.node_id in ids],
+        ENTITY_EDGE: lambda ids: [
+            edge for edge in storage.fetch_workflow_edges(project_id=project_id) or []
+            if edge_entity_id(edge.source_node_id, edge.target_node_id) in ids],
+        ENTITY_PROCESSOR: lambda ids: [
+            processor for processor in storage.fetch_processors(project_id=project_id) or [] if processor.id in ids],
+        ENTITY_STATE: lambda ids: [
+            state for state in [storage.load_state(state_id=state_id, load_data=False) for state_id in ids] if state],
+        ENTITY_ROUTE: lambda ids: [
+            route for route in storage.fetch_processor_state_routes_by_project_id(project_id=project_id) or []
+            if route.id in ids],
+    }
+
+    def entity_id_of(entity_type: str, entity) -> str:
+        if entity_type == ENTITY_NODE:
+            return entity.node_id
+        elif entity_type == ENTITY_EDGE:
+            return edge_entity_id(entity.source_node_id, entity.target_node_id)
+        return entity.id
+
+    for entity_type, existed_by_id in upserts.items():
+        section = CHANGE_SECTIONS[entity_type]
+        for entity in loaders[entity_type](set(existed_by_id.keys())):
+            existed = existed_by_id.pop(entity_id_of(entity_type, entity), False)
+            getattr(result.updated if existed else result.inserted, section).append(entity)
+
+        # changed entities that no longer exist were removed outside the tracked endpoints
+        if existed_by_id:
+            result.deleted.setdefault(section, []).extend(existed_by_id.keys())
+
+    return result
+
+
+@project_router.get("/{project_id}/search")
+async def search_project_state_data(
+        project_id: str,
+        q: str = Query(..., description="Search query, words, \"quoted phrases\", OR and -negation"),
+        columns: Optional[List[str]] = Query(None, description="Columns to search, all text columns by default"),
+        limit: int = Query(20, ge=1, le=200),
+        offset: int = Query(0, ge=0),
+        user_id: str = Depends(token_service.verify_jwt)) -> StateSearchPage:
+    """Full text search of the values of all states of the project, best ranked rows first."""
+    if not ENABLED_STATE_SEARCH_INDEX:
+        raise HTTPException(status_code=404,
+                            detail="state data search is not enabled, set ENABLED_STATE_SEARCH_INDEX=true")
+    try:
+        return await execution_lanes.run(
+            LANE_QUERY, state_search_storage.search,
+            query=q, project_id=project_id, columns=columns, limit=limit, offset=offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @project_router.get("/{project_id}")
 @check_null_response
 async def fetch_project(project_id: str, user_id: str = Depends(token_service.verify_jwt)) -> Optional[UserProject]:
@@ -136,7 +349,7 @@ async def clone_project(project_id: str, request: CloneProjectRequest) -> bool:
         edges = {}
 
     state_mapping = {}
-    states = storage.fetch_states(project_id=project_id)
+    states = state_deletion_manager.exclude_purging(storage.fetch_states(project_id=project_id))
     for fetched_state in states:
         state = storage.load_state(state_id=fetched_state.id, load_data=request.copy_data)
         old_state_id = state.id
@@ -1,39 +1,71 @@
 import asyncio
-import io
 import json
+import logging
 import openpyxl
 from openpyxl.styles import Alignment
 import tempfile
 import os
+from concurrent.futures import Executor
 
-from typing import Optional, Union
-from fastapi.responses import StreamingResponse
-from fastapi import UploadFile, File, APIRouter, Depends, Query
+from typing import List, Optional, Union
+from fastapi.responses import StreamingResponse, Response
+from fastapi import UploadFile, File, APIRouter, Depends, Query, Request, HTTPException
 from ismcore.messaging.base_message_route_model import RouteMessageStatus
 from ismcore.model.base_model import ProcessorStateDirection
+from ismcore.model.filter import Filter
 from ismcore.model.processor_state import State
-from pydantic import ValidationError
+from pydantic import BaseModel, Field, ValidationError
 
 from api import token_service
 from api.processor_state_route import SELECTOR_STATE_ROUTER
-from environment import storage
+from db.state_deletion_storage import StateDeletionProgress
+from db.state_query_storage import StateDataPage
+from db.state_search_storage import StateSearchPage
+from environment import storage, state_deletion_manager, execution_lanes, admission_controller, \
+    state_bulk_load_storage, upload_sessions, artifact_cache, state_query_storage, state_search_storage, \
+    STATE_SYNC_ENCODING, STATE_SYNC_COMPRESSION, ENABLED_STATE_SEARCH_INDEX
 from message_router import message_router
+from utils.admission import ADMISSION_REQUESTS, ADMISSION_BYTES, ADMISSION_MESSAGES
+from utils.columnar import negotiate_media_type, state_page_to_arrow, state_page_to_msgpack, ARROW_STREAM_MEDIA_TYPE
+from utils.envelope import encode_state_sync_message
+from utils.executors import LANE_EXPORT, LANE_QUERY
 from utils.http_exceptions import check_null_response
-from utils.process_file import process_csv_state_sync_store
+from utils.ingest_dedup import IngestDeduplicator, deduplicate_blocks
+from utils.process_file import detect_upload_format, stream_upload_blocks, FORMAT_CSV, FORMAT_JSONL, \
+    UPLOAD_FORMATS
+from utils.upload_sessions import UploadSession, UploadSessionAborted, UPLOAD_FINAL_STATUSES
+
+logger = logging.getLogger(__name__)
 
 state_router = APIRouter()
+
+# upload modes: publish the rows to the state sync route, or COPY them directly into the state data tables
+UPLOAD_MODE_SYNC = "sync"
+UPLOAD_MODE_COPY = "copy"
 state_router_route = message_router.find_route(SELECTOR_STATE_ROUTER)
 
 @state_router.get('/{state_id}')
 @check_null_response
 async def fetch_state(
     state_id: str,
+    request: Request,
     load_data: bool = False,
     offset: int = Query(..., description="Offset for pagination"),
     limit: int = Query(..., description="Limit for pagination"),
     user_id: str = Depends(token_service.verify_jwt)
 ) -> Optional[State]:
-    return storage.load_state(state_id=state_id, load_data=load_data, offset=offset, limit=limit)
+    state = storage.load_state(state_id=state_id, load_data=load_data, offset=offset, limit=limit)
+    if not state:
+        return None
+
+    # columnar binary representations of the page, negotiated by the Accept header
+    media_type = negotiate_media_type(request.headers.get("accept"))
+    if media_type == ARROW_STREAM_MEDIA_TYPE:
+        return Response(content=state_page_to_arrow(state, offset=offset, limit=limit), media_type=media_type)
+    elif media_type:
+        return Response(content=state_page_to_msgpack(state, offset=offset, limit=limit), media_type=media_type)
+
+    return state
 
 
 def _write_excel_row(worksheet, row_index: int, row_data: dict, column_mapping: dict):
@@ -86,7 +118,16 @@ def _file_iterator(file_path: str, chunk_size: int = 8192):
             os.unlink(file_path)
 
 def _build_excel_file(state_id: str, chunk_size: int) -> str:
-    """Build Excel export file. Sync — meant to run in a thread pool."""
+    """
+    Build Excel export file, or check out the one cached for the state data version. Either way the file is the
+    caller's to remove. Sync — meant to run in the export lane.
+    """
+    # the version before the data, a write meanwhile only makes the file newer than its key
+    cache_key = artifact_cache.key(state_id, artifact_cache.data_version(state_id), "xlsx")
+    cached_path = artifact_cache.checkout(cache_key)
+    if cached_path:
+        return cached_path
+
     state_meta = storage.load_state_metadata(state_id=state_id)
     if not state_meta:
         raise ValueError(f"State {state_id} not found")
@@ -118,9 +159,14 @@ def _build_excel_file(state_id: str, chunk_size: int) -> str:
         tmp_path = tmp_file.name
         wb.save(tmp_file.name)
 
+    artifact_cache.put(cache_key, tmp_path)
     return tmp_path
 
 
+# exports of states are built ahead of their download once the processor of the state completes
+artifact_cache.register_warmer("xlsx", lambda state_id: os.unlink(_build_excel_file(state_id, chunk_size=1000)))
+
+
 @state_router.get(
     "/{state_id}/export",
     summary="Export state as Excel",
@@ -131,7 +177,8 @@ async def export_state_excel(
     chunk_size: int = Query(1000, description="Number of rows to load per chunk"),
     user_id: str = Depends(token_service.verify_jwt)
 ) -> StreamingResponse:
-    tmp_path = await asyncio.to_thread(_build_excel_file, state_id, chunk_size)
+    await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id)
+    tmp_path = await execution_lanes.run(LANE_EXPORT, _build_excel_file, state_id, chunk_size)
 
     return StreamingResponse(
         _file_iterator(tmp_path),
@@ -139,29 +186,117 @@ async def export_state_excel(
         headers={"Content-Disposition": f'attachment; filename="state_{state_id}.xlsx"'},
     )
 
+class StateDataQuery(BaseModel):
+    filter_id: Optional[str] = None  # a stored filter, or else the filter
+    filter: Optional[Filter] = None
+    columns: Optional[List[str]] = None  # the columns to return, all when not set
+    sort: Optional[str] = None
+    descending: bool = False
+    limit: int = Field(100, ge=1, le=1000)
+    cursor: Optional[str] = None  # next_cursor of the previous page
+
+
+@state_router.post('/{state_id}/data/query')
+async def query_state_data(
+    state_id: str,
+    query: StateDataQuery,
+    user_id: str = Depends(token_service.verify_jwt)
+) -> StateDataPage:
+    """
+    The rows of the state matching a filter, evaluated by the database, with only the requested columns,
+    optionally sorted by a column, a page at a time (pass the next_cursor of a page to fetch the next one).
+    """
+    state_filter = query.filter
+    if query.filter_id:
+        state_filter = storage.fetch_filter(filter_id=query.filter_id)
+        if not state_filter:
+            raise HTTPException(status_code=404, detail=f"filter {query.filter_id} not found")
+
+    try:
+        page, index_columns = await execution_lanes.run(
+            LANE_QUERY, state_query_storage.query_state_data,
+            state_id=state_id, filter=state_filter, columns=query.columns, sort=query.sort,
+            descending=query.descending, limit=query.limit, cursor=query.cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # columns filtered frequently are candidates for an index, created by an operator (python -m db.filter_indexes)
+    for column in index_columns:
+        logger.info(f'column {column.name} ({column.id}) of state {state_id} is filtered frequently, '
+                    f'a candidate for a filter index')
+
+    return page
+
+
+@state_router.get('/{state_id}/data/search')
+async def search_state_data(
+    state_id: str,
+    q: str = Query(..., description="Search query, words, \"quoted phrases\", OR and -negation"),
+    columns: Optional[List[str]] = Query(None, description="Columns to search, all text columns by default"),
+    limit: int = Query(20, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    user_id: str = Depends(token_service.verify_jwt)
+) -> StateSearchPage:
+    """Full text search of the values of the state, best ranked rows first with highlighted snippets."""
+    if not ENABLED_STATE_SEARCH_INDEX:
+        raise HTTPException(status_code=404,
+                            detail="state data search is not enabled, set ENABLED_STATE_SEARCH_INDEX=true")
+    try:
+        return await execution_lanes.run(
+            LANE_QUERY, state_search_storage.search,
+            query=q, state_id=state_id, columns=columns, limit=limit, offset=offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @state_router.post("/create")
 @check_null_response
 async def merge_state(state: State) -> State:
+    # a save would write the columns (and count) of a state whose data is being deleted
+    if state.id and state_deletion_manager.is_deleting(state_id=state.id):
+        raise HTTPException(status_code=409, detail=f"state {state.id} is being deleted")
+
     # TODO we should propagate this as a CQRS event to the state machine instead of saving it directly
     return storage.save_state(state=state, options={
         "force_update_column": True,
         "force_update_count": False,
     })
 
-@state_router.delete('/{state_id}/data')
+@state_router.delete('/{state_id}/data', status_code=202)
 @check_null_response
-async def delete_state_data(state_id: str) -> int:
-    result = storage.delete_state_data(state_id=state_id)
-    return 1
+async def delete_state_data(state_id: str) -> Optional[StateDeletionProgress]:
+    if not storage.fetch_state(state_id=state_id):
+        return None
+
+    # the data is deleted in the background, in throttled data index ranges
+    progress = state_deletion_manager.start(state_id=state_id)
+    artifact_cache.invalidate(state_id=state_id)
+    return progress
 
 
-@state_router.delete('/{state_id}')
-async def delete_state(state_id: str, user_id: str = Depends(token_service.verify_jwt)) -> int:
+@state_router.delete('/{state_id}', status_code=202)
+@check_null_response
+async def delete_state(state_id: str, user_id: str = Depends(token_service.verify_jwt)) \
+        -> Optional[StateDeletionProgress]:
+    if not storage.fetch_state(state_id=state_id):
+        return None
+
+    # detach the state from the graph right away, such that nothing is routed into it any longer
     storage.delete_processor_state_routes_by_state_id(state_id=state_id)
-    storage.delete_state_cascade(state_id=state_id)
     storage.delete_workflow_edges_by_node_id(node_id=state_id)
     storage.delete_workflow_node(node_id=state_id)
-    return 1
+
+    artifact_cache.invalidate(state_id=state_id)
+
+    # the data and finally the state itself are deleted in the background
+    return state_deletion_manager.start(state_id=state_id, purge=True)
+
+
+@state_router.get('/{state_id}/deletion')
+@check_null_response
+async def fetch_state_deletion(state_id: str, user_id: str = Depends(token_service.verify_jwt)) \
+        -> Optional[StateDeletionProgress]:
+    return state_deletion_manager.fetch_progress(state_id=state_id)
 
 
 @state_router.delete("/{state_id}/config/{definition_type}/{id}")
@@ -219,11 +354,17 @@ def derive_message_from_input_value(route_id: str, query_state_entry_value: any)
 
 @state_router.post('/{state_id}/forward/entry')
 @check_null_response
-async def route_forward_query_state_entry(state_id: str, input_value: Union[str, dict, bytes]) -> RouteMessageStatus:
+async def route_forward_query_state_entry(
+    state_id: str,
+    input_value: Union[str, dict, bytes],
+    user_id: Optional[str] = Depends(token_service.verify_caller)
+) -> RouteMessageStatus:
     state = storage.fetch_state(state_id=state_id)
     if not state:
         raise ValidationError(f'input state id {state_id} does not exist')
 
+    await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id, project_id=state.project_id)
+
     # fetch the processor state route for the input state id
     # essentially what this is doing is finding a set of processors that take this state as their input
     processor_state_routes = storage.fetch_processor_state_route(
@@ -233,6 +374,10 @@ async def route_forward_query_state_entry(state_id: str, input_value: Union[str,
     if not processor_state_routes:
         raise ValidationError(f"state_id: {state_id} is not connected to any processor inputs")
 
+    # one message is published per connected processor
+    await admission_controller.admit(
+        ADMISSION_MESSAGES, user_id=user_id, project_id=state.project_id, amount=len(processor_state_routes))
+
     # user = "krasaee"  # TODO need to extract from jwt
 
     status = None # TODO need to fix this such that we do not send hundreds of messages.
@@ -253,51 +398,238 @@ async def route_forward_query_state_entry(state_id: str, input_value: Union[str,
     return status
 
 
-@state_router.post("/{state_id}/data/upload")
-async def upload_file(state_id: str, file: UploadFile = File(...)):
+async def _copy_upload_blocks(state_id: str, blocks) -> tuple[int, Optional[State]]:
+    """COPY the blocks into the state data tables, each block is committed (and counted) as it is written."""
+    load = await asyncio.to_thread(state_bulk_load_storage.begin_load, state_id=state_id)
+    if not load:
+        raise KeyError(f"unable to locate state id {state_id}")
+
+    count = 0
     try:
-        state = storage.load_state(state_id=state_id)
+        async for block in blocks:
+            count += await asyncio.to_thread(load.write, block)
+        return count, await asyncio.to_thread(load.commit)
+    except BaseException:
+        await asyncio.to_thread(load.rollback)
+        raise
+
+
+async def _ingest_upload(state: State,
+                         file,
+                         upload_format: str,
+                         mode: str,
+                         notify: bool,
+                         deduplicate: bool,
+                         executor: Optional[Executor] = None) -> dict:
+    """
+    Ingest a file object (read a block at a time) into the state, returns the summary of the ingest. The file
+    is read on the threads of the executor when given, the default threads otherwise.
+    """
+    deduplicator = IngestDeduplicator(
+        state=state, fetch_existing_keys=state_bulk_load_storage.fetch_existing_state_keys) if deduplicate else None
+
+    if mode == UPLOAD_MODE_COPY:
+        # pure data ingestion, no message per block
+        blocks = stream_upload_blocks(file, upload_format=upload_format, block_size=5000, executor=executor)
+        count, state = await _copy_upload_blocks(
+            state_id=state.id, blocks=deduplicate_blocks(blocks, deduplicator))
+
+        if notify:
+            sync_route = message_router.find_route("processor/state/sync")
+            await sync_route.publish(msg=json.dumps({
+                "type": "state_loaded",
+                "state_id": state.id,
+                "rows": count,
+                "count": state.count
+            }))
 
-        if not state:
-            raise KeyError(f"unable to locate state id {state_id}")
+        return {
+            "message": "file loaded successfully",
+            "state_id": state.id,
+            "format": upload_format,
+            **(deduplicator.summary() if deduplicator else {}),
+            "rows": count,
+            "count": state.count
+        }
 
-        data = await file.read()
-        text_data = io.StringIO(data.decode('utf-8'))
-        query_state = await process_csv_state_sync_store(state=state, io=text_data)
-
-        ## publish blocks of data instead of a one shot dataset
-        offset = 0
-        chunks = 200
-        sync_route = message_router.find_route("processor/state/sync")
-        while offset < len(query_state):
-            block = query_state[offset:offset + chunks]
-            offset += chunks
-
-            # derive the new message with complete csv file data
-            message = {
-                "type": "query_state_direct",
-                "state_id": state.id,
-                "query_state": block
-            }
+    ## publish blocks of data instead of a one shot dataset
+    chunks = 200
+    count = 0
+    sync_route = message_router.find_route("processor/state/sync")
+    blocks = stream_upload_blocks(file, upload_format=upload_format, block_size=chunks, executor=executor)
+    async for block in deduplicate_blocks(blocks, deduplicator):
+        count += len(block)
 
-            message_string = json.dumps(message)
-            await sync_route.publish(msg=message_string)
+        # derive the new message with the block of file data
+        message_string = encode_state_sync_message(
+            state_id=state.id, rows=block, encoding=STATE_SYNC_ENCODING, compression=STATE_SYNC_COMPRESSION)
+        await sync_route.publish(msg=message_string)
 
 
-        # sync_route.flush()
+    # sync_route.flush()
 
-        # state = storage.save_state(state=state)
+    # state = storage.save_state(state=state)
 
-        return {
-            "status": "success",
-            "message": "file uploaded successfully",
-            "state_id": state.id,
-            "count": state.count
-        }
+    return {
+        "message": "file uploaded successfully",
+        "state_id": state.id,
+        "format": upload_format,
+        **(deduplicator.summary() if deduplicator else {}),
+        "rows": count,
+        "count": state.count
+    }
+
+
+@state_router.post("/{state_id}/data/upload")
+async def upload_file(
+    state_id: str,
+    file: UploadFile = File(...),
+    upload_format: Optional[str] = Query(None, alias="format", description="csv, parquet, arrow, jsonl or xlsx, "
+                                                                          "detected from the file when not set"),
+    mode: str = Query(UPLOAD_MODE_SYNC, pattern=f"^({UPLOAD_MODE_SYNC}|{UPLOAD_MODE_COPY})$",
+                      description="sync publishes the rows for processing, copy writes them directly"),
+    notify: bool = Query(False, description="publish a single state loaded event after a copy"),
+    deduplicate: bool = Query(True, description="skip rows whose primary key is repeated or already in the state"),
+    user_id: Optional[str] = Depends(token_service.verify_caller)
+):
+    if state_deletion_manager.is_deleting(state_id=state_id):
+        raise HTTPException(status_code=409, detail=f"state {state_id} is being deleted")
+
+    state = storage.load_state_metadata(state_id=state_id)
+    if state:
+        # admitted before the upload is read, rejections must not be reported as an upload error below
+        await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id, project_id=state.project_id)
+        if file.size:
+            await admission_controller.admit(
+                ADMISSION_BYTES, user_id=user_id, project_id=state.project_id, amount=file.size)
+
+    try:
+        if not state:
+            raise KeyError(f"unable to locate state id {state_id}")
+
+        # the upload is spooled to disk by the server, it is read from there a block at a time
+        if not upload_format:
+            head = await file.read(8)
+            await file.seek(0)
+            upload_format = detect_upload_format(filename=file.filename, head=head)
+
+        summary = await _ingest_upload(
+            state=state, file=file.file, upload_format=upload_format, mode=mode, notify=notify,
+            deduplicate=deduplicate)
+
+        return {"status": "success", **summary}
     except Exception as e:
         return {"status": "error", "message": str(e), "count": 0}
 
 
+class UploadSessionRequest(BaseModel):
+    filename: Optional[str] = None
+    size: int = Field(..., gt=0)
+    format: Optional[str] = None
+    mode: str = Field(UPLOAD_MODE_SYNC, pattern=f"^({UPLOAD_MODE_SYNC}|{UPLOAD_MODE_COPY})$")
+    notify: bool = False
+    deduplicate: bool = True
+
+
+def _load_upload_session(state_id: str, session_id: str, user_id: str) -> UploadSession:
+    session = upload_sessions.store.load(session_id)
+    if not session or session.state_id != state_id or session.user_id != user_id:
+        raise HTTPException(status_code=404, detail=f"upload session {session_id} not found")
+    return session
+
+
+@state_router.post("/{state_id}/data/upload/sessions")
+async def create_upload_session(
+    state_id: str,
+    request: UploadSessionRequest,
+    user_id: str = Depends(token_service.verify_jwt)
+) -> UploadSession:
+    """
+    Start a resumable upload of a large file, the parts are then sent (in any order and in parallel) as byte
+    ranges of the file. csv and jsonl are ingested while the parts arrive, from the contiguous bytes received so
+    far; parquet, arrow and xlsx need random access and are ingested once the whole file is received.
+    """
+    if state_deletion_manager.is_deleting(state_id=state_id):
+        raise HTTPException(status_code=409, detail=f"state {state_id} is being deleted")
+
+    state = storage.load_state_metadata(state_id=state_id)
+    if not state:
+        raise HTTPException(status_code=404, detail=f"unable to locate state id {state_id}")
+
+    await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id, project_id=state.project_id)
+    await admission_controller.admit(ADMISSION_BYTES, user_id=user_id, project_id=state.project_id,
+                                     amount=request.size)
+
+    upload_format = request.format or detect_upload_format(filename=request.filename, head=b"")
+    if upload_format not in UPLOAD_FORMATS:
+        raise HTTPException(status_code=400, detail=f"unsupported upload format {upload_format}")
+
+    session = upload_sessions.store.create(UploadSession(
+        state_id=state.id,
+        user_id=user_id,
+        filename=request.filename,
+        size=request.size,
+        upload_format=upload_format,
+        mode=request.mode,
+        notify=request.notify,
+        deduplicate=request.deduplicate))
+
+    async def ingest(upload_session: UploadSession, file) -> dict:
+        return await _ingest_upload(
+            state=state, file=file, upload_format=upload_session.upload_format, mode=upload_session.mode,
+            notify=upload_session.notify, deduplicate=upload_session.deduplicate,
+            executor=upload_sessions.reader_executor)
+
+    upload_sessions.start(session, ingest=ingest, streaming=upload_format in (FORMAT_CSV, FORMAT_JSONL))
+    return session
+
+
+@state_router.put("/{state_id}/data/upload/sessions/{session_id}")
+async def upload_session_part(
+    state_id: str,
+    session_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0, description="byte offset of the part within the file"),
+    user_id: str = Depends(token_service.verify_jwt)
+) -> UploadSession:
+    """Write the request body at the offset, a part that fails can be sent again (it is idempotent)."""
+    session = _load_upload_session(state_id=state_id, session_id=session_id, user_id=user_id)
+    if session.status in UPLOAD_FINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"upload session {session_id} is {session.status}")
+
+    try:
+        await upload_sessions.store.write_part(session, offset=offset, chunks=request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UploadSessionAborted as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    return upload_sessions.store.load(session_id)
+
+
+@state_router.get("/{state_id}/data/upload/sessions/{session_id}")
+async def fetch_upload_session(
+    state_id: str,
+    session_id: str,
+    user_id: str = Depends(token_service.verify_jwt)
+) -> UploadSession:
+    """The progress of the upload, the received ranges tell a resuming client which parts are missing."""
+    return _load_upload_session(state_id=state_id, session_id=session_id, user_id=user_id)
+
+
+@state_router.delete("/{state_id}/data/upload/sessions/{session_id}")
+async def abort_upload_session(
+    state_id: str,
+    session_id: str,
+    user_id: str = Depends(token_service.verify_jwt)
+) -> UploadSession:
+    session = _load_upload_session(state_id=state_id, session_id=session_id, user_id=user_id)
+    if session.status in UPLOAD_FINAL_STATUSES:
+        return session
+
+    return upload_sessions.abort(session)
+
+
 @state_router.get('/{state_id}/processors')
 @check_null_response
 async def fetch(state_id: str):
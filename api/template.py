@@ -1,10 +1,13 @@
 from typing import Optional, List, Dict
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, Depends
+from pydantic import BaseModel, Field
 from ismcore.model.base_model import InstructionTemplate
 
-from environment import storage
+from api import token_service
+from environment import storage, single_flight, execution_lanes
 from api.template_examples import TemplateExamples
+from utils.executors import LANE_SANDBOX
+from utils.sandbox import render_mako_template, check_mako_template
 
 template_router = APIRouter()
 
@@ -25,6 +28,15 @@ class StateSampleData(BaseModel):
     total_rows: int
 
 
+class TemplateRenderRequest(BaseModel):
+    """Request to preview a template against sample rows of a state"""
+    state_id: str
+    offset: int = 0
+    limit: int = Field(10, ge=1, le=100)
+    batch: bool = False  # render once with all rows as items, instead of once per row
+    template_content: Optional[str] = None  # unsaved content to render instead of the stored template
+
+
 class AutocompletionRequest(BaseModel):
     """Request model for autocompletion"""
     state_columns: Optional[List[StateColumnInfo]] = None
@@ -79,7 +91,48 @@ async def get_template_examples(template_type: str) -> List[Dict]:
 
 @template_router.get("/{template_id}")
 async def fetch_instruction_template(template_id: str) -> Optional[InstructionTemplate]:
-    return storage.fetch_template(template_id=template_id)
+    return await single_flight.run("template", template_id, storage.fetch_template, template_id=template_id)
+
+
+@template_router.post("/{template_id}/render")
+async def render_instruction_template(template_id: str, request: TemplateRenderRequest,
+                                      user_id: str = Depends(token_service.verify_jwt)) -> Dict:
+    """
+    Render a mako template against sample rows of a state, returning the output (or error) and render timing of
+    each row. Templates are compiled once per content hash, such that edits can be previewed interactively.
+
+    Only templates limited to expressions, filters and control lines are previewed (no python blocks, imports
+    or private names), see check_mako_template.
+    """
+    content = request.template_content
+    if content is None:
+        template = await single_flight.run("template", template_id, storage.fetch_template, template_id=template_id)
+        if not template:
+            raise HTTPException(status_code=404, detail=f"Template not found: {template_id}")
+
+        if template.template_type and template.template_type.lower() != "mako":
+            raise HTTPException(
+                status_code=400, detail=f"Render preview is only supported for mako templates, "
+                                        f"not {template.template_type}")
+        content = template.template_content or ""
+
+    try:
+        violations = check_mako_template(content)
+    except Exception:
+        violations = []  # a template that does not parse is reported by the render, with the mako error detail
+    if violations:
+        raise HTTPException(status_code=400, detail=violations)
+
+    state = storage.load_state(
+        state_id=request.state_id, load_data=True, offset=request.offset, limit=request.limit)
+    if not state:
+        raise HTTPException(status_code=404, detail=f"State not found: {request.state_id}")
+
+    rows = _convert_state_data_to_rows(state)
+
+    # rendered in a worker process of the sandbox lane (without the api environment), under a render deadline
+    result = await execution_lanes.run(LANE_SANDBOX, render_mako_template, content, rows, request.batch)
+    return {"template_id": template_id, "state_id": request.state_id, "row_count": len(rows), **result}
 
 
 @template_router.post('/create')
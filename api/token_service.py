@@ -1,16 +1,36 @@
+import hmac
 import os
 import jwt
 import datetime
+from typing import Optional
 
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from starlette import status
 
+from environment import CALLER_IDENTITY_REQUIRED
+from utils.admission import SERVICE_CALLER_PREFIX
+
 # Replace with a secure key
 SECRET_KEY = os.environ.get("SECRET_KEY", "<hello world>")
 
 # Create an HTTPBearer instance
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+
+def parse_service_tokens(value: str) -> dict:
+    """Parse name=token entries, e.g. "processor-openai=...,sync=..." into a token to service name mapping."""
+    tokens = {}
+    for entry in (value or "").split(","):
+        if "=" in entry:
+            name, token = entry.split("=", 1)
+            tokens[token.strip()] = name.strip()
+    return tokens
+
+
+# bearer tokens of service callers (processors, pipelines) which have no user, by token
+SERVICE_TOKENS = parse_service_tokens(os.environ.get("SERVICE_TOKENS", None))
 
 def generate_jwt(user_id: str):
     expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=24)  # JWT expiration (24 hours)
@@ -46,3 +66,25 @@ def verify_jwt(credentials: HTTPAuthorizationCredentials = Depends(security)):
             detail="Invalid token",
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+
+def verify_caller(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> Optional[str]:
+    """
+    The identity of the caller: the user of a JWT, or service:<name> for a service token (not admission controlled).
+    Without credentials the caller is anonymous (None), which is only accepted while no identity is required.
+    """
+    if credentials is None:
+        if CALLER_IDENTITY_REQUIRED:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Not authenticated, a user or service token is required",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return None
+
+    service = next((name for token, name in SERVICE_TOKENS.items()
+                    if hmac.compare_digest(token, credentials.credentials)), None)
+    if service:
+        return f"{SERVICE_CALLER_PREFIX}{service}"
+
+    return verify_jwt(credentials)
@@ -5,7 +5,7 @@ from ismcore.model.base_model_usage_and_limits import UserProjectCurrentUsageRep
 from ismcore.storage.processor_state_storage import FieldConfig
 
 from api import token_service
-from environment import storage
+from environment import storage, single_flight
 from utils.http_exceptions import check_null_response
 
 usage_router = APIRouter()
@@ -46,7 +46,9 @@ async def fetch_project_usage_percentages(project_id: str, user_id: str = Depend
     if project_id is None:
         return None
 
-    user_current_usage = storage.fetch_user_project_current_usage_report(user_id=user_id, project_id=project_id)
+    user_current_usage = await single_flight.run(
+        "project_usage", (user_id, project_id),
+        storage.fetch_user_project_current_usage_report, user_id=user_id, project_id=project_id)
     return user_current_usage
 
 @usage_router.get("/user/percentages")
@@ -59,7 +61,8 @@ async def fetch_user_usage_percentages(user_id: str = Depends(token_service.veri
 
     Returns None if the user has no usage yet.
     """
-    user_current_usage = storage.fetch_user_project_current_usage_report(user_id=user_id)
+    user_current_usage = await single_flight.run(
+        "user_usage", user_id, storage.fetch_user_project_current_usage_report, user_id=user_id)
     return user_current_usage
 
 
@@ -85,7 +88,8 @@ async def fetch_user_usage_status(
 
     Returns None if the user has no usage yet.
     """
-    user_current_usage = storage.fetch_user_project_current_usage_report(user_id=user_id)
+    user_current_usage = await single_flight.run(
+        "user_usage", user_id, storage.fetch_user_project_current_usage_report, user_id=user_id)
 
     if not user_current_usage:
         return None
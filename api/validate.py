@@ -1,62 +1,63 @@
-import traceback
 from typing import Dict, List, Any
-from fastapi import APIRouter, Body
-from ismcore.compiler.secure_runnable import SecurityConfig, SecureRunnableBuilder
+from fastapi import APIRouter, Body, Depends, HTTPException
+
+from api import token_service
+from environment import storage, execution_lanes, admission_controller
+from utils.admission import ADMISSION_REQUESTS
+from utils.executors import LANE_SANDBOX, LANE_EXPORT
+from utils.sandbox import run_python_validation, run_python_benchmark
 
 validate_router = APIRouter()
 
+# upper bound of the rows a state validation runs over, the rows are shipped to the sandbox worker in one call
+MAX_VALIDATION_SAMPLE_SIZE = 10000
+
 
 @validate_router.post('/python')
 async def validate_python_code(
     code_content: str = Body(..., embed=True, media_type="text/plain"),
     queries: List[Dict] = Body(None)
 ) -> Any:
+    # user code runs in a worker process of the sandbox lane, never on the event loop
+    return await execution_lanes.run(LANE_SANDBOX, run_python_validation, code_content, queries)
+
+
+def _fetch_sample_rows(state_id: str, sample_size: int) -> List[Dict]:
+    """The first sample_size rows of the state, pivoted from a single (column, index, value) query."""
+    rows: Dict[int, Dict] = {}
+    for column_name, data_index, data_value in storage.fetch_state_data_chunk_for_export(
+            state_id=state_id, offset=0, limit=sample_size) or []:
+        rows.setdefault(data_index, {})[column_name] = data_value
 
-    config = SecurityConfig(
-        max_memory_mb=100,
-        max_cpu_time_seconds=5,
-        max_requests=50,
-        execution_timeout=10,
-        enable_resource_limits=False
-    )
-
-    try:
-        # Create builder and compile the user code
-        builder = SecureRunnableBuilder(config)
-        runnable = builder.compile(code_content.lstrip())
-
-        # Run the user's code with queries
-        results = runnable.process(queries=queries)
-        return results
-
-    except SyntaxError as e:
-        # Capture syntax errors
-        return {
-            "error": "Syntax Error",
-            "message": str(e),
-            "traceback": traceback.format_exc()
-        }
-
-    except AttributeError as e:
-        # Capture attribute-related errors
-        return {
-            "error": "Attribute Error",
-            "message": str(e),
-            "traceback": traceback.format_exc()
-        }
-
-    except TypeError as e:
-        # Capture type errors, often from mismatched arguments
-        return {
-            "error": "Type Error",
-            "message": str(e),
-            "traceback": traceback.format_exc()
-        }
-
-    except Exception as e:
-        # General exception handler for unexpected errors
-        return {
-            "error": "Unexpected Error",
-            "message": str(e),
-            "traceback": traceback.format_exc()
-        }
\ No newline at end of file
+    return [rows[data_index] for data_index in sorted(rows)]
+
+
+@validate_router.post('/python/state/{state_id}')
+async def validate_python_code_with_state(
+    state_id: str,
+    code_content: str = Body(..., embed=True, media_type="text/plain"),
+    sample_size: int = Body(1000, embed=True, ge=1, le=MAX_VALIDATION_SAMPLE_SIZE),
+    batch_size: int = Body(100, embed=True, ge=1),
+    stream: bool = Body(False, embed=True),
+    result_limit: int = Body(100, embed=True, ge=0),
+    user_id: str = Depends(token_service.verify_jwt)
+) -> Any:
+    """
+    Run the user code over a sample of the state rows in batches, through process or (with stream)
+    process_stream, and report the results along with per batch (per row averaged) and total timings, throughput
+    and peak memory. Use batch_size 1 for the timings of individual rows.
+
+    The batches run within the timeout of the sandbox lane, batches that would not fit are skipped and reported
+    as such rather than failing the whole run.
+    """
+    state = storage.load_state_metadata(state_id=state_id)
+    if not state:
+        raise HTTPException(status_code=404, detail=f"State not found: {state_id}")
+
+    await admission_controller.admit(ADMISSION_REQUESTS, user_id=user_id, project_id=state.project_id)
+
+    # a bulk read of state data, the same as the exports
+    rows = await execution_lanes.run(LANE_EXPORT, _fetch_sample_rows, state_id, sample_size)
+    return await execution_lanes.run(
+        LANE_SANDBOX, run_python_benchmark, code_content, rows, batch_size, stream, result_limit,
+        execution_lanes[LANE_SANDBOX].timeout)
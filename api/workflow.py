@@ -1,12 +1,18 @@
 import uuid
-from typing import Optional
+from typing import Optional, List
 
-from fastapi import APIRouter, Depends
+import psycopg2
+from fastapi import APIRouter, Depends, HTTPException
 from ismcore.model.base_model import WorkflowNode, WorkflowEdge
 
 from api import token_service
-from environment import storage
-from models.models import WorkflowEdgeDelete
+from db.project_change_storage import edge_entity_id
+from environment import storage, workflow_batch_storage
+from models.models import (
+    WorkflowEdgeDelete, WorkflowBatchRequest, WorkflowBatchResult,
+    CreateNodeOperation, DeleteNodeOperation,
+    CreateEdgeOperation, CreateProcessorOperation, DeleteProcessorOperation,
+    CreateRouteOperation, DeleteRouteOperation)
 
 workflow_router = APIRouter()
 
@@ -38,3 +44,108 @@ async def delete_workflow_edge(edge: WorkflowEdgeDelete, user_id: str = Depends(
     storage.delete_workflow_edge(
         source_node_id=edge.source_node_id,
         target_node_id=edge.target_node_id)
+
+
+def _find_duplicates(values: list) -> set:
+    seen, duplicates = set(), set()
+    for value in values:
+        (duplicates if value in seen else seen).add(value)
+    return duplicates
+
+
+def validate_workflow_batch(batch: WorkflowBatchRequest) -> List[str]:
+    """
+    Validate the operations of a batch together, against each other and the current graph. Returns every
+    error found such that a client can fix a pasted or auto-layouted subgraph in one round trip.
+    """
+    operations = batch.operations
+    errors = []
+
+    def of_type(op_type):
+        return [op for op in operations if isinstance(op, op_type)]
+
+    # nodes and processors owned by the batch project, with an id assigned up front such that edges and
+    # routes in the same batch can reference them
+    for op in of_type(CreateNodeOperation):
+        op.node.node_id = op.node.node_id or str(uuid.uuid4())
+        op.node.project_id = batch.project_id
+
+    for op in of_type(CreateProcessorOperation):
+        op.processor.id = op.processor.id or str(uuid.uuid4())
+        op.processor.project_id = batch.project_id
+
+    created_nodes = {op.node.node_id for op in of_type(CreateNodeOperation)}
+    created_processors = {op.processor.id for op in of_type(CreateProcessorOperation)}
+    deleted_nodes = {op.node_id for op in of_type(DeleteNodeOperation)}
+    deleted_processors = {op.processor_id for op in of_type(DeleteProcessorOperation)}
+
+    for label, duplicates in (
+            ("node", _find_duplicates([op.node.node_id for op in of_type(CreateNodeOperation)])),
+            ("processor", _find_duplicates([op.processor.id for op in of_type(CreateProcessorOperation)])),
+            ("edge", _find_duplicates([edge_entity_id(op.edge.source_node_id, op.edge.target_node_id)
+                                       for op in of_type(CreateEdgeOperation)])),
+            ("route", _find_duplicates([f"{op.route.processor_id}:{op.route.state_id}:{op.route.direction.value}"
+                                        for op in of_type(CreateRouteOperation)]))):
+        errors += [f"{label} {entity_id} is created more than once" for entity_id in sorted(duplicates)]
+
+    for entity_id in sorted((created_nodes | created_processors) & (deleted_nodes | deleted_processors)):
+        errors.append(f"node {entity_id} is both created and deleted")
+
+    # every node referenced by an edge or route must exist after the batch is applied
+    edge_node_ids = {node_id for op in of_type(CreateEdgeOperation)
+                     for node_id in (op.edge.source_node_id, op.edge.target_node_id)}
+    route_processor_ids = {op.route.processor_id for op in of_type(CreateRouteOperation)}
+    route_state_ids = {op.route.state_id for op in of_type(CreateRouteOperation)}
+
+    # the batch may only change and reference the graph of its own project
+    project_id = batch.project_id
+    deleted_routes = {op.route_id for op in of_type(DeleteRouteOperation)}
+    for label, table, entity_ids in (
+            ("node", "workflow_node", created_nodes | deleted_nodes),
+            ("processor", "processor", created_processors | deleted_processors)):
+        for entity_id in sorted(workflow_batch_storage.fetch_foreign_ids(table, entity_ids, project_id)):
+            errors.append(f"{label} {entity_id} belongs to another project")
+
+    for route_id in sorted(workflow_batch_storage.fetch_foreign_route_ids(deleted_routes, project_id)):
+        errors.append(f"route {route_id} belongs to another project")
+
+    existing_nodes = workflow_batch_storage.fetch_existing_ids(
+        "workflow_node", edge_node_ids - created_nodes, project_id=project_id)
+    existing_processors = workflow_batch_storage.fetch_existing_ids(
+        "processor", route_processor_ids - created_processors, project_id=project_id)
+    existing_states = workflow_batch_storage.fetch_existing_ids("state", route_state_ids, project_id=project_id)
+
+    removed = deleted_nodes | deleted_processors
+    available_nodes = (created_nodes | created_processors | existing_nodes) - removed
+    available_processors = (created_processors | existing_processors) - removed
+    available_states = existing_states - removed
+
+    for op in of_type(CreateEdgeOperation):
+        for node_id in (op.edge.source_node_id, op.edge.target_node_id):
+            if node_id not in available_nodes:
+                errors.append(f"edge {edge_entity_id(op.edge.source_node_id, op.edge.target_node_id)} "
+                              f"references node {node_id} which does not exist in the project")
+
+    for op in of_type(CreateRouteOperation):
+        if op.route.processor_id not in available_processors:
+            errors.append(f"route references processor {op.route.processor_id} which does not exist in the project")
+        if op.route.state_id not in available_states:
+            errors.append(f"route references state {op.route.state_id} which does not exist in the project")
+
+    return errors
+
+
+@workflow_router.post("/batch")
+async def apply_workflow_batch(batch: WorkflowBatchRequest, user_id: str = Depends(token_service.verify_jwt)) \
+        -> WorkflowBatchResult:
+
+    errors = validate_workflow_batch(batch)
+    if errors:
+        raise HTTPException(status_code=400, detail=errors)
+
+    try:
+        return workflow_batch_storage.apply_batch(project_id=batch.project_id, operations=batch.operations)
+    except psycopg2.IntegrityError as e:
+        # a reference removed (or a duplicate created) concurrently, since the validation
+        raise HTTPException(status_code=400, detail=[f"workflow batch violates an integrity constraint: "
+                                                     f"{e.diag.message_primary or e}"])
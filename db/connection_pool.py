@@ -0,0 +1,180 @@
+import logging as log
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from ismdb.base import BaseDatabaseAccessSinglePool
+from psycopg2.extensions import connection as pg_connection
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+
+from utils.metrics import Metric, Histogram, register_collector
+
+logging = log.getLogger(__name__)
+
+# statement timeout (milliseconds) of the route group handling the current request, see statement_timeout_group
+statement_timeout_ms: ContextVar[Optional[int]] = ContextVar("statement_timeout_ms", default=None)
+
+
+class PooledConnection(pg_connection):
+    # statement timeout currently set on the (server side) session, None when never set
+    statement_timeout: Optional[int] = None
+
+
+class InstrumentedConnectionPool(ThreadedConnectionPool):
+    """
+    A thread safe connection pool that waits up to acquire_timeout for a connection to be released instead of
+    failing right away when exhausted, applies the statement timeout of the current route group to every
+    connection handed out and keeps wait, in use and idle metrics.
+
+    Up to minconn idle connections are kept open, connections above that (up to maxconn) are opened for bursts
+    and closed once released.
+
+    With transaction_pooling (PgBouncer in transaction mode) no session state is kept on server connections,
+    the statement timeout is applied with SET LOCAL and therefore lasts until the first commit or rollback.
+    """
+
+    def __init__(self,
+                 minconn: int,
+                 maxconn: int,
+                 *args,
+                 acquire_timeout: float = 10.0,
+                 transaction_pooling: bool = False,
+                 default_statement_timeout_ms: int = 0,
+                 name: str = "primary",
+                 **kwargs):
+        super().__init__(minconn, maxconn, *args, connection_factory=PooledConnection, **kwargs)
+        self.name = name
+        self.acquire_timeout = acquire_timeout
+        self.transaction_pooling = transaction_pooling
+        self.default_statement_timeout_ms = default_statement_timeout_ms
+        self.available = threading.Condition(self._lock)
+        self.wait_histogram = Histogram()
+        self.waiting = 0
+        self.timeouts = 0
+
+    def getconn(self, key=None):
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+
+        with self.available:
+            self.waiting += 1
+            try:
+                while True:
+                    try:
+                        conn = self._getconn(key)
+                        break
+                    except PoolError:
+                        if self.closed:
+                            raise
+
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise PoolError(f'timed out after {self.acquire_timeout}s waiting for a database '
+                                            f'connection, {len(self._used)} of {self.maxconn} in use')
+                        self.available.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+        self.wait_histogram.observe(time.monotonic() - started)
+
+        try:
+            self._apply_statement_timeout(conn)
+        except Exception as e:
+            logging.error(f'failed to apply statement timeout, discarding connection: {e}')
+            self.putconn(conn, close=True)
+            raise
+
+        return conn
+
+    def putconn(self, conn=None, key=None, close=False):
+        with self.available:
+            self._putconn(conn, key, close)
+            self.available.notify()
+
+    def _apply_statement_timeout(self, conn: PooledConnection):
+        timeout = statement_timeout_ms.get()
+        timeout = self.default_statement_timeout_ms if timeout is None else timeout
+
+        if self.transaction_pooling:
+            if timeout:
+                with conn.cursor() as cursor:
+                    cursor.execute("SET LOCAL statement_timeout = %s", [timeout])
+            return
+
+        if (conn.statement_timeout or 0) == timeout:
+            return
+
+        with conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = %s", [timeout])
+        conn.commit()
+        conn.statement_timeout = timeout
+
+    def collect_metrics(self):
+        with self.available:
+            in_use, idle, waiting = len(self._used), len(self._pool), self.waiting
+
+        labels = {"pool": self.name}
+        yield Metric("db_pool_connections_in_use", "gauge",
+                     "Connections currently checked out of the pool").add(in_use, labels)
+        yield Metric("db_pool_connections_idle", "gauge", "Open connections idle in the pool").add(idle, labels)
+        yield Metric("db_pool_connections_max", "gauge", "Maximum number of pool connections").add(self.maxconn, labels)
+        yield Metric("db_pool_waiting", "gauge", "Threads currently waiting for a connection").add(waiting, labels)
+        yield Metric("db_pool_acquire_timeouts_total", "counter",
+                     "Connection acquisitions that timed out").add(self.timeouts, labels)
+        yield self.wait_histogram.to_metric(
+            "db_pool_acquire_wait_seconds", "Time spent waiting for a connection", labels)
+
+
+# statement timeouts (milliseconds) by route group, configured by install_connection_pool
+_statement_timeouts: Dict[str, int] = {}
+
+
+def install_connection_pool(database_url: str,
+                            min_size: int,
+                            max_size: int,
+                            acquire_timeout: float,
+                            transaction_pooling: bool,
+                            default_statement_timeout_ms: int,
+                            statement_timeouts: Dict[str, int],
+                            name: str = "primary") -> InstrumentedConnectionPool:
+    """
+    Create the pool of the database url and register it as the shared pool of BaseDatabaseAccessSinglePool,
+    such that every storage class created afterwards for the same database url uses it.
+    """
+    connection_pool = InstrumentedConnectionPool(
+        min_size, max_size, database_url,
+        acquire_timeout=acquire_timeout,
+        transaction_pooling=transaction_pooling,
+        default_statement_timeout_ms=default_statement_timeout_ms,
+        name=name)
+
+    BaseDatabaseAccessSinglePool._pools[database_url] = connection_pool
+    _statement_timeouts.update(statement_timeouts)
+    register_collector(connection_pool.collect_metrics)
+
+    logging.info(f'established {name} connection pool with {min_size} to {max_size} connections, '
+                 f'transaction pooling: {transaction_pooling}')
+    return connection_pool
+
+
+def statement_timeout_group(group: str):
+    """Router dependency that applies the statement timeout configured for the group to the request."""
+
+    async def apply_statement_timeout():
+        timeout = _statement_timeouts.get(group)
+        if timeout is not None:
+            statement_timeout_ms.set(timeout)
+
+    return apply_statement_timeout
+
+
+def parse_statement_timeouts(value: Optional[str]) -> Dict[str, int]:
+    """Parse group=milliseconds pairs, e.g. "state=120000,dataset=600000"."""
+    timeouts = {}
+    for entry in (value or "").split(","):
+        if "=" in entry:
+            group, timeout = entry.split("=", 1)
+            timeouts[group.strip()] = int(timeout.strip())
+    return timeouts
@@ -0,0 +1,62 @@
+"""
+Manages the partial indexes of frequently filtered state columns, see StateQueryDatabaseStorage. Queries report
+the columns crossing STATE_QUERY_INDEX_THRESHOLD in the logs, an operator indexes those worth it:
+
+    python -m db.filter_indexes list
+    python -m db.filter_indexes create <column id> [<column id> ...]
+    python -m db.filter_indexes drop <column id> [<column id> ...]
+    python -m db.filter_indexes prune
+
+Indexes are built and dropped concurrently, without blocking writes, at most STATE_QUERY_MAX_INDEXES of them.
+Prune drops the indexes of columns that no longer exist (those of purged states are dropped along with them).
+"""
+import argparse
+import logging as log
+import os
+
+import dotenv
+
+from db.state_query_storage import StateQueryDatabaseStorage
+
+logging = log.getLogger(__name__)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m db.filter_indexes", description="state column filter indexes")
+    parser.add_argument("command", choices=["list", "create", "drop", "prune"])
+    parser.add_argument("column_ids", nargs="*", type=int)
+    args = parser.parse_args(argv)
+
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise ValueError(f'invalid database url, no DATABASE_URL env was specified')
+
+    storage = StateQueryDatabaseStorage(
+        database_url=database_url, max_indexes=int(os.environ.get("STATE_QUERY_MAX_INDEXES", 50)))
+
+    if args.command in ("create", "drop") and not args.column_ids:
+        parser.error(f"{args.command} requires the ids of the columns")
+
+    if args.command == "list":
+        for index in storage.fetch_filter_indexes():
+            status = "orphaned" if index.orphaned else "valid" if index.valid else "invalid"
+            print(f"{index.name}\tcolumn {index.column_id}\t{status}")
+    elif args.command == "create":
+        for column_id in args.column_ids:
+            column = storage.fetch_column(column_id)
+            if not column:
+                raise ValueError(f"no column {column_id}")
+            created = storage.create_filter_index(column)
+            logging.info(f'filter index of column {column_id} ({column.name}): '
+                         f'{"created" if created else "exists already"}')
+    elif args.command == "drop":
+        storage.drop_filter_indexes(args.column_ids)
+    else:
+        dropped = storage.drop_filter_indexes()
+        logging.info(f'dropped {len(dropped)} filter indexes of deleted columns')
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    log.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+    main()
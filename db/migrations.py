@@ -0,0 +1,90 @@
+"""
+Applies the sql migrations of the migrations directory, in name order, each once. Run it before rolling out a
+version that needs them (e.g. as a job or an init container), the api does not change the schema at runtime:
+
+    python -m db.migrations
+
+A migration runs in a transaction. Migrations starting with a `-- migrate: no-transaction` line (concurrent
+index builds) run statement by statement outside of one, their statements must be separated by a `;` at the
+end of a line and must be safe to repeat, such that an interrupted migration can be run again.
+"""
+import logging as log
+import os
+import re
+from typing import List
+
+import dotenv
+import psycopg2
+
+logging = log.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+# serializes the runners of concurrently starting deployments
+MIGRATION_LOCK_KEY = "ism_schema_migration"
+
+
+def _statements(sql: str) -> List[str]:
+    statements = [statement.strip() for statement in re.split(r';\s*$', sql, flags=re.MULTILINE)]
+    return [statement for statement in statements
+            if any(line.strip() and not line.strip().startswith("--") for line in statement.splitlines())]
+
+
+def pending_migrations(applied: List[str], directory: str = MIGRATIONS_DIR) -> List[str]:
+    return sorted(name for name in os.listdir(directory) if name.endswith(".sql") and name not in applied)
+
+
+def apply_migrations(database_url: str, directory: str = MIGRATIONS_DIR) -> List[str]:
+    """Apply the migrations not applied yet, returns their names."""
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    applied_now = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = 0")
+            cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", [MIGRATION_LOCK_KEY])
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migration (
+                    name VARCHAR(255) PRIMARY KEY,
+                    applied_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )""")
+            cursor.execute("SELECT name FROM schema_migration")
+            applied = [row[0] for row in cursor.fetchall()]
+
+            for name in pending_migrations(applied, directory=directory):
+                with open(os.path.join(directory, name)) as file:
+                    sql = file.read()
+
+                logging.info(f'applying migration {name}')
+                if sql.lstrip().startswith(NO_TRANSACTION_MARKER):
+                    for statement in _statements(sql):
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_migration (name) VALUES (%s)", [name])
+                else:
+                    cursor.execute("BEGIN")
+                    try:
+                        cursor.execute(sql)
+                        cursor.execute("INSERT INTO schema_migration (name) VALUES (%s)", [name])
+                        cursor.execute("COMMIT")
+                    except Exception:
+                        cursor.execute("ROLLBACK")
+                        raise
+                applied_now.append(name)
+
+            cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", [MIGRATION_LOCK_KEY])
+        return applied_now
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    log.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise ValueError(f'invalid database url, no DATABASE_URL env was specified')
+
+    migrations = apply_migrations(database_url)
+    logging.info(f'applied {len(migrations)} migrations: {", ".join(migrations) or "none pending"}')
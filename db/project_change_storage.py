@@ -0,0 +1,71 @@
+import logging as log
+from typing import List
+
+from ismdb.base import BaseDatabaseAccessSinglePool
+from pydantic import BaseModel
+
+logging = log.getLogger(__name__)
+
+ENTITY_NODE = "node"
+ENTITY_EDGE = "edge"
+ENTITY_PROCESSOR = "processor"
+ENTITY_STATE = "state"
+ENTITY_ROUTE = "route"
+
+OPERATION_UPSERT = "upsert"
+OPERATION_DELETE = "delete"
+
+
+class ProjectChange(BaseModel):
+    entity_type: str
+    entity_id: str
+    operation: str
+    version: int
+    existed: bool  # whether the entity was already known at the requested since version
+
+
+def edge_entity_id(source_node_id: str, target_node_id: str) -> str:
+    return f"{source_node_id}:{target_node_id}"
+
+
+class ProjectChangeDatabaseStorage(BaseDatabaseAccessSinglePool):
+    """
+    Append only log of changes to the workflow graph of a project (nodes, edges, processors, states and routes).
+
+    Changes are recorded by triggers (see migrations/0001_project_change_log.sql) in the transaction of the write,
+    versioned by a counter per project that is locked until the write commits, such that versions become visible
+    in order and clients polling for changes since the last version seen never skip one.
+    """
+
+    def fetch_version(self, cursor, project_id: str) -> int:
+        """The current version of the project on the cursor, including the changes of its open transaction."""
+        cursor.execute("SELECT version FROM project_change_version WHERE project_id = %s", [project_id])
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def fetch_current_version(self, project_id: str) -> int:
+        rows = self.execute_query_fixed(
+            sql="SELECT version FROM project_change_version WHERE project_id = %s",
+            params=[project_id],
+            mapper=lambda row: row['version'])
+        return rows[0] if rows else 0
+
+    def fetch_changes_since(self, project_id: str, since: int) -> List[ProjectChange]:
+        """
+        Return the latest change of each entity changed after the since version. Entities of the baseline (version
+        0, those that existed before the log) or changed before the since version are reported as existing.
+        """
+        return self.execute_query_fixed(
+            sql="""
+                SELECT DISTINCT ON (c.entity_type, c.entity_id)
+                       c.entity_type, c.entity_id, c.operation, c.version,
+                       EXISTS (SELECT 1 FROM project_change_log p
+                                WHERE p.project_id = c.project_id
+                                  AND p.entity_type = c.entity_type
+                                  AND p.entity_id = c.entity_id
+                                  AND p.version <= %s) AS existed
+                  FROM project_change_log c
+                 WHERE c.project_id = %s AND c.version > %s
+                 ORDER BY c.entity_type, c.entity_id, c.version DESC""",
+            params=[since, project_id, since],
+            mapper=lambda row: ProjectChange(**row)) or []
@@ -0,0 +1,169 @@
+import asyncio
+import logging as log
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from ismdb.base import BaseDatabaseAccessSinglePool
+from psycopg2 import OperationalError, InterfaceError
+from psycopg2.pool import PoolError
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Receive, Scope, Send, Message
+
+logging = log.getLogger(__name__)
+
+# the client echoes the token of its last write, reads are served by the replica only once it has replayed it
+CONSISTENCY_TOKEN_HEADER = "X-Consistency-Token"
+
+# storage methods that only read, and can therefore be served by the replica
+READ_METHOD_PREFIXES = ("fetch_", "load_")
+
+# read only endpoints that use POST
+READ_ONLY_POST_PATHS = (
+    re.compile(r"/monitor/(project|state|route)/[^/]+$"),
+)
+
+# set for read only requests, see ReadReplicaMiddleware
+read_only_request: ContextVar[bool] = ContextVar("read_only_request", default=False)
+
+# minimum WAL position the replica must have replayed to serve the current request
+consistency_lsn: ContextVar[Optional[int]] = ContextVar("consistency_lsn", default=None)
+
+
+def parse_lsn(value: Optional[str]) -> Optional[int]:
+    """Parse a postgres WAL position (e.g. 16/B374D848) into a comparable integer."""
+    try:
+        high, low = value.strip().split("/")
+        return (int(high, 16) << 32) + int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+class WalPositionDatabaseStorage(BaseDatabaseAccessSinglePool):
+
+    def fetch_current_lsn(self) -> Optional[str]:
+        rows = self.execute_query_fixed(
+            sql="SELECT pg_current_wal_lsn()::text AS lsn", params=[], mapper=lambda row: row['lsn'])
+        return rows[0] if rows else None
+
+    def fetch_replay_lsn(self) -> Optional[str]:
+        rows = self.execute_query_fixed(
+            sql="SELECT pg_last_wal_replay_lsn()::text AS lsn", params=[], mapper=lambda row: row['lsn'])
+        return rows[0] if rows else None
+
+
+class ReadReplicaRoutingStorage:
+    """
+    Wraps the primary storage and serves fetch_* and load_* calls from the replica storage while a read only
+    request is handled. Everything else, and reads the replica cannot serve (not caught up with the consistency
+    token of the client, or unavailable), goes to the primary.
+    """
+
+    def __init__(self,
+                 primary,
+                 replica,
+                 primary_wal: WalPositionDatabaseStorage,
+                 replica_wal: WalPositionDatabaseStorage,
+                 replay_check_interval: float = 0.2):
+        self.primary = primary
+        self.replica = replica
+        self.primary_wal = primary_wal
+        self.replica_wal = replica_wal
+        self.replay_check_interval = replay_check_interval
+        self._replay_lsn = None
+        self._replay_checked = 0.0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        primary_attribute = getattr(self.primary, name)
+        if not name.startswith(READ_METHOD_PREFIXES) or not callable(primary_attribute):
+            return primary_attribute
+
+        def routed(*args, **kwargs):
+            if not self.use_replica():
+                return primary_attribute(*args, **kwargs)
+
+            try:
+                return getattr(self.replica, name)(*args, **kwargs)
+            except (OperationalError, InterfaceError, PoolError) as e:
+                logging.warning(f'replica unavailable for {name}, falling back to the primary: {e}')
+                return primary_attribute(*args, **kwargs)
+
+        return routed
+
+    def use_replica(self) -> bool:
+        if not read_only_request.get():
+            return False
+
+        required = consistency_lsn.get()
+        if required is None:
+            return True
+
+        replayed = self.fetch_replay_lsn()
+        return replayed is not None and replayed >= required
+
+    def fetch_replay_lsn(self) -> Optional[int]:
+        """The WAL position replayed by the replica, checked at most once per replay check interval."""
+        with self._lock:
+            if time.monotonic() - self._replay_checked < self.replay_check_interval:
+                return self._replay_lsn
+
+            try:
+                self._replay_lsn = parse_lsn(self.replica_wal.fetch_replay_lsn())
+            except Exception as e:
+                logging.warning(f'unable to fetch the replica replay position: {e}')
+                self._replay_lsn = None
+
+            self._replay_checked = time.monotonic()
+            return self._replay_lsn
+
+    def fetch_current_lsn(self) -> Optional[str]:
+        return self.primary_wal.fetch_current_lsn()
+
+
+class ReadReplicaMiddleware:
+    """
+    Marks GET (and known read only POST) requests as read only such that their storage reads go to the replica.
+    Successful writes return the current primary WAL position as a consistency token; a client that sends it
+    back reads from the primary until the replica has replayed that position (read your writes).
+    """
+
+    def __init__(self, app: ASGIApp, routing_storage: ReadReplicaRoutingStorage):
+        self.app = app
+        self.routing_storage = routing_storage
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        if method in ("GET", "HEAD") or (
+                method == "POST" and any(path.search(scope["path"]) for path in READ_ONLY_POST_PATHS)):
+            read_only_token = read_only_request.set(True)
+            lsn_token = consistency_lsn.set(parse_lsn(Headers(scope=scope).get(CONSISTENCY_TOKEN_HEADER)))
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                consistency_lsn.reset(lsn_token)
+                read_only_request.reset(read_only_token)
+            return
+
+        async def send_with_token(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                try:
+                    lsn = await asyncio.to_thread(self.routing_storage.fetch_current_lsn)
+                    if lsn:
+                        MutableHeaders(scope=message)[CONSISTENCY_TOKEN_HEADER] = lsn
+                except Exception as e:
+                    logging.warning(f'unable to fetch the primary WAL position: {e}')
+            await send(message)
+
+        await self.app(scope, receive, send_with_token)
+
+
+async def use_primary():
+    """Endpoint dependency for reads that must be served by the primary, e.g. ones paired with the change log."""
+    read_only_request.set(False)
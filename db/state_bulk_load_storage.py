@@ -0,0 +1,193 @@
+import io
+import json
+import logging as log
+from typing import Any, Dict, List, Optional, Set
+
+from ismcore.model.processor_state import State
+from ismdb.base import BaseDatabaseAccessSinglePool
+
+logging = log.getLogger(__name__)
+
+
+def _copy_csv_line(values: List[Any]) -> str:
+    """A COPY csv line, strings are always quoted and None never is, such that COPY tells empty strings from NULL."""
+    return ",".join(
+        "" if value is None
+        else str(value) if isinstance(value, int)
+        else '"' + str(value).replace('"', '""') + '"'
+        for value in values) + "\n"
+
+
+class StateBulkLoad:
+    """
+    A bulk load of rows into the data tables of a state, committed a block at a time.
+
+    Rows are transformed the same as the message path does (callable columns, state keys), then written with
+    COPY. Each block runs in its own short transaction, which does three things:
+    - reserves the block's data indexes by advancing the state count
+    - creates the columns first seen in the block
+    - copies the data and key mappings
+
+    The state row is locked only for that block transaction, not for the whole load. Other writers of the state
+    (count updates, deletion progress, merges) wait one block at most. A failed block leaves nothing behind, and
+    the blocks committed before it stay loaded: the state count is the persisted position of the load.
+
+    Concurrent writers: the reservation starts past both the state count and the highest data index already
+    written. Rows that message path writers have inserted but not yet counted are therefore kept, never
+    overwritten or deleted. They become counted along with the block. Loads of the same state interleave block
+    by block. A message path writer that later sets the count from its own view of the state can still lower
+    it below the loaded rows, so a state should not be fed by both paths at the same time.
+    """
+
+    def __init__(self, storage: 'StateBulkLoadDatabaseStorage', state: State):
+        self.storage = storage
+        self.state = state
+        self.rows = 0
+        self.start_position: Optional[int] = None  # data index of the first row of the load
+
+    def _insert_new_columns(self, cursor) -> List:
+        """Create the columns first seen in the block, in the block transaction, returns the created columns."""
+        created = []
+        for column in self.state.columns.values():
+            if column.id is not None:
+                continue
+
+            cursor.execute("""
+                INSERT INTO state_column (
+                    state_id, name, data_type, required, callable, min_length, max_length,
+                    dimensions, value, source_column_name, display_order)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id""", [
+                self.state.id, column.name, column.data_type, column.required, column.callable,
+                column.min_length, column.max_length, column.dimensions, column.value,
+                column.source_column_name, column.display_order])
+            column.id = cursor.fetchone()[0]
+            created.append(column)
+        return created
+
+    def _reserve(self, cursor, rows: int) -> int:
+        """Advance the state count by the rows of the block, returns the data index of the first row."""
+        cursor.execute("""
+            WITH written AS (
+                SELECT COALESCE(MAX(d.data_index) + 1, 0) AS next_index
+                  FROM state_column c
+                  JOIN LATERAL (SELECT data_index FROM state_column_data
+                                 WHERE column_id = c.id ORDER BY data_index DESC LIMIT 1) d ON TRUE
+                 WHERE c.state_id = %s)
+            UPDATE state s
+               SET count = GREATEST(COALESCE(s.count, 0), written.next_index) + %s
+              FROM written
+             WHERE s.id = %s
+         RETURNING s.count - %s""", [self.state.id, rows, self.state.id, rows])
+        row = cursor.fetchone()
+        if not row:
+            raise KeyError(f"unable to locate state id {self.state.id}")
+        return row[0]
+
+    def write(self, query_states: List[Dict[str, Any]]) -> int:
+        """Transform, COPY and commit a block of rows, returns the number of rows written."""
+        if not query_states:
+            return 0
+
+        query_states = [
+            self.state.apply_query_state(query_state=entry, skip_data_append=True, scope_variable_mappings={})
+            for entry in query_states
+        ]
+
+        conn = self.storage.create_connection()
+        created = []
+        try:
+            with conn.cursor() as cursor:
+                # the version row of the state is locked before the state row, in the order of every other write of
+                # the data (whose version trigger fires before the state count is updated), see
+                # migrations/0002_state_data_version.sql, both locks are held to the commit, keep the block short
+                cursor.execute("SELECT bump_state_data_version(ARRAY[%s]::VARCHAR[])", [self.state.id])
+                start_position = self._reserve(cursor, len(query_states))
+                created = self._insert_new_columns(cursor)
+
+                data = io.StringIO()
+                mappings = io.StringIO()
+
+                columns = [(column.id, column.data_type == 'json', name) for name, column in self.state.columns.items()]
+                for row_offset, query_state in enumerate(query_states):
+                    data_index = start_position + row_offset
+                    for column_id, is_json, name in columns:
+                        value = query_state.get(name)
+                        if value is None:
+                            continue
+
+                        if is_json:
+                            data.write(_copy_csv_line([column_id, data_index, None, json.dumps(value, default=str)]))
+                        else:
+                            data.write(_copy_csv_line([column_id, data_index, value, None]))
+
+                    state_key = query_state.get('state_key')
+                    if state_key:
+                        mappings.write(_copy_csv_line([self.state.id, state_key, data_index]))
+
+                data.seek(0)
+                cursor.copy_expert(
+                    "COPY state_column_data (column_id, data_index, data_value, data_json_value) "
+                    "FROM STDIN WITH (FORMAT csv)", data)
+
+                if mappings.tell():
+                    mappings.seek(0)
+                    cursor.copy_expert(
+                        "COPY state_column_data_mapping (state_id, state_key, data_index) "
+                        "FROM STDIN WITH (FORMAT csv)", mappings)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            # the columns were not created after all, a later block creates them again
+            for column in created:
+                column.id = None
+            logging.error(f'bulk load of state {self.state.id} failed after {self.rows} rows were loaded')
+            raise
+        finally:
+            self.storage.release_connection(conn)
+
+        if self.start_position is None:
+            self.start_position = start_position
+        self.rows += len(query_states)
+        self.state.count = start_position + len(query_states)
+        return len(query_states)
+
+    def commit(self) -> State:
+        """The state as loaded, every block is committed as it is written."""
+        if self.rows:
+            self.state.persisted_position = self.state.count - 1
+        logging.info(f'bulk loaded {self.rows} rows into state {self.state.id}, count: {self.state.count}')
+        return self.state
+
+    def rollback(self):
+        """Nothing to undo, a failed block rolled back itself, the blocks before it remain loaded."""
+        if self.rows:
+            logging.warning(f'bulk load of state {self.state.id} stopped, {self.rows} rows remain loaded')
+
+
+class StateBulkLoadDatabaseStorage(BaseDatabaseAccessSinglePool):
+    """Direct COPY loads of state data, for data that needs no processing on its way in, and ingest key lookups."""
+
+    def __init__(self, database_url, state_storage, incremental: bool = False):
+        super().__init__(database_url=database_url, incremental=incremental)
+        self.state_storage = state_storage
+
+    def fetch_existing_state_keys(self, state_id: str, state_keys: List[str]) -> Set[str]:
+        """The subset of the state keys that already map to data of the state, in a single query."""
+        if not state_keys:
+            return set()
+
+        rows = self.execute_query_fixed(
+            sql="SELECT DISTINCT state_key FROM state_column_data_mapping WHERE state_id = %s AND state_key = ANY(%s)",
+            params=[state_id, list(state_keys)],
+            mapper=lambda row: row['state_key'])
+
+        return set(rows or [])
+
+    def begin_load(self, state_id: str) -> Optional[StateBulkLoad]:
+        state = self.state_storage.load_state_metadata(state_id=state_id)
+        if not state:
+            return None
+
+        return StateBulkLoad(storage=self, state=state)
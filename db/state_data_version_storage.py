@@ -0,0 +1,34 @@
+import logging as log
+
+from ismdb.base import BaseDatabaseAccessSinglePool
+
+logging = log.getLogger(__name__)
+
+
+class StateDataVersionDatabaseStorage(BaseDatabaseAccessSinglePool):
+    """
+    The data version of states, bumped by triggers (see migrations/0002_state_data_version.sql) in the transaction
+    of every write of the data or columns of a state, such that anything derived from the data of a version stays
+    valid until a write commits, on every host.
+    """
+
+    def fetch_version(self, state_id: str) -> int:
+        rows = self.execute_query_fixed(
+            sql="SELECT version FROM state_data_version WHERE state_id = %s",
+            params=[state_id],
+            mapper=lambda row: row['version'])
+        return rows[0] if rows else 0
+
+    def bump_version(self, state_id: str) -> None:
+        """A new version of the state without a write of its data, e.g. once a deletion of it starts."""
+        conn = self.create_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT bump_state_data_version(ARRAY[%s]::VARCHAR[])", [state_id])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(e)
+            raise e
+        finally:
+            self.release_connection(conn)
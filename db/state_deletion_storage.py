@@ -0,0 +1,218 @@
+import datetime as dt
+import logging as log
+from typing import Optional, List, Set, Tuple
+
+from ismdb.base import BaseDatabaseAccessSinglePool
+from pydantic import BaseModel
+
+logging = log.getLogger(__name__)
+
+DELETION_STATUS_PENDING = "PENDING"
+DELETION_STATUS_RUNNING = "RUNNING"
+DELETION_STATUS_COMPLETED = "COMPLETED"
+DELETION_STATUS_FAILED = "FAILED"
+
+
+class StateDeletionProgress(BaseModel):
+    state_id: str
+    status: str = DELETION_STATUS_PENDING
+    purge: bool = False  # whether the state itself is removed once its data is gone
+    total: int = 0  # number of data index positions to delete
+    deleted: int = 0  # number of data index positions deleted so far
+    started_date: Optional[dt.datetime] = None
+    finished_date: Optional[dt.datetime] = None
+    error: Optional[str] = None
+    owner: Optional[str] = None  # the worker running the deletion, which holds it while its heartbeat is recent
+    heartbeat: Optional[float] = None  # database time (epoch seconds) of the last progress update of the owner
+
+
+# the columns of state_deletion, selected as the fields of the progress
+PROGRESS_FIELDS = list(StateDeletionProgress.model_fields)
+PROGRESS_SQL = ", ".join(field if field != "heartbeat" else "extract(epoch FROM heartbeat)::float AS heartbeat"
+                         for field in PROGRESS_FIELDS)
+
+
+class StateDeletionDatabaseStorage(BaseDatabaseAccessSinglePool):
+    """
+    Deletes state data in small data_index ranges, each range in its own short transaction, such that row locks
+    are held briefly and WAL is written gradually instead of in one multi-million row statement.
+
+    While a deletion is in progress the state is tombstoned by its row of state_deletion (see
+    migrations/0005_state_deletion.sql), which is also what allows an interrupted deletion to be resumed, and which
+    saves of the state do not write. A deletion is run by the one worker that claimed it, the claim is a conditional
+    update of the tombstone (PENDING, or RUNNING without a heartbeat within the lease), taken under the row lock
+    such that workers and pods racing for it cannot both win.
+    """
+
+    def _execute(self, sql: str, params: list, fetch: bool = False):
+        conn = self.create_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall() if fetch else cursor.rowcount
+            conn.commit()
+            return rows
+        except Exception as e:
+            conn.rollback()
+            logging.error(e)
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def _fetch_progress(self, sql: str, params: list) -> List[StateDeletionProgress]:
+        return [StateDeletionProgress(**dict(zip(PROGRESS_FIELDS, row)))
+                for row in self._execute(sql=sql, params=params, fetch=True) or []]
+
+    def begin_deletion(self, progress: StateDeletionProgress) -> Optional[StateDeletionProgress]:
+        """
+        Tombstone the state with the (pending) progress, unless a deletion of it is already pending or running,
+        in which case that deletion is returned, purging if either of them does. None if the state does not exist.
+        """
+        conn = self.create_connection()
+        try:
+            with conn.cursor() as cursor:
+                # a deletion in progress is joined
+                cursor.execute(f"""
+                    INSERT INTO state_deletion AS d (state_id, status, purge, started_date)
+                    SELECT s.id, %s, %s, %s FROM state s WHERE s.id = %s
+                        ON CONFLICT (state_id) DO UPDATE SET purge = d.purge OR EXCLUDED.purge
+                     WHERE d.status IN (%s, %s)
+                 RETURNING {PROGRESS_SQL}""",
+                    [DELETION_STATUS_PENDING, progress.purge, progress.started_date, progress.state_id,
+                     DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING])
+                row = cursor.fetchone()
+
+                # a finished one is replaced
+                if not row:
+                    cursor.execute(f"""
+                        UPDATE state_deletion
+                           SET status = %s, purge = %s, total = 0, deleted = 0, started_date = %s,
+                               finished_date = NULL, error = NULL, owner = NULL, heartbeat = NULL
+                         WHERE state_id = %s AND status NOT IN (%s, %s)
+                     RETURNING {PROGRESS_SQL}""",
+                        [DELETION_STATUS_PENDING, progress.purge, progress.started_date, progress.state_id,
+                         DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING])
+                    row = cursor.fetchone()
+
+                # unless a concurrent request replaced it first
+                if not row:
+                    cursor.execute(f"SELECT {PROGRESS_SQL} FROM state_deletion WHERE state_id = %s",
+                                   [progress.state_id])
+                    row = cursor.fetchone()
+            conn.commit()
+            return StateDeletionProgress(**dict(zip(PROGRESS_FIELDS, row))) if row else None
+        except Exception as e:
+            conn.rollback()
+            logging.error(e)
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def claim_deletion(self, state_id: str, owner: str, lease_seconds: float) -> Optional[StateDeletionProgress]:
+        """
+        Claim the pending (or abandoned running) deletion of the state for the owner, returns the claimed
+        progress, None if there is nothing to claim or another worker holds it.
+        """
+        claimed = self._fetch_progress(
+            sql=f"""UPDATE state_deletion
+                       SET status = %s, owner = %s, heartbeat = now()
+                     WHERE state_id = %s
+                       AND (status = %s
+                            OR (status = %s AND COALESCE(heartbeat, '-infinity') < now() - make_interval(secs => %s)))
+                 RETURNING {PROGRESS_SQL}""",
+            params=[DELETION_STATUS_RUNNING, owner, state_id,
+                    DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING, lease_seconds])
+        return claimed[0] if claimed else None
+
+    def update_deletion_progress(self, progress: StateDeletionProgress) -> Optional[StateDeletionProgress]:
+        """
+        Store the deletion progress, renewing the heartbeat of its owner, a purge requested meanwhile (by another
+        worker) is kept. Returns the stored progress, None if there is no deletion of the state (any longer) or it
+        is no longer held by the owner of the progress.
+        """
+        stored = self._fetch_progress(
+            sql=f"""UPDATE state_deletion
+                       SET status = %s, total = %s, deleted = %s, started_date = %s, finished_date = %s, error = %s,
+                           heartbeat = now(), purge = purge OR %s
+                     WHERE state_id = %s AND owner IS NOT DISTINCT FROM %s
+                 RETURNING {PROGRESS_SQL}""",
+            params=[progress.status, progress.total, progress.deleted, progress.started_date,
+                    progress.finished_date, progress.error, progress.purge,
+                    progress.state_id, progress.owner])
+        return stored[0] if stored else None
+
+    def clear_deletion_progress(self, state_id: str, owner: Optional[str] = None) -> None:
+        """Remove the tombstone of the (data) deletion held by the owner, the state has no data left."""
+        self._execute(
+            sql="""WITH cleared AS (
+                       DELETE FROM state_deletion WHERE state_id = %s AND owner IS NOT DISTINCT FROM %s
+                    RETURNING state_id)
+                   UPDATE state SET count = 0 WHERE id IN (SELECT state_id FROM cleared)""",
+            params=[state_id, owner])
+
+    def delete_deletion_progress(self, state_id: str) -> None:
+        """Remove the tombstone and the data version of a purged state (once its columns are gone)."""
+        self._execute(sql="""
+            WITH version AS (DELETE FROM state_data_version WHERE state_id = %s)
+            DELETE FROM state_deletion WHERE state_id = %s""", params=[state_id, state_id])
+
+    def fetch_deletion_progress(self, state_id: str) -> Optional[StateDeletionProgress]:
+        progress = self._fetch_progress(
+            sql=f"SELECT {PROGRESS_SQL} FROM state_deletion WHERE state_id = %s", params=[state_id])
+        return progress[0] if progress else None
+
+    def fetch_pending_deletions(self) -> List[StateDeletionProgress]:
+        return self._fetch_progress(
+            sql=f"SELECT {PROGRESS_SQL} FROM state_deletion WHERE status IN (%s, %s)",
+            params=[DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING])
+
+    def fetch_purging_state_ids(self, state_ids: List[str]) -> Set[str]:
+        """The states of the ids which are being purged."""
+        rows = self._execute(
+            sql="SELECT state_id FROM state_deletion WHERE state_id = ANY(%s) AND purge AND status IN (%s, %s)",
+            params=[state_ids, DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING],
+            fetch=True)
+        return {row[0] for row in rows or []}
+
+    def fetch_column_ids(self, state_id: str) -> List[int]:
+        rows = self._execute(sql="SELECT id FROM state_column WHERE state_id = %s", params=[state_id], fetch=True)
+        return [row[0] for row in rows or []]
+
+    def fetch_data_index_bounds(self, state_id: str, column_ids: List[int]) -> Optional[Tuple[int, int]]:
+        """The lowest and highest data index still present in the state data or its key mapping."""
+        rows = self._execute(
+            sql="""SELECT MIN(data_index), MAX(data_index) FROM (
+                       SELECT MIN(data_index) AS data_index FROM state_column_data WHERE column_id = ANY(%s)
+                        UNION ALL
+                       SELECT MAX(data_index) FROM state_column_data WHERE column_id = ANY(%s)
+                        UNION ALL
+                       SELECT MIN(data_index) FROM state_column_data_mapping WHERE state_id = %s
+                        UNION ALL
+                       SELECT MAX(data_index) FROM state_column_data_mapping WHERE state_id = %s
+                   ) bounds""",
+            params=[column_ids, column_ids, state_id, state_id],
+            fetch=True)
+        if not rows or rows[0][0] is None:
+            return None
+        return rows[0][0], rows[0][1]
+
+    def delete_data_index_range(self, state_id: str, column_ids: List[int], start: int, end: int) -> int:
+        """Delete the data and key mappings of the state with a data index in [start, end), in one short transaction."""
+        conn = self.create_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM state_column_data WHERE column_id = ANY(%s) AND data_index >= %s AND data_index < %s",
+                    [column_ids, start, end])
+                deleted = cursor.rowcount
+                cursor.execute(
+                    "DELETE FROM state_column_data_mapping WHERE state_id = %s AND data_index >= %s AND data_index < %s",
+                    [state_id, start, end])
+            conn.commit()
+            return deleted
+        except Exception as e:
+            conn.rollback()
+            logging.error(e)
+            raise e
+        finally:
+            self.release_connection(conn)
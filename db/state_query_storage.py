@@ -0,0 +1,526 @@
+import base64
+import json
+import logging as log
+import re
+import threading
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from ismcore.model.filter import Filter, FilterItem, FilterOperator
+from ismdb.base import BaseDatabaseAccessSinglePool
+from pydantic import BaseModel
+
+logging = log.getLogger(__name__)
+
+NUMERIC_DATA_TYPES = ("int", "float")
+
+# the same numeric strings the filter model compares as numbers (int and float accept surrounding whitespace),
+# values that are not compare as NULL
+NUMERIC_PATTERN = r'^\s*[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)\s*$'
+
+# text orders as the filter model compares strings (by code point), numeric strings are not ordered against text
+TEXT_ORDER_GUARD = f"{{t}} !~ '{NUMERIC_PATTERN}'"
+
+# operators evaluated as the absence of a matching value, such that rows without the column pass them
+NEGATED_OPERATORS = {
+    FilterOperator.NE: FilterOperator.EQ,
+    FilterOperator.NOT_IN: FilterOperator.IN,
+    FilterOperator.NOT_CONTAINS: FilterOperator.CONTAINS,
+    FilterOperator.NOT_EXISTS: FilterOperator.EXISTS,
+    FilterOperator.IS_NULL: FilterOperator.EXISTS,
+}
+
+FILTER_INDEX_PREFIX = "state_column_data_filter_"
+
+# operators a partial index of the column can serve, text columns get a hash index (equality of values of any
+# length, EQ and IN) and numeric columns a btree index of their numeric value
+INDEXED_NUMERIC_OPERATORS = (FilterOperator.EQ, FilterOperator.GT, FilterOperator.GTE, FilterOperator.LT,
+                             FilterOperator.LTE, FilterOperator.BETWEEN)
+
+
+class StateColumnRef(BaseModel):
+    id: int
+    name: str
+    data_type: Optional[str] = None
+
+    @property
+    def is_json(self) -> bool:
+        return self.data_type == "json"
+
+    @property
+    def is_numeric(self) -> bool:
+        return self.data_type in NUMERIC_DATA_TYPES
+
+
+class StateDataPage(BaseModel):
+    columns: List[str]
+    rows: List[Dict[str, Any]]
+    indexes: List[int]  # the data index of each row
+    next_cursor: Optional[str] = None
+
+
+def _numeric_sql(expression: str, json_expression: Optional[str] = None) -> str:
+    # json booleans compare as the numbers 1 and 0, as bool values do in python
+    json_bool = f"WHEN jsonb_typeof({json_expression}) = 'boolean' THEN ({expression} = 'true')::int::numeric " \
+        if json_expression else ""
+    return f"(CASE {json_bool}WHEN {expression} ~ '{NUMERIC_PATTERN}' THEN ({expression})::numeric END)"
+
+
+def _numeric_value(value: Any) -> Optional[Decimal]:
+    if isinstance(value, bool):
+        return Decimal(int(value))
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, str) and re.match(NUMERIC_PATTERN, value):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            return None
+    return None
+
+
+def _like_pattern(value: str, prefix: str = "%", suffix: str = "%") -> str:
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{prefix}{escaped}{suffix}"
+
+
+def encode_cursor(sort_value: Any, data_index: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_value, data_index], default=str).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    try:
+        sort_value, data_index = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return sort_value, int(data_index)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor {cursor}") from e
+
+
+class FilterCompiler:
+    """
+    Compiles the items of a Filter into SQL predicates over the data index of the state rows, with the same
+    semantics as Filter.apply_filter_on_data: numeric strings compare as numbers, text orders by code point and
+    not against numeric strings, rows without a value fail every operator except the negated ones (NE, NOT_IN,
+    NOT_CONTAINS, NOT_EXISTS and IS_NULL), which are compiled as the absence of a matching value. Keys of json
+    columns may address nested values with dot notation.
+    """
+
+    def __init__(self, columns: Dict[str, StateColumnRef], row_alias: str = "r"):
+        self.columns = columns
+        self.row_alias = row_alias
+
+    def _value_sql(self, column: StateColumnRef, path: List[str]) -> Tuple[str, str, list]:
+        """The text and jsonb expressions of the value (json path params are inlined once per use)."""
+        if column.is_json:
+            return "(f.data_json_value #>> %s::text[])", "(f.data_json_value #> %s::text[])", [path]
+        return "f.data_value", "NULL::jsonb", []
+
+    def condition(self, item: FilterItem, column: StateColumnRef, path: List[str],
+                  operator: FilterOperator) -> Tuple[str, list]:
+        """The condition on the value row f of the column, for a non negated operator."""
+        text, json_value, path_params = self._value_sql(column, path)
+        value = item.value
+
+        def text_sql(sql: str, *params) -> Tuple[str, list]:
+            return sql.replace("{t}", text).replace("{j}", json_value), \
+                path_params * (sql.count("{t}") + sql.count("{j}")) + list(params)
+
+        # json strings only, numbers, booleans and objects would otherwise match their json text
+        string_guard = "jsonb_typeof({j}) = 'string' AND " if column.is_json else ""
+        numeric_sql = _numeric_sql("{t}", "{j}" if column.is_json else None)
+
+        if operator in (FilterOperator.EXISTS, FilterOperator.IS_NOT_NULL):
+            return text_sql("{t} IS NOT NULL")
+
+        if operator in (FilterOperator.EQ, FilterOperator.GT, FilterOperator.GTE,
+                        FilterOperator.LT, FilterOperator.LTE):
+            sql_operator = {FilterOperator.EQ: "=", FilterOperator.GT: ">", FilterOperator.GTE: ">=",
+                            FilterOperator.LT: "<", FilterOperator.LTE: "<="}[operator]
+            # bool values are the numbers 1 and 0, "1" equals True but "true" does not
+            number = _numeric_value(value)
+            if number is not None:
+                return text_sql(f"{numeric_sql} {sql_operator} %s", number)
+            if value is None or isinstance(value, (list, dict)):
+                return "FALSE", []
+            if operator == FilterOperator.EQ:
+                return text_sql(string_guard + "{t} = %s", str(value))
+            return text_sql(f"{string_guard}{TEXT_ORDER_GUARD} AND {{t}} COLLATE \"C\" {sql_operator} %s",
+                            str(value))
+
+        if operator == FilterOperator.IN:
+            # entries compare as they are, the text of a value is not a number (and json values keep their type)
+            entries = [entry for entry in value if entry is not None] if isinstance(value, list) else []
+            if column.is_json:
+                entries = [json.dumps(entry) for entry in entries]
+                return text_sql("{j} = ANY(%s::jsonb[])", entries) if entries else ("FALSE", [])
+            entries = [entry for entry in entries if isinstance(entry, str)]
+            return text_sql("{t} = ANY(%s)", entries) if entries else ("FALSE", [])
+
+        if operator == FilterOperator.CONTAINS:
+            conditions, params = [], []
+            if isinstance(value, str):
+                sql, sql_params = text_sql(string_guard + "{t} LIKE %s", _like_pattern(value))
+                conditions.append(f"({sql})")
+                params += sql_params
+            if column.is_json:
+                sql, sql_params = text_sql("(jsonb_typeof({j}) = 'array' AND {j} @> %s::jsonb)", json.dumps([value]))
+                conditions.append(sql)
+                params += sql_params
+            return (f"({' OR '.join(conditions)})", params) if conditions else ("FALSE", [])
+
+        if operator in (FilterOperator.STARTS_WITH, FilterOperator.ENDS_WITH):
+            if not isinstance(value, str):
+                return "FALSE", []
+            pattern = _like_pattern(value, prefix="") if operator == FilterOperator.STARTS_WITH \
+                else _like_pattern(value, suffix="")
+            return text_sql(string_guard + "{t} LIKE %s", pattern)
+
+        if operator in (FilterOperator.REGEX, FilterOperator.REGEX_CASE_INSENSITIVE):
+            if not isinstance(value, str):
+                return "FALSE", []
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(f"invalid regular expression {value} of filter key {item.key}: {e}")
+            sql_operator = "~" if operator == FilterOperator.REGEX else "~*"
+            return text_sql(f"{string_guard}{{t}} {sql_operator} %s", value)
+
+        if operator in (FilterOperator.BETWEEN, FilterOperator.NOT_BETWEEN):
+            if item.secondary_value is None:
+                return ("FALSE", []) if operator == FilterOperator.BETWEEN else text_sql("{t} IS NOT NULL")
+
+            negation = "NOT " if operator == FilterOperator.NOT_BETWEEN else ""
+            low, high = _numeric_value(value), _numeric_value(item.secondary_value)
+            if (low is None) != (high is None):
+                # bounds of different kinds, the row by row evaluation only gets past the lower bound by failing it
+                return ("FALSE", []) if operator == FilterOperator.BETWEEN \
+                    else self.condition(item, column, path, FilterOperator.LT)
+            if low is not None and high is not None:
+                return text_sql(f"{negation}({numeric_sql} BETWEEN %s AND %s)", low, high)
+            return text_sql(f"{string_guard}{TEXT_ORDER_GUARD} AND {negation}({{t}} COLLATE \"C\" BETWEEN %s AND %s)",
+                            str(value), str(item.secondary_value))
+
+        raise ValueError(f"unsupported filter operator {operator}")
+
+    def compile_item(self, item: FilterItem) -> Tuple[Optional[StateColumnRef], bool, str, list]:
+        """The column, whether the predicate is negated, and the (exists) condition on the value row f."""
+        operator = item.operator or FilterOperator.EQ
+
+        # a missing value is not different from None, nor not in a list with None, every present value is
+        if operator == FilterOperator.NE and item.value is None:
+            operator = FilterOperator.EXISTS
+        missing_in_list = operator == FilterOperator.NOT_IN and isinstance(item.value, list) and None in item.value
+
+        negated = operator in NEGATED_OPERATORS and not missing_in_list
+        operator = NEGATED_OPERATORS.get(operator, operator)
+
+        name, *path = item.key.split(".")
+        column = self.columns.get(name)
+
+        # a missing column (or a nested key of a column that is not json) has no value in any row
+        if not column or (path and not column.is_json):
+            return None, negated, "FALSE", []
+
+        condition, params = self.condition(item, column, path, operator)
+        if missing_in_list:
+            exists, exists_params = self.condition(item, column, path, FilterOperator.EXISTS)
+            condition, params = f"({exists} AND NOT ({condition}))", exists_params + params
+        return column, negated, condition, params
+
+    def exists_sql(self, column: StateColumnRef, condition: str) -> str:
+        return (f"EXISTS (SELECT 1 FROM state_column_data f WHERE f.column_id = {int(column.id)} "
+                f"AND f.data_index = {self.row_alias}.data_index AND {condition})")
+
+
+class FilterIndex(BaseModel):
+    name: str
+    column_id: int
+    valid: bool  # an interrupted concurrent build leaves an invalid index
+    orphaned: bool  # the column is gone
+
+
+def filter_index_name(column_id: int) -> str:
+    return f"{FILTER_INDEX_PREFIX}{int(column_id)}"
+
+
+class StateQueryDatabaseStorage(BaseDatabaseAccessSinglePool):
+    """
+    Filtered, sorted and projected queries of state data, evaluated by the database over the column data
+    tables: a page of data indexes is selected by the compiled filter (keyset paginated), and only the
+    projected columns of those rows are loaded.
+
+    Columns that are filtered frequently may get a partial index of their values. Queries only report the
+    columns a worker filtered index_threshold times (0 is off), the indexes are managed by an operator through
+    `python -m db.filter_indexes`, at most max_indexes of them, and dropped along with the state.
+    """
+
+    def __init__(self, database_url, incremental: bool = False, index_threshold: int = 0, max_indexes: int = 50):
+        super().__init__(database_url=database_url, incremental=incremental)
+        self.index_threshold = index_threshold
+        self.max_indexes = max_indexes
+        self.filter_counts: Counter = Counter()
+        self.reported_columns: Set[int] = set()
+        self.lock = threading.Lock()
+
+    def fetch_column(self, column_id: int) -> Optional[StateColumnRef]:
+        rows = self.execute_query_fixed(
+            sql="SELECT id, name, data_type FROM state_column WHERE id = %s",
+            params=[column_id],
+            mapper=lambda row: StateColumnRef(**row))
+        return rows[0] if rows else None
+
+    def fetch_state_columns(self, state_id: str) -> Dict[str, StateColumnRef]:
+        rows = self.execute_query_fixed(
+            sql="SELECT id, name, data_type FROM state_column WHERE state_id = %s",
+            params=[state_id],
+            mapper=lambda row: StateColumnRef(**row))
+        return {column.name: column for column in rows or []}
+
+    def query_state_data(self,
+                         state_id: str,
+                         filter: Optional[Filter] = None,
+                         columns: Optional[List[str]] = None,
+                         sort: Optional[str] = None,
+                         descending: bool = False,
+                         limit: int = 100,
+                         cursor: Optional[str] = None) -> Tuple[StateDataPage, List[StateColumnRef]]:
+        """
+        A page of the rows matching the filter, ordered by the sort column (then data index) or by data index,
+        continuing after the cursor of the previous page. Returns the page along with the columns that crossed
+        the index threshold.
+        """
+        state_columns = self.fetch_state_columns(state_id=state_id)
+        compiler = FilterCompiler(state_columns)
+
+        # the first positive predicate drives the scan, the rows matching it are checked against the others
+        driver_sql, driver_params = None, []
+        predicates, params = [], []
+        filtered_columns = []
+        for item in (filter.filter_items or {}).values() if filter else []:
+            column, negated, condition, condition_params = compiler.compile_item(item)
+            if column is None:
+                if not negated:
+                    predicates.append("FALSE")
+                continue
+
+            if self._indexable(column, item):
+                filtered_columns.append(column)
+
+            if not negated and driver_sql is None:
+                driver_sql = (f"(SELECT DISTINCT f.data_index FROM state_column_data f "
+                              f"WHERE f.column_id = {int(column.id)} AND {condition}) r")
+                driver_params = condition_params
+                continue
+
+            predicates.append(("NOT " if negated else "") + compiler.exists_sql(column, condition))
+            params += condition_params
+
+        if driver_sql is None:
+            driver_sql = "generate_series(0, (SELECT count FROM state WHERE id = %s) - 1) AS r(data_index)"
+            driver_params = [state_id]
+
+        predicates.append("r.data_index < (SELECT count FROM state WHERE id = %s)")
+        params.append(state_id)
+
+        select_sql, join_sql, order_sql = "r.data_index, NULL AS sort_value", "", "r.data_index"
+        sort_column = None
+        if sort:
+            sort_column = state_columns.get(sort)
+            if not sort_column:
+                raise ValueError(f"unable to sort by {sort}, no such column in state {state_id}")
+
+            sort_value = "s.data_json_value #>> '{}'" if sort_column.is_json else "s.data_value"
+            if sort_column.is_numeric:
+                sort_value = _numeric_sql(sort_value)
+
+            direction = "DESC" if descending else "ASC"
+            select_sql = f"r.data_index, {sort_value} AS sort_value"
+            join_sql = (f"LEFT JOIN state_column_data s "
+                        f"ON s.column_id = {int(sort_column.id)} AND s.data_index = r.data_index")
+            order_sql = f"{sort_value} {direction} NULLS LAST, r.data_index"
+
+        if cursor:
+            after_value, after_index = decode_cursor(cursor)
+            if not sort_column:
+                predicates.append("r.data_index > %s")
+                params.append(after_index)
+            elif after_value is None:
+                predicates.append(f"({sort_value} IS NULL AND r.data_index > %s)")
+                params.append(after_index)
+            else:
+                # nulls sort last, after every value
+                cast = "::numeric" if sort_column.is_numeric else ""
+                comparison = "<" if descending else ">"
+                predicates.append(f"({sort_value} {comparison} %s{cast} "
+                                  f"OR ({sort_value} = %s{cast} AND r.data_index > %s) OR {sort_value} IS NULL)")
+                params += [str(after_value), str(after_value), after_index]
+
+        sql = (f"SELECT {select_sql} FROM {driver_sql} {join_sql} "
+               f"WHERE {' AND '.join(predicates)} ORDER BY {order_sql} LIMIT %s")
+
+        page = self.execute_query_fixed(
+            sql=sql,
+            params=driver_params + params + [limit + 1],
+            mapper=lambda row: (row['data_index'], row['sort_value'])) or []
+
+        has_more = len(page) > limit
+        page = page[:limit]
+        indexes = [data_index for data_index, _ in page]
+
+        projected = [state_columns[name] for name in columns if name in state_columns] if columns \
+            else list(state_columns.values())
+
+        rows = {data_index: {} for data_index in indexes}
+        if indexes and projected:
+            for name, data_index, value in self.execute_query_fixed(
+                    sql="""SELECT sc.name, sd.data_index,
+                                  CASE WHEN sc.data_type = 'json' THEN sd.data_json_value
+                                       ELSE to_jsonb(sd.data_value) END AS value
+                             FROM state_column_data sd
+                             JOIN state_column sc ON sc.id = sd.column_id
+                            WHERE sd.column_id = ANY(%s) AND sd.data_index = ANY(%s)""",
+                    params=[[column.id for column in projected], indexes],
+                    mapper=lambda row: (row['name'], row['data_index'], row['value'])) or []:
+                rows[data_index][name] = value
+
+        next_cursor = None
+        if has_more:
+            last_index, last_sort_value = page[-1]
+            next_cursor = encode_cursor(last_sort_value, last_index)
+
+        return StateDataPage(
+            columns=[column.name for column in projected],
+            rows=[rows[data_index] for data_index in indexes],
+            indexes=indexes,
+            next_cursor=next_cursor
+        ), self._index_candidates(filtered_columns)
+
+    def _indexable(self, column: StateColumnRef, item: FilterItem) -> bool:
+        operator = item.operator or FilterOperator.EQ
+        if column.is_json:
+            return False
+        if column.is_numeric:
+            return operator in INDEXED_NUMERIC_OPERATORS and _numeric_value(item.value) is not None
+
+        # numbers compare by their numeric value, which the hash index of the text does not serve
+        return operator == FilterOperator.IN or (
+            operator == FilterOperator.EQ and _numeric_value(item.value) is None)
+
+    def _index_candidates(self, columns: List[StateColumnRef]) -> List[StateColumnRef]:
+        """The filtered columns that crossed the index threshold, each reported once by the worker."""
+        if not self.index_threshold:
+            return []
+
+        candidates = []
+        with self.lock:
+            for column in columns:
+                if column.id in self.reported_columns:
+                    continue
+                self.filter_counts[column.id] += 1
+                if self.filter_counts[column.id] >= self.index_threshold:
+                    self.reported_columns.add(column.id)
+                    candidates.append(column)
+        return candidates
+
+    def _maintenance_connection(self):
+        """A connection for concurrent index builds and drops, which cannot run in a transaction."""
+        conn = self.create_connection()
+        try:
+            conn.commit()
+            conn.autocommit = True
+        except Exception:
+            self.release_connection(conn)
+            raise
+        return conn
+
+    def _release_maintenance_connection(self, conn):
+        conn.autocommit = False
+        self.release_connection(conn)
+
+    def fetch_filter_indexes(self) -> List[FilterIndex]:
+        return self.execute_query_fixed(
+            sql=f"""SELECT c.relname AS name, i.indisvalid AS valid, x.column_id,
+                           NOT EXISTS (SELECT 1 FROM state_column sc WHERE sc.id = x.column_id) AS orphaned
+                      FROM pg_class c
+                      JOIN pg_index i ON i.indexrelid = c.oid
+                     CROSS JOIN LATERAL (SELECT substring(c.relname FROM '^{FILTER_INDEX_PREFIX}([0-9]+)$')::bigint
+                                                AS column_id) x
+                     WHERE c.relname ~ '^{FILTER_INDEX_PREFIX}[0-9]+$'
+                     ORDER BY x.column_id""",
+            params=None,
+            mapper=lambda row: FilterIndex(**row)) or []
+
+    def create_filter_index(self, column: StateColumnRef) -> bool:
+        """
+        Create the partial index of the column values concurrently (without blocking writes), replacing an
+        invalid one left by an interrupted build. Returns whether an index was created, raises a ValueError
+        when the maximum number of filter indexes exists.
+        """
+        name = filter_index_name(column.id)
+        if column.is_numeric:
+            definition = f"USING btree ({_numeric_sql('data_value')}, data_index)"
+        else:
+            definition = "USING hash (data_value)"
+
+        existing = {index.name: index for index in self.fetch_filter_indexes()}
+        if name in existing and existing[name].valid:
+            return False
+        if name not in existing and len(existing) >= self.max_indexes:
+            raise ValueError(f"unable to index column {column.name}, {len(existing)} filter indexes exist "
+                             f"(at most {self.max_indexes}), drop unused ones first")
+
+        conn = self._maintenance_connection()
+        try:
+            with conn.cursor() as cursor:
+                if name in existing:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+                # builds do not run within the statement timeout of requests
+                cursor.execute("SET statement_timeout = 0")
+                try:
+                    cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON state_column_data "
+                                   f"{definition} WHERE column_id = {int(column.id)}")
+                finally:
+                    cursor.execute("RESET statement_timeout")
+                    if hasattr(conn, "statement_timeout"):
+                        conn.statement_timeout = None
+
+            logging.info(f'created filter index {name} of column {column.name}')
+            return True
+        finally:
+            self._release_maintenance_connection(conn)
+
+    def drop_filter_indexes(self, column_ids: Optional[List[int]] = None) -> List[str]:
+        """
+        Drop the filter indexes of the columns concurrently, or of the columns that no longer exist when none
+        are given. Returns the names of the indexes dropped.
+        """
+        if column_ids is None:
+            names = [index.name for index in self.fetch_filter_indexes() if index.orphaned]
+        else:
+            names = [filter_index_name(column_id) for column_id in column_ids]
+        if not names:
+            return []
+
+        dropped = []
+        conn = self._maintenance_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET statement_timeout = 0")
+                try:
+                    for name in names:
+                        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [name])
+                        if cursor.fetchone():
+                            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                            dropped.append(name)
+                finally:
+                    cursor.execute("RESET statement_timeout")
+                    if hasattr(conn, "statement_timeout"):
+                        conn.statement_timeout = None
+        finally:
+            self._release_maintenance_connection(conn)
+
+        if dropped:
+            logging.info(f'dropped filter indexes {", ".join(dropped)}')
+        return dropped
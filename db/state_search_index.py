@@ -0,0 +1,51 @@
+"""
+Enables the full text search of state data, see StateSearchDatabaseStorage. The search vectors are written by
+triggers on every write of state data, a cost only deployments serving the search (ENABLED_STATE_SEARCH_INDEX)
+should pay, hence installed by an operator once migrations/0003_state_search.sql is applied:
+
+    python -m db.state_search_index status
+    python -m db.state_search_index enable
+    python -m db.state_search_index disable
+
+Enable installs the triggers, writes the vectors of the existing data and builds their index concurrently
+(without blocking writes), it may take a while on a large database and is safe to run again when interrupted.
+Disable removes the triggers, the vectors and their index.
+"""
+import argparse
+import logging as log
+import os
+
+import dotenv
+
+from db.state_search_storage import StateSearchDatabaseStorage
+
+logging = log.getLogger(__name__)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m db.state_search_index", description="state data search index")
+    parser.add_argument("command", choices=["status", "enable", "disable"])
+    args = parser.parse_args(argv)
+
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise ValueError(f'invalid database url, no DATABASE_URL env was specified')
+
+    storage = StateSearchDatabaseStorage(database_url=database_url)
+
+    if args.command == "enable":
+        storage.enable_search_index()
+        logging.info('enabled the state data search index')
+    elif args.command == "disable":
+        storage.disable_search_index()
+        logging.info('disabled the state data search index')
+
+    status = storage.fetch_search_index_status()
+    index = "missing" if status["index_valid"] is None else "valid" if status["index_valid"] else "invalid"
+    print(f"triggers\t{', '.join(status['triggers']) or 'none'}\nindex\t{index}")
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    log.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+    main()
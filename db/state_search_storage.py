@@ -0,0 +1,206 @@
+import logging as log
+from typing import List, Optional
+
+from ismdb.base import BaseDatabaseAccessSinglePool
+from pydantic import BaseModel
+
+logging = log.getLogger(__name__)
+
+# the text search configuration and the prefix length of the values of the stored vectors, changing either
+# takes a migration recomputing them (see migrations/0003_state_search.sql)
+SEARCH_CONFIG = "simple"
+SEARCH_MAX_CHARS = 100000
+
+# the index of the stored vectors, and the triggers writing them along with the data (see enable_search_index)
+SEARCH_INDEX_NAME = "state_column_data_search_vector_idx"
+# (name, table, definition), transition tables are per event
+SEARCH_TRIGGERS = [
+    ("state_search_insert", "state_column_data",
+     "AFTER INSERT ON state_column_data REFERENCING NEW TABLE AS changed_data "
+     "FOR EACH STATEMENT EXECUTE FUNCTION state_search_of_data()"),
+    ("state_search_update", "state_column_data",
+     "AFTER UPDATE ON state_column_data REFERENCING OLD TABLE AS previous_data NEW TABLE AS changed_data "
+     "FOR EACH STATEMENT EXECUTE FUNCTION state_search_of_data()"),
+    ("state_search_delete", "state_column_data",
+     "AFTER DELETE ON state_column_data REFERENCING OLD TABLE AS previous_data "
+     "FOR EACH STATEMENT EXECUTE FUNCTION state_search_of_data()"),
+    ("state_search", "state_column",
+     "AFTER UPDATE OF data_type ON state_column FOR EACH ROW EXECUTE FUNCTION state_search_of_column()"),
+]
+
+# ts_headline options of the snippets, only computed for the rows of the page
+SNIPPET_OPTIONS = 'MaxFragments=2, MaxWords=30, MinWords=10, FragmentDelimiter=" ... "'
+
+
+class StateSearchHit(BaseModel):
+    state_id: str
+    column: str
+    data_index: int
+    rank: float
+    snippet: Optional[str] = None
+
+
+class StateSearchPage(BaseModel):
+    query: str
+    hits: List[StateSearchHit]
+    next_offset: Optional[int] = None
+
+
+class StateSearchDatabaseStorage(BaseDatabaseAccessSinglePool):
+    """
+    Full text search over the values of the text (and json) columns of states, ranked by ts_rank_cd with
+    highlighted snippets. The text search vectors of the values are stored and indexed by the database (see
+    migrations/0003_state_search.sql), written by triggers along with the values once enabled by an operator
+    through `python -m db.state_search_index enable`, there is no indexing step of the api.
+    """
+
+    def _maintenance_connection(self):
+        """A connection for the backfill and concurrent index builds, which cannot run in a transaction."""
+        conn = self.create_connection()
+        try:
+            conn.commit()
+            conn.autocommit = True
+        except Exception:
+            self.release_connection(conn)
+            raise
+        return conn
+
+    def _release_maintenance_connection(self, conn):
+        conn.autocommit = False
+        self.release_connection(conn)
+
+    def fetch_search_index_status(self) -> dict:
+        """The installed triggers, and whether the index exists and is valid (None if it does not exist)."""
+        rows = self.execute_query_fixed(
+            sql="""SELECT (SELECT array_agg(tgname::text ORDER BY tgname) FROM pg_trigger
+                            WHERE tgname = ANY(%s) AND NOT tgisinternal) AS triggers,
+                          (SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+                            WHERE c.relname = %s) AS index_valid""",
+            params=[[name for name, _, _ in SEARCH_TRIGGERS], SEARCH_INDEX_NAME],
+            mapper=lambda row: {"triggers": row['triggers'] or [], "index_valid": row['index_valid']})
+        return rows[0]
+
+    def enable_search_index(self) -> None:
+        """
+        Install the triggers writing the vectors of the data, then write the vectors of the data written before
+        and build their index concurrently (without blocking writes), replacing an invalid one left by an
+        interrupted build. Safe to run again, e.g. after an interruption.
+        """
+        conn = self.create_connection()
+        try:
+            with conn.cursor() as cursor:
+                for name, table, definition in SEARCH_TRIGGERS:
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+                    cursor.execute(f"CREATE TRIGGER {name} {definition}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(e)
+            raise e
+        finally:
+            self.release_connection(conn)
+
+        index_valid = self.fetch_search_index_status()["index_valid"]
+        conn = self._maintenance_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET statement_timeout = 0")
+                # the vectors the triggers did not write, those written meanwhile are newer
+                cursor.execute("""
+                    INSERT INTO state_column_data_search (column_id, data_index, search_vector)
+                    SELECT d.column_id, d.data_index, state_search_vector(d.data_value, d.data_json_value)
+                      FROM state_column_data d
+                      JOIN state_column c ON c.id = d.column_id
+                     WHERE state_search_searchable(c.data_type)
+                       AND COALESCE(d.data_value, d.data_json_value::text) IS NOT NULL
+                        ON CONFLICT (column_id, data_index) DO NOTHING""")
+                logging.info(f'wrote the search vectors of {cursor.rowcount} state data values')
+
+                if index_valid is False:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {SEARCH_INDEX_NAME}")
+                cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {SEARCH_INDEX_NAME} "
+                               f"ON state_column_data_search USING gin (search_vector)")
+        finally:
+            self._release_maintenance_connection(conn)
+
+    def disable_search_index(self) -> None:
+        """Remove the triggers, then the vectors (which would no longer follow the data) and their index."""
+        conn = self.create_connection()
+        try:
+            with conn.cursor() as cursor:
+                for name, table, _ in SEARCH_TRIGGERS:
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(e)
+            raise e
+        finally:
+            self.release_connection(conn)
+
+        conn = self._maintenance_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {SEARCH_INDEX_NAME}")
+                cursor.execute("TRUNCATE state_column_data_search")
+        finally:
+            self._release_maintenance_connection(conn)
+
+    def _text_sql(self, alias: str = "") -> str:
+        prefix = f"{alias}." if alias else ""
+        return f"left(COALESCE({prefix}data_value, {prefix}data_json_value::text), {SEARCH_MAX_CHARS})"
+
+    def search(self,
+               query: str,
+               state_id: Optional[str] = None,
+               project_id: Optional[str] = None,
+               columns: Optional[List[str]] = None,
+               limit: int = 20,
+               offset: int = 0) -> StateSearchPage:
+        """
+        The rows of the state (or of all states of the project) with a searchable column value matching the
+        query, in web search syntax (words, "quoted phrases", OR and -negation), best ranked first.
+        """
+        if not state_id and not project_id:
+            raise ValueError("either a state_id or a project_id is required")
+        if not query or not query.strip():
+            raise ValueError("a search query is required")
+
+        scope_sql, scope_params = ("s.id = %s", [state_id]) if state_id else ("s.project_id = %s", [project_id])
+        if columns:
+            scope_sql += " AND sc.name = ANY(%s)"
+            scope_params.append(columns)
+
+        sql = f"""
+            WITH search AS (SELECT websearch_to_tsquery('{SEARCH_CONFIG}'::regconfig, %s) AS query),
+                 hits AS (
+                    SELECT v.column_id, v.data_index, ts_rank_cd(v.search_vector, search.query) AS rank
+                      FROM state_column_data_search v
+                      JOIN state_column sc ON sc.id = v.column_id
+                      JOIN state s ON s.id = sc.state_id
+                     CROSS JOIN search
+                     WHERE {scope_sql}
+                       AND v.data_index < s.count
+                       AND v.search_vector @@ search.query
+                     ORDER BY rank DESC, v.column_id, v.data_index
+                     LIMIT %s OFFSET %s)
+            SELECT sc.state_id, sc.name, h.data_index, h.rank,
+                   ts_headline('{SEARCH_CONFIG}'::regconfig, {self._text_sql('d')}, search.query, %s) AS snippet
+              FROM hits h
+              JOIN state_column sc ON sc.id = h.column_id
+              JOIN state_column_data d ON d.column_id = h.column_id AND d.data_index = h.data_index
+             CROSS JOIN search
+             ORDER BY h.rank DESC, h.column_id, h.data_index"""
+
+        hits = self.execute_query_fixed(
+            sql=sql,
+            params=[query] + scope_params + [limit + 1, offset, SNIPPET_OPTIONS],
+            mapper=lambda row: StateSearchHit(state_id=row['state_id'], column=row['name'],
+                                              data_index=row['data_index'], rank=row['rank'],
+                                              snippet=row['snippet'])) or []
+
+        return StateSearchPage(
+            query=query,
+            hits=hits[:limit],
+            next_offset=offset + limit if len(hits) > limit else None
+        )
@@ -0,0 +1,252 @@
+import json
+import logging as log
+import uuid
+from typing import List, Set, Dict, Optional
+
+from ismdb.base import BaseDatabaseAccessSinglePool
+from psycopg2.extras import execute_values, Json
+
+from db.project_change_storage import ProjectChangeDatabaseStorage, edge_entity_id
+from models.models import (
+    WorkflowBatchResult,
+    CreateNodeOperation, DeleteNodeOperation,
+    CreateEdgeOperation, DeleteEdgeOperation,
+    CreateProcessorOperation, DeleteProcessorOperation,
+    CreateRouteOperation, DeleteRouteOperation)
+
+logging = log.getLogger(__name__)
+
+# tables (and id column) whose existence can be checked when validating a batch
+EXISTENCE_CHECKS = {
+    "workflow_node": "node_id",
+    "processor": "id",
+    "state": "id",
+}
+
+
+class WorkflowBatchDatabaseStorage(BaseDatabaseAccessSinglePool):
+    """Applies a batch of workflow graph operations (nodes, edges, processors and routes) in a single transaction."""
+
+    def __init__(self, database_url, change_storage: ProjectChangeDatabaseStorage, incremental: bool = False):
+        super().__init__(database_url=database_url, incremental=incremental)
+        self.change_storage = change_storage
+
+    def fetch_existing_ids(self, table: str, ids: Set[str], project_id: Optional[str] = None) -> Set[str]:
+        """The ids that exist, in the project when given."""
+        if not ids:
+            return set()
+
+        id_column = EXISTENCE_CHECKS[table]
+        sql = f"SELECT {id_column} AS id FROM {table} WHERE {id_column} = ANY(%s)"
+        params = [list(ids)]
+        if project_id:
+            sql += " AND project_id = %s"
+            params.append(project_id)
+
+        rows = self.execute_query_fixed(sql=sql, params=params, mapper=lambda row: row['id'])
+        return set(rows or [])
+
+    def fetch_node_project_id(self, node_id: str) -> Optional[str]:
+        """The project of the workflow node of the id, None if there is no such node (or it has no project)."""
+        rows = self.execute_query_fixed(
+            sql="SELECT project_id FROM workflow_node WHERE node_id = %s",
+            params=[node_id],
+            mapper=lambda row: row['project_id'])
+        return rows[0] if rows else None
+
+    def fetch_foreign_ids(self, table: str, ids: Set[str], project_id: str) -> Set[str]:
+        """The ids that exist, in another project (or in none)."""
+        if not ids:
+            return set()
+
+        id_column = EXISTENCE_CHECKS[table]
+        rows = self.execute_query_fixed(
+            sql=f"SELECT {id_column} AS id FROM {table} "
+                f"WHERE {id_column} = ANY(%s) AND project_id IS DISTINCT FROM %s",
+            params=[list(ids), project_id],
+            mapper=lambda row: row['id'])
+        return set(rows or [])
+
+    def fetch_foreign_route_ids(self, route_ids: Set[str], project_id: str) -> Set[str]:
+        """The route ids that exist, with a processor of another project."""
+        if not route_ids:
+            return set()
+
+        rows = self.execute_query_fixed(
+            sql="""SELECT ps.id FROM processor_state ps
+                     LEFT JOIN processor p ON p.id = ps.processor_id
+                    WHERE ps.id = ANY(%s) AND p.project_id IS DISTINCT FROM %s""",
+            params=[list(route_ids), project_id],
+            mapper=lambda row: row['id'])
+        return set(rows or [])
+
+    def apply_batch(self, project_id: str, operations: List) -> WorkflowBatchResult:
+        """
+        Apply the (already validated) operations, deletes before upserts, using one multi-row statement per
+        table and operation. Deleting a node or processor also deletes every edge and route attached to it,
+        such that no dangling edges are left behind. The change log is written in the same transaction (by
+        the triggers of the tables).
+
+        Deletes are scoped to the project, ids of other projects are left alone (validation rejects them up
+        front, the scoping guards against a concurrent change in between).
+        """
+        creates = {op_type: [op for op in operations if isinstance(op, op_type)] for op_type in (
+            CreateNodeOperation, CreateEdgeOperation, CreateProcessorOperation, CreateRouteOperation)}
+
+        delete_route_ids = [op.route_id for op in operations if isinstance(op, DeleteRouteOperation)]
+        delete_edges = [(op.source_node_id, op.target_node_id) for op in operations if isinstance(op, DeleteEdgeOperation)]
+        delete_processor_ids = [op.processor_id for op in operations if isinstance(op, DeleteProcessorOperation)]
+        delete_node_ids = [op.node_id for op in operations if isinstance(op, DeleteNodeOperation)] + delete_processor_ids
+
+        nodes = [op.node for op in creates[CreateNodeOperation]]
+        edges = [op.edge for op in creates[CreateEdgeOperation]]
+        processors = [op.processor for op in creates[CreateProcessorOperation]]
+        routes = [op.route for op in creates[CreateRouteOperation]]
+
+        for node in nodes:
+            node.node_id = node.node_id or str(uuid.uuid4())
+
+        for processor in processors:
+            processor.id = processor.id or str(uuid.uuid4())
+
+        result = WorkflowBatchResult(nodes=nodes, edges=edges, processors=processors, routes=routes)
+        deleted: Dict[str, List[str]] = {}
+
+        conn = self.create_connection()
+        try:
+            with conn.cursor() as cursor:
+                if delete_node_ids:
+                    # a processor is a node of the graph too
+                    cursor.execute(
+                        """SELECT node_id FROM workflow_node WHERE node_id = ANY(%s) AND project_id = %s
+                            UNION
+                           SELECT id FROM processor WHERE id = ANY(%s) AND project_id = %s""",
+                        [delete_node_ids, project_id, delete_processor_ids, project_id])
+                    delete_node_ids = [row[0] for row in cursor.fetchall()]
+
+                if delete_route_ids or delete_processor_ids:
+                    cursor.execute(
+                        """DELETE FROM processor_state ps
+                            USING processor p
+                            WHERE p.id = ps.processor_id AND p.project_id = %s
+                              AND (ps.id = ANY(%s) OR ps.processor_id = ANY(%s))
+                        RETURNING ps.id""",
+                        [project_id, delete_route_ids, delete_processor_ids])
+                    deleted["routes"] = [row[0] for row in cursor.fetchall() if row[0]]
+
+                deleted_edges = []
+                if delete_edges:
+                    cursor.execute(
+                        """DELETE FROM workflow_edge e
+                            USING unnest(%s::text[], %s::text[]) AS d (source_node_id, target_node_id), workflow_node n
+                            WHERE e.source_node_id = d.source_node_id AND e.target_node_id = d.target_node_id
+                              AND n.node_id = e.source_node_id AND n.project_id = %s
+                        RETURNING e.source_node_id, e.target_node_id""",
+                        [[source for source, _ in delete_edges], [target for _, target in delete_edges], project_id])
+                    deleted_edges += cursor.fetchall()
+
+                if delete_node_ids:
+                    cursor.execute(
+                        """DELETE FROM workflow_edge
+                            WHERE source_node_id = ANY(%s) OR target_node_id = ANY(%s)
+                        RETURNING source_node_id, target_node_id""",
+                        [delete_node_ids, delete_node_ids])
+                    deleted_edges += cursor.fetchall()
+
+                if deleted_edges:
+                    deleted["edges"] = [edge_entity_id(source, target) for source, target in deleted_edges]
+
+                if delete_processor_ids:
+                    cursor.execute("DELETE FROM processor WHERE id = ANY(%s) AND project_id = %s RETURNING id",
+                                   [delete_processor_ids, project_id])
+                    deleted["processors"] = [row[0] for row in cursor.fetchall()]
+
+                if delete_node_ids:
+                    cursor.execute("DELETE FROM workflow_node WHERE node_id = ANY(%s) AND project_id = %s RETURNING node_id",
+                                   [delete_node_ids, project_id])
+                    deleted["nodes"] = [row[0] for row in cursor.fetchall()]
+
+                if nodes:
+                    execute_values(cursor, """
+                        INSERT INTO workflow_node (
+                            node_id, node_type, node_label, project_id, object_id,
+                            position_x, position_y, width, height, metadata)
+                        VALUES %s
+                        ON CONFLICT (node_id)
+                        DO UPDATE SET
+                            node_label = EXCLUDED.node_label,
+                            object_id = EXCLUDED.object_id,
+                            node_type = EXCLUDED.node_type,
+                            position_x = EXCLUDED.position_x,
+                            position_y = EXCLUDED.position_y,
+                            width = EXCLUDED.width,
+                            height = EXCLUDED.height,
+                            metadata = EXCLUDED.metadata
+                        WHERE workflow_node.project_id = EXCLUDED.project_id""", [
+                        (node.node_id, node.node_type, node.node_label, node.project_id, node.object_id,
+                         node.position_x, node.position_y, node.width, node.height,
+                         json.dumps(node.metadata) if node.metadata else None)
+                        for node in nodes])
+
+                if processors:
+                    execute_values(cursor, """
+                        INSERT INTO processor (id, provider_id, project_id, name, properties, status)
+                        VALUES %s
+                        ON CONFLICT (id)
+                        DO UPDATE SET
+                            provider_id = EXCLUDED.provider_id,
+                            properties = EXCLUDED.properties,
+                            name = EXCLUDED.name
+                        WHERE processor.project_id = EXCLUDED.project_id""", [
+                        (processor.id, processor.provider_id, processor.project_id, processor.name,
+                         Json(processor.properties) if processor.properties else None, processor.status.value)
+                        for processor in processors])
+
+                if edges:
+                    execute_values(cursor, """
+                        INSERT INTO workflow_edge (
+                            source_node_id, target_node_id, source_handle, target_handle, animated, edge_label, type)
+                        VALUES %s
+                        ON CONFLICT (source_node_id, target_node_id)
+                        DO UPDATE SET
+                            animated = EXCLUDED.animated,
+                            edge_label = EXCLUDED.edge_label""", [
+                        (edge.source_node_id, edge.target_node_id, edge.source_handle, edge.target_handle,
+                         edge.animated, edge.edge_label, edge.type)
+                        for edge in edges])
+
+                if routes:
+                    internal_ids = execute_values(cursor, """
+                        INSERT INTO processor_state (
+                            id, processor_id, state_id, direction, status,
+                            count, current_index, maximum_index, edge_function)
+                        VALUES %s
+                        ON CONFLICT (processor_id, state_id, direction)
+                        DO UPDATE SET
+                            count = EXCLUDED.count,
+                            status = EXCLUDED.status,
+                            current_index = EXCLUDED.current_index,
+                            maximum_index = EXCLUDED.maximum_index,
+                            edge_function = EXCLUDED.edge_function
+                        RETURNING internal_id""", [
+                        (route.id, route.processor_id, route.state_id, route.direction.value, route.status.value,
+                         route.count, route.current_index, route.maximum_index,
+                         route.edge_function.model_dump_json() if route.edge_function else None)
+                        for route in routes], fetch=True)
+
+                    for route, row in zip(routes, internal_ids):
+                        route.internal_id = route.internal_id or row[0]
+
+                # the changes are recorded by the triggers of the tables, in this transaction
+                result.change_version = self.change_storage.fetch_version(cursor, project_id)
+
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f'failed to apply workflow batch of {len(operations)} operations: {e}')
+            raise
+        finally:
+            self.release_connection(conn)
+
+        result.deleted = deleted
+        return result
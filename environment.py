@@ -1,14 +1,36 @@
 import logging
 import os
+import tempfile
+import threading
 
 import dotenv
 from ismcore.utils.general_utils import str2bool
 from ismdb.postgres_storage_class import PostgresDatabaseStorage
 
+from db.connection_pool import install_connection_pool, parse_statement_timeouts
+from db.project_change_storage import ProjectChangeDatabaseStorage
+from db.read_replica import ReadReplicaRoutingStorage, WalPositionDatabaseStorage
+from db.state_bulk_load_storage import StateBulkLoadDatabaseStorage
+from db.state_data_version_storage import StateDataVersionDatabaseStorage
+from db.state_deletion_storage import StateDeletionDatabaseStorage
+from db.state_query_storage import StateQueryDatabaseStorage
+from db.state_search_storage import StateSearchDatabaseStorage
+from db.workflow_batch_storage import WorkflowBatchDatabaseStorage
+from utils.admission import AdmissionController, ADMISSION_REQUESTS, ADMISSION_BYTES, ADMISSION_MESSAGES
+from utils.artifact_cache import ArtifactCache
+from utils.envelope import validate_envelope_config
+from utils.executors import ExecutionLanes, parse_lane_config, parse_lane_timeouts, LANE_METADATA, LANE_SANDBOX
+from utils.sandbox import init_sandbox_worker
+from utils.singleflight import SingleFlight
+from utils.state_deletion import StateDeletionManager
+from utils.upload_sessions import UploadSessionManager, UploadSessionStore
+
 dotenv.load_dotenv()
 
 HUGGING_FACE_TOKEN = os.environ.get("HUGGING_FACE_TOKEN", None)
+HF_PUSH_WORKERS = int(os.environ.get("HF_PUSH_WORKERS", 4))  # parquet shards written and uploaded in parallel
 DATABASE_URL = os.environ.get("DATABASE_URL", None)
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL", None)  # optional read replica, used by read only requests
 API_ROOT_PATH = os.environ.get("API_ROOT_PATH", None)
 ROUTING_FILE = os.environ.get("ROUTING_FILE", '.routing.yaml')
 FIREBASE_CREDENTIALS_JSON_FILE = os.environ.get("FIREBASE_CREDENTIALS_JSON_FILE", ".firebase-credentials.json")
@@ -16,6 +38,92 @@ LOG_LEVEL = os.environ.get("LOG_LEVEL", logging.INFO)
 ENABLED_LOCAL_AUTH = str2bool(os.environ.get("ENABLED_LOCAL_AUTH", "False"))
 ENABLED_FIREBASE_AUTH = str2bool(os.environ.get("ENABLED_FIREBASE_AUTH", "False"))
 
+# response compression (zstd/br/gzip negotiated by Accept-Encoding), responses smaller than the minimum are sent as is
+ENABLED_COMPRESSION = str2bool(os.environ.get("ENABLED_COMPRESSION", "True"))
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", 1024))
+
+# maximum number of concurrent storage queries issued by a single project snapshot request
+SNAPSHOT_CONCURRENCY = int(os.environ.get("SNAPSHOT_CONCURRENCY", 3))
+
+# state data is deleted in the background in data index ranges of this size, pausing between ranges
+STATE_DELETION_BATCH_SIZE = int(os.environ.get("STATE_DELETION_BATCH_SIZE", 5000))
+STATE_DELETION_THROTTLE_SECONDS = float(os.environ.get("STATE_DELETION_THROTTLE_SECONDS", 0.1))
+# a running deletion without a progress update for the lease is taken over by another worker
+STATE_DELETION_LEASE_SECONDS = float(os.environ.get("STATE_DELETION_LEASE_SECONDS", 300))
+
+# database connection pool, shared by all storage classes of a worker process; idle connections above the
+# minimum are closed when released, an exhausted pool waits up to the acquire timeout for a connection
+DATABASE_POOL_MIN_SIZE = int(os.environ.get("DATABASE_POOL_MIN_SIZE", os.environ.get("MIN_DB_CONNECTIONS", 1)))
+DATABASE_POOL_MAX_SIZE = int(os.environ.get("DATABASE_POOL_MAX_SIZE", os.environ.get("MAX_DB_CONNECTIONS", 5)))
+DATABASE_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("DATABASE_POOL_ACQUIRE_TIMEOUT", 10))
+# pool connections reading state data for parquet shards at once, across the hugging face pushes of a worker
+HF_PUSH_DB_CONNECTIONS = int(os.environ.get("HF_PUSH_DB_CONNECTIONS", max(1, DATABASE_POOL_MAX_SIZE // 2)))
+
+# set when connecting through PgBouncer in transaction mode, no session state is kept on server connections
+DATABASE_PGBOUNCER_TRANSACTION_MODE = str2bool(os.environ.get("DATABASE_PGBOUNCER_TRANSACTION_MODE", "False"))
+
+# statement timeouts in milliseconds (0 is none), by default and by route group, e.g. "state=120000,dataset=600000"
+DATABASE_STATEMENT_TIMEOUT_MS = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT_MS", 0))
+DATABASE_STATEMENT_TIMEOUTS = parse_statement_timeouts(os.environ.get("DATABASE_STATEMENT_TIMEOUTS", None))
+
+# identical concurrent polling reads of a worker share one storage call, results are optionally reused for the ttl
+SINGLEFLIGHT_TTL_SECONDS = float(os.environ.get("SINGLEFLIGHT_TTL_SECONDS", 0))
+
+# bounded executors by kind of work as lane=workers:queue, calls beyond workers plus queue are rejected with a 429
+EXECUTION_LANES = parse_lane_config(os.environ.get("EXECUTION_LANES", None))
+# seconds a call of a process lane may run before its workers are terminated and replaced, 0 is none
+EXECUTION_LANE_TIMEOUTS = parse_lane_timeouts(os.environ.get("EXECUTION_LANE_TIMEOUTS", None))
+# address space limit of the sandbox worker processes (user code and template previews), 0 is none
+SANDBOX_MEMORY_LIMIT_MB = int(os.environ.get("SANDBOX_MEMORY_LIMIT_MB", 2048))
+
+# encoding (json, msgpack or arrow) and compression (zstd) of the blocks published to the state sync route,
+# json without compression publishes plain row messages, anything else columnar envelopes consumers must decode
+STATE_SYNC_ENCODING, STATE_SYNC_COMPRESSION = validate_envelope_config(
+    encoding=os.environ.get("STATE_SYNC_ENCODING", "json"),
+    compression=os.environ.get("STATE_SYNC_COMPRESSION", None))
+
+# admission control of uploads, exports, triggers and forwards per user and project, as token bucket rates per
+# second and burst capacities; requests over the rate are delayed up to the max delay and rejected beyond it
+ENABLED_ADMISSION_CONTROL = str2bool(os.environ.get("ENABLED_ADMISSION_CONTROL", "True"))
+ADMISSION_REQUEST_RATE = float(os.environ.get("ADMISSION_REQUEST_RATE", 2))
+ADMISSION_REQUEST_BURST = float(os.environ.get("ADMISSION_REQUEST_BURST", 20))
+ADMISSION_BYTES_RATE = float(os.environ.get("ADMISSION_BYTES_RATE", 5 * 1024 * 1024))
+ADMISSION_BYTES_BURST = float(os.environ.get("ADMISSION_BYTES_BURST", 100 * 1024 * 1024))
+ADMISSION_MESSAGE_RATE = float(os.environ.get("ADMISSION_MESSAGE_RATE", 50))
+ADMISSION_MESSAGE_BURST = float(os.environ.get("ADMISSION_MESSAGE_BURST", 1000))
+ADMISSION_MAX_DELAY_SECONDS = float(os.environ.get("ADMISSION_MAX_DELAY_SECONDS", 2))
+ADMISSION_USAGE_TTL_SECONDS = float(os.environ.get("ADMISSION_USAGE_TTL_SECONDS", 30))
+# whether callers of the admission controlled endpoints must identify as a user (JWT) or a service (SERVICE_TOKENS),
+# anonymous callers are accepted (and not admission controlled) otherwise
+CALLER_IDENTITY_REQUIRED = str2bool(os.environ.get("CALLER_IDENTITY_REQUIRED", "False"))
+
+# resumable chunked uploads are spooled to this local directory, parts of a session must reach the same host;
+# sessions expire after the ttl and their ingest fails when no data arrives within the idle timeout
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "ism-uploads"))
+UPLOAD_SESSION_TTL_SECONDS = float(os.environ.get("UPLOAD_SESSION_TTL_SECONDS", 86400))
+UPLOAD_SESSION_IDLE_TIMEOUT_SECONDS = float(os.environ.get("UPLOAD_SESSION_IDLE_TIMEOUT_SECONDS", 3600))
+# threads reading (and waiting for) the spooled parts of upload sessions, sessions beyond wait for a thread
+UPLOAD_SESSION_MAX_READERS = int(os.environ.get("UPLOAD_SESSION_MAX_READERS", 16))
+
+# generated export artifacts (xlsx exports, parquet shards of pushes) are cached on local disk or a volume,
+# keyed by the data version of the state (shared by the hosts), the least recently used ones are evicted beyond the max bytes
+ENABLED_EXPORT_CACHE = str2bool(os.environ.get("ENABLED_EXPORT_CACHE", "True"))
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ism-exports"))
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+
+# filtered state data queries log a column as a filter index candidate once it was filtered this many times by
+# a worker (by equality, or by range for numeric columns), 0 is off; indexes are created by an operator through
+# `python -m db.filter_indexes`, at most the max of them
+STATE_QUERY_INDEX_THRESHOLD = int(os.environ.get("STATE_QUERY_INDEX_THRESHOLD", 0))
+STATE_QUERY_MAX_INDEXES = int(os.environ.get("STATE_QUERY_MAX_INDEXES", 50))
+
+# full text search of state data, served once the search vectors and their index are in place
+# (python -m db.state_search_index enable)
+ENABLED_STATE_SEARCH_INDEX = str2bool(os.environ.get("ENABLED_STATE_SEARCH_INDEX", "False"))
+
+# expose prometheus metrics (connection pool and others) of each worker at /metrics
+ENABLED_METRICS = str2bool(os.environ.get("ENABLED_METRICS", "True"))
+
 if not DATABASE_URL:
     raise ValueError(f'invalid database url, no DATABASE_URL env was specified')
 
@@ -23,6 +131,101 @@ logging.basicConfig(level=LOG_LEVEL)
 logging.info(DATABASE_URL[:20])
 logging = logging.getLogger(__name__)
 
+# set up the connection pool before any storage, such that all of them share it
+install_connection_pool(
+    database_url=DATABASE_URL,
+    min_size=DATABASE_POOL_MIN_SIZE,
+    max_size=DATABASE_POOL_MAX_SIZE,
+    acquire_timeout=DATABASE_POOL_ACQUIRE_TIMEOUT,
+    transaction_pooling=DATABASE_PGBOUNCER_TRANSACTION_MODE,
+    default_statement_timeout_ms=DATABASE_STATEMENT_TIMEOUT_MS,
+    statement_timeouts=DATABASE_STATEMENT_TIMEOUTS)
+
 # set up the storage device for managing state, state configs, templates, models and so forth
 storage = PostgresDatabaseStorage(database_url=DATABASE_URL)
 
+# reads of read only requests are served by the replica, when one is configured
+if DATABASE_READ_URL:
+    install_connection_pool(
+        database_url=DATABASE_READ_URL,
+        min_size=DATABASE_POOL_MIN_SIZE,
+        max_size=DATABASE_POOL_MAX_SIZE,
+        acquire_timeout=DATABASE_POOL_ACQUIRE_TIMEOUT,
+        transaction_pooling=DATABASE_PGBOUNCER_TRANSACTION_MODE,
+        default_statement_timeout_ms=DATABASE_STATEMENT_TIMEOUT_MS,
+        statement_timeouts=DATABASE_STATEMENT_TIMEOUTS,
+        name="replica")
+
+    storage = ReadReplicaRoutingStorage(
+        primary=storage,
+        replica=PostgresDatabaseStorage(database_url=DATABASE_READ_URL),
+        primary_wal=WalPositionDatabaseStorage(database_url=DATABASE_URL),
+        replica_wal=WalPositionDatabaseStorage(database_url=DATABASE_READ_URL))
+
+# change log of project workflow graphs, used for incremental (delta) synchronization
+project_change_storage = ProjectChangeDatabaseStorage(database_url=DATABASE_URL)
+
+# applies batches of workflow graph operations in a single transaction
+workflow_batch_storage = WorkflowBatchDatabaseStorage(database_url=DATABASE_URL, change_storage=project_change_storage)
+
+# direct COPY loads of uploaded state data, bypassing the state sync message path
+state_bulk_load_storage = StateBulkLoadDatabaseStorage(database_url=DATABASE_URL, state_storage=storage)
+
+# server side filtered, sorted and projected queries of state data
+state_query_storage = StateQueryDatabaseStorage(
+    database_url=DATABASE_URL, index_threshold=STATE_QUERY_INDEX_THRESHOLD, max_indexes=STATE_QUERY_MAX_INDEXES)
+
+# full text search of state data, ranked with snippets
+state_search_storage = StateSearchDatabaseStorage(database_url=DATABASE_URL)
+
+# background (chunked and throttled) deletion of state data
+state_deletion_storage = StateDeletionDatabaseStorage(database_url=DATABASE_URL)
+state_deletion_manager = StateDeletionManager(
+    storage=storage,
+    deletion_storage=state_deletion_storage,
+    batch_size=STATE_DELETION_BATCH_SIZE,
+    throttle_seconds=STATE_DELETION_THROTTLE_SECONDS,
+    lease_seconds=STATE_DELETION_LEASE_SECONDS,
+    on_purged=state_query_storage.drop_filter_indexes)
+
+# named executors (export, import, sandbox and metadata) such that heavy work cannot starve cheap calls
+execution_lanes = ExecutionLanes(
+    config=EXECUTION_LANES,
+    timeouts=EXECUTION_LANE_TIMEOUTS,
+    initializers={LANE_SANDBOX: (init_sandbox_worker, (SANDBOX_MEMORY_LIMIT_MB,))})
+
+# shard writes of concurrent pushes share these connections, the rest of the pool is left to requests
+hf_push_connections = threading.BoundedSemaphore(HF_PUSH_DB_CONNECTIONS)
+
+# coalesces identical concurrent reads (polling endpoints)
+single_flight = SingleFlight(ttl=SINGLEFLIGHT_TTL_SECONDS, lane=execution_lanes[LANE_METADATA])
+
+# token bucket admission control, decisions are tightened by the (cached) usage report of the user and project
+admission_controller = AdmissionController(
+    usage_loader=lambda user_id, project_id: single_flight.run(
+        "admission_usage", (user_id, project_id),
+        storage.fetch_user_project_current_usage_report, user_id=user_id, project_id=project_id),
+    rates={
+        ADMISSION_REQUESTS: (ADMISSION_REQUEST_RATE, ADMISSION_REQUEST_BURST),
+        ADMISSION_BYTES: (ADMISSION_BYTES_RATE, ADMISSION_BYTES_BURST),
+        ADMISSION_MESSAGES: (ADMISSION_MESSAGE_RATE, ADMISSION_MESSAGE_BURST),
+    },
+    max_delay=ADMISSION_MAX_DELAY_SECONDS,
+    usage_ttl=ADMISSION_USAGE_TTL_SECONDS,
+    enabled=ENABLED_ADMISSION_CONTROL)
+
+# resumable upload sessions, ingested in the background while their parts arrive
+upload_sessions = UploadSessionManager(
+    store=UploadSessionStore(spool_dir=UPLOAD_SPOOL_DIR, ttl_seconds=UPLOAD_SESSION_TTL_SECONDS),
+    idle_timeout=UPLOAD_SESSION_IDLE_TIMEOUT_SECONDS,
+    max_readers=UPLOAD_SESSION_MAX_READERS)
+
+# export artifacts of state data versions, warmed when the processor of a state completes; the versions are read
+# from the primary, a replica behind would hand out artifacts of an earlier version
+state_data_version_storage = StateDataVersionDatabaseStorage(database_url=DATABASE_URL)
+artifact_cache = ArtifactCache(
+    cache_dir=EXPORT_CACHE_DIR,
+    max_bytes=EXPORT_CACHE_MAX_BYTES,
+    enabled=ENABLED_EXPORT_CACHE,
+    version_loader=state_data_version_storage.fetch_version,
+    version_bumper=state_data_version_storage.bump_version)
@@ -1,11 +1,14 @@
+import asyncio
 import os
 import time
 
 ## front loaded
-from environment import API_ROOT_PATH
+from environment import API_ROOT_PATH, ENABLED_COMPRESSION, COMPRESSION_MINIMUM_SIZE, ENABLED_METRICS, \
+    DATABASE_READ_URL, storage, state_deletion_manager, execution_lanes
 
 from api.dataset import dataset_router
 from api.filter import filter_router
+from api.metrics import metrics_router
 from message_router import message_router
 from api.processor_state_route import processor_state_router
 from api.monitor import monitor_router
@@ -21,8 +24,11 @@ from api.validate import validate_router
 from api.workflow import workflow_router
 from api.state_subscriber import state_channel_router
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends
 from starlette.middleware.cors import CORSMiddleware
+from db.connection_pool import statement_timeout_group
+from db.read_replica import ReadReplicaMiddleware, CONSISTENCY_TOKEN_HEADER
+from utils.compression import CompressionMiddleware
 from utils.exceptions import CustomException, custom_exception_handler
 
 # set the timezone
@@ -58,36 +64,73 @@ origins = [
     "https://ism.quantumwake.io"
 ]
 
+# compress responses (including streamed exports) for clients that accept it,
+# added before CORS so that CORS remains the outermost middleware
+if ENABLED_COMPRESSION:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
+
+# route the storage reads of read only requests to the replica, and hand out consistency tokens on writes
+if DATABASE_READ_URL:
+    app.add_middleware(ReadReplicaMiddleware, routing_storage=storage)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Authorization"],  # Make sure Authorization header is exposed
+    expose_headers=["Authorization", CONSISTENCY_TOKEN_HEADER],  # Make sure Authorization header is exposed
 )
 
 # Register the custom exception handler
 app.add_exception_handler(CustomException, custom_exception_handler)
 
-app.include_router(user_router, prefix="/user", tags=["users"])
-app.include_router(usage_router, prefix="/usage", tags=["usage"])
-app.include_router(project_router, prefix="/project", tags=["projects"])
-app.include_router(workflow_router, prefix="/workflow", tags=["workflows"])
-app.include_router(processor_router, prefix="/processor", tags=["processors"])
-app.include_router(processor_state_router, prefix="/processor/state/route", tags=["routes"])
-app.include_router(state_router, prefix="/state", tags=["state"])
-app.include_router(session_router, prefix="/session", tags=["sessions"])
-app.include_router(provider_router, prefix="/provider", tags=["providers"])
-app.include_router(filter_router, prefix="/filter", tags=["filters"])
-app.include_router(template_router, prefix="/template", tags=["templates"])
-app.include_router(monitor_router, prefix="/monitor", tags=["monitors"])
+# each route group applies its own database statement timeout, see DATABASE_STATEMENT_TIMEOUTS
+app.include_router(user_router, prefix="/user", tags=["users"],
+                   dependencies=[Depends(statement_timeout_group("user"))])
+app.include_router(usage_router, prefix="/usage", tags=["usage"],
+                   dependencies=[Depends(statement_timeout_group("usage"))])
+app.include_router(project_router, prefix="/project", tags=["projects"],
+                   dependencies=[Depends(statement_timeout_group("project"))])
+app.include_router(workflow_router, prefix="/workflow", tags=["workflows"],
+                   dependencies=[Depends(statement_timeout_group("workflow"))])
+app.include_router(processor_router, prefix="/processor", tags=["processors"],
+                   dependencies=[Depends(statement_timeout_group("processor"))])
+app.include_router(processor_state_router, prefix="/processor/state/route", tags=["routes"],
+                   dependencies=[Depends(statement_timeout_group("route"))])
+app.include_router(state_router, prefix="/state", tags=["state"],
+                   dependencies=[Depends(statement_timeout_group("state"))])
+app.include_router(session_router, prefix="/session", tags=["sessions"],
+                   dependencies=[Depends(statement_timeout_group("session"))])
+app.include_router(provider_router, prefix="/provider", tags=["providers"],
+                   dependencies=[Depends(statement_timeout_group("provider"))])
+app.include_router(filter_router, prefix="/filter", tags=["filters"],
+                   dependencies=[Depends(statement_timeout_group("filter"))])
+app.include_router(template_router, prefix="/template", tags=["templates"],
+                   dependencies=[Depends(statement_timeout_group("template"))])
+app.include_router(monitor_router, prefix="/monitor", tags=["monitors"],
+                   dependencies=[Depends(statement_timeout_group("monitor"))])
 app.include_router(state_channel_router, prefix="/streams", tags=["streams"])
-app.include_router(dataset_router, prefix="/dataset", tags=["datasets"])
-app.include_router(validate_router, prefix="/validate", tags=["validate"])
+app.include_router(dataset_router, prefix="/dataset", tags=["datasets"],
+                   dependencies=[Depends(statement_timeout_group("dataset"))])
+app.include_router(validate_router, prefix="/validate", tags=["validate"],
+                   dependencies=[Depends(statement_timeout_group("validate"))])
+
+if ENABLED_METRICS:
+    app.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
+
+# startup work running in the background, referenced until done
+_startup_tasks = set()
+
+
 @app.on_event("startup")
 async def startup_event():
-    pass
+    # pick up state deletions that were interrupted by a restart (or abandoned by a crashed pod), claimed by
+    # one worker each
+    task = asyncio.create_task(state_deletion_manager.watch_pending())
+    _startup_tasks.add(task)
+    task.add_done_callback(_startup_tasks.discard)
+
     # connect_routes = [
     #     "processor/state/router",
     #     "processor/state/sync",
@@ -100,3 +143,4 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     await message_router.disconnect()
+    execution_lanes.shutdown()
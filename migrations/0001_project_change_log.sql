@@ -0,0 +1,204 @@
+-- Change log of the workflow graph of projects (nodes, edges, processors, states and routes), polled by the studio
+-- for changes since the version of its snapshot.
+--
+-- Changes are recorded by triggers, in the transaction of the write itself (whichever service writes), and are
+-- versioned by a counter row per project. The counter row stays locked until the writing transaction ends, such
+-- that versions become visible in order, a poller never skips a version that commits late.
+
+CREATE TABLE IF NOT EXISTS project_change_log (
+    project_id VARCHAR(36) NOT NULL,
+    version BIGINT NOT NULL,
+    entity_type VARCHAR(32) NOT NULL,
+    entity_id VARCHAR(255) NOT NULL,
+    operation VARCHAR(16) NOT NULL,
+    changed_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- version 0 is the baseline of the entities that existed before the log, any number of them
+CREATE UNIQUE INDEX IF NOT EXISTS project_change_log_version_idx
+    ON project_change_log (project_id, version) WHERE version > 0;
+CREATE INDEX IF NOT EXISTS project_change_log_entity_idx
+    ON project_change_log (project_id, entity_type, entity_id, version);
+
+CREATE TABLE IF NOT EXISTS project_change_version (
+    project_id VARCHAR(36) PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+-- baseline of the graph as it is, such that entities not logged yet are reported as existing (not as inserts)
+INSERT INTO project_change_log (project_id, version, entity_type, entity_id, operation)
+SELECT e.project_id, 0, e.entity_type, e.entity_id, 'upsert'
+  FROM (SELECT n.project_id, 'node' AS entity_type, n.node_id AS entity_id FROM workflow_node n
+        UNION ALL
+        SELECT n.project_id, 'edge', e.source_node_id || ':' || e.target_node_id
+          FROM workflow_edge e JOIN workflow_node n ON n.node_id = e.source_node_id
+        UNION ALL
+        SELECT p.project_id, 'processor', p.id FROM processor p
+        UNION ALL
+        SELECT s.project_id, 'state', s.id FROM state s
+        UNION ALL
+        SELECT s.project_id, 'route', ps.id FROM processor_state ps JOIN state s ON s.id = ps.state_id
+         WHERE ps.id IS NOT NULL) e
+ WHERE e.project_id IS NOT NULL
+   AND NOT EXISTS (SELECT 1 FROM project_change_log l
+                    WHERE l.project_id = e.project_id
+                      AND l.entity_type = e.entity_type
+                      AND l.entity_id = e.entity_id);
+
+CREATE OR REPLACE FUNCTION record_project_change(change_project_id VARCHAR, change_entity_type VARCHAR,
+                                                 change_entity_id VARCHAR, change_operation VARCHAR)
+    RETURNS BIGINT LANGUAGE plpgsql AS $$
+DECLARE
+    next_version BIGINT;
+BEGIN
+    IF change_project_id IS NULL OR change_entity_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO project_change_version AS c (project_id, version) VALUES (change_project_id, 1)
+        ON CONFLICT (project_id) DO UPDATE SET version = c.version + 1
+        RETURNING c.version INTO next_version;
+
+    INSERT INTO project_change_log (project_id, version, entity_type, entity_id, operation)
+        VALUES (change_project_id, next_version, change_entity_type, change_entity_id, change_operation);
+    RETURN next_version;
+END $$;
+
+-- entities with a project_id column, TG_ARGV: entity type, id column
+CREATE OR REPLACE FUNCTION project_change_of_entity() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    entity JSONB;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        entity := to_jsonb(OLD);
+    ELSE
+        entity := to_jsonb(NEW);
+    END IF;
+
+    PERFORM record_project_change(entity ->> 'project_id', TG_ARGV[0], entity ->> TG_ARGV[1],
+                                  CASE WHEN TG_OP = 'DELETE' THEN 'delete' ELSE 'upsert' END);
+    RETURN NULL;
+END $$;
+
+-- edges by either of their nodes, the other one may be deleted along in the same statement
+CREATE OR REPLACE FUNCTION project_change_of_edge() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    edge workflow_edge;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        edge := OLD;
+    ELSE
+        edge := NEW;
+    END IF;
+
+    PERFORM record_project_change(
+        (SELECT project_id FROM workflow_node WHERE node_id IN (edge.source_node_id, edge.target_node_id) LIMIT 1),
+        'edge', edge.source_node_id || ':' || edge.target_node_id,
+        CASE WHEN TG_OP = 'DELETE' THEN 'delete' ELSE 'upsert' END);
+    RETURN NULL;
+END $$;
+
+-- routes by their state, or processor when the state is deleted along
+CREATE OR REPLACE FUNCTION project_change_of_route() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    route processor_state;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        route := OLD;
+    ELSE
+        route := NEW;
+    END IF;
+
+    PERFORM record_project_change(
+        COALESCE((SELECT project_id FROM state WHERE id = route.state_id),
+                 (SELECT project_id FROM processor WHERE id = route.processor_id)),
+        'route', route.id,
+        CASE WHEN TG_OP = 'DELETE' THEN 'delete' ELSE 'upsert' END);
+    RETURN NULL;
+END $$;
+
+-- the configuration, key definitions and columns of a state are changes of the state
+CREATE OR REPLACE FUNCTION project_change_of_state_part() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    part_state_id VARCHAR;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        part_state_id := OLD.state_id;
+    ELSE
+        part_state_id := NEW.state_id;
+    END IF;
+
+    PERFORM record_project_change((SELECT project_id FROM state WHERE id = part_state_id),
+                                  'state', part_state_id, 'upsert');
+    RETURN NULL;
+END $$;
+
+-- updates of runtime fields (state count and deletion progress, route progress) are not changes,
+-- rows without an id (routes of earlier versions) are not recorded
+DROP TRIGGER IF EXISTS project_change ON workflow_node;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON workflow_node
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_entity('node', 'node_id');
+DROP TRIGGER IF EXISTS project_change_update ON workflow_node;
+CREATE TRIGGER project_change_update AFTER UPDATE ON workflow_node
+    FOR EACH ROW WHEN (to_jsonb(OLD) IS DISTINCT FROM to_jsonb(NEW))
+    EXECUTE FUNCTION project_change_of_entity('node', 'node_id');
+
+DROP TRIGGER IF EXISTS project_change ON workflow_edge;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON workflow_edge
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_edge();
+DROP TRIGGER IF EXISTS project_change_update ON workflow_edge;
+CREATE TRIGGER project_change_update AFTER UPDATE ON workflow_edge
+    FOR EACH ROW WHEN (to_jsonb(OLD) IS DISTINCT FROM to_jsonb(NEW))
+    EXECUTE FUNCTION project_change_of_edge();
+
+DROP TRIGGER IF EXISTS project_change ON processor;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON processor
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_entity('processor', 'id');
+DROP TRIGGER IF EXISTS project_change_update ON processor;
+CREATE TRIGGER project_change_update AFTER UPDATE ON processor
+    FOR EACH ROW WHEN (to_jsonb(OLD) IS DISTINCT FROM to_jsonb(NEW))
+    EXECUTE FUNCTION project_change_of_entity('processor', 'id');
+
+DROP TRIGGER IF EXISTS project_change ON state;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON state
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_entity('state', 'id');
+DROP TRIGGER IF EXISTS project_change_update ON state;
+CREATE TRIGGER project_change_update AFTER UPDATE ON state
+    FOR EACH ROW WHEN (OLD.state_type IS DISTINCT FROM NEW.state_type
+                       OR OLD.properties::jsonb IS DISTINCT FROM NEW.properties::jsonb
+                       OR OLD.project_id IS DISTINCT FROM NEW.project_id)
+    EXECUTE FUNCTION project_change_of_entity('state', 'id');
+
+DROP TRIGGER IF EXISTS project_change ON state_config;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON state_config
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_state_part();
+DROP TRIGGER IF EXISTS project_change_update ON state_config;
+CREATE TRIGGER project_change_update AFTER UPDATE ON state_config
+    FOR EACH ROW WHEN (to_jsonb(OLD) IS DISTINCT FROM to_jsonb(NEW))
+    EXECUTE FUNCTION project_change_of_state_part();
+
+DROP TRIGGER IF EXISTS project_change ON state_column_key_definition;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON state_column_key_definition
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_state_part();
+DROP TRIGGER IF EXISTS project_change_update ON state_column_key_definition;
+CREATE TRIGGER project_change_update AFTER UPDATE ON state_column_key_definition
+    FOR EACH ROW WHEN (to_jsonb(OLD) IS DISTINCT FROM to_jsonb(NEW))
+    EXECUTE FUNCTION project_change_of_state_part();
+
+DROP TRIGGER IF EXISTS project_change ON state_column;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON state_column
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_state_part();
+DROP TRIGGER IF EXISTS project_change_update ON state_column;
+CREATE TRIGGER project_change_update AFTER UPDATE ON state_column
+    FOR EACH ROW WHEN (to_jsonb(OLD) IS DISTINCT FROM to_jsonb(NEW))
+    EXECUTE FUNCTION project_change_of_state_part();
+
+DROP TRIGGER IF EXISTS project_change ON processor_state;
+CREATE TRIGGER project_change AFTER INSERT OR DELETE ON processor_state
+    FOR EACH ROW EXECUTE FUNCTION project_change_of_route();
+DROP TRIGGER IF EXISTS project_change_update ON processor_state;
+CREATE TRIGGER project_change_update AFTER UPDATE ON processor_state
+    FOR EACH ROW WHEN (NEW.id IS NOT NULL
+                       AND (OLD.id IS DISTINCT FROM NEW.id
+                            OR OLD.edge_function::text IS DISTINCT FROM NEW.edge_function::text))
+    EXECUTE FUNCTION project_change_of_route();
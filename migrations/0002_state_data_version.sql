@@ -0,0 +1,58 @@
+-- Data version of states, for caches of artifacts derived from the state data (exports, parquet shards).
+--
+-- The version is bumped by triggers in the transaction of every write of the data or columns of a state, whichever
+-- service writes (a write of the same state count, or an in place update of values, still changes the version).
+-- It is shared by the hosts, a cache keyed by it misses on every host once the write commits.
+--
+-- The version row is locked until the write commits, writes of the data that also update the state row must lock
+-- the version row first (as the triggers do before the state count is updated), such that they cannot deadlock.
+
+CREATE TABLE IF NOT EXISTS state_data_version (
+    state_id VARCHAR(36) PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+-- states in id order, such that statements writing several states lock their version rows in the same order
+CREATE OR REPLACE FUNCTION bump_state_data_version(version_state_ids VARCHAR[]) RETURNS VOID LANGUAGE sql AS $$
+    INSERT INTO state_data_version AS v (state_id, version)
+    SELECT DISTINCT state_id, 1 FROM unnest(version_state_ids) AS state_id
+     WHERE state_id IS NOT NULL
+     ORDER BY state_id
+        ON CONFLICT (state_id) DO UPDATE SET version = v.version + 1;
+$$;
+
+-- once per statement, by the columns of the rows written (a bulk COPY bumps each of its states once)
+CREATE OR REPLACE FUNCTION state_data_version_of_data() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM bump_state_data_version(ARRAY(
+        SELECT DISTINCT c.state_id::VARCHAR FROM changed_data d JOIN state_column c ON c.id = d.column_id));
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION state_data_version_of_column() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM bump_state_data_version(ARRAY[OLD.state_id::VARCHAR]);
+    ELSE
+        PERFORM bump_state_data_version(ARRAY[NEW.state_id::VARCHAR]);
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- transition tables are per event
+DROP TRIGGER IF EXISTS state_data_version_insert ON state_column_data;
+CREATE TRIGGER state_data_version_insert AFTER INSERT ON state_column_data
+    REFERENCING NEW TABLE AS changed_data
+    FOR EACH STATEMENT EXECUTE FUNCTION state_data_version_of_data();
+DROP TRIGGER IF EXISTS state_data_version_update ON state_column_data;
+CREATE TRIGGER state_data_version_update AFTER UPDATE ON state_column_data
+    REFERENCING NEW TABLE AS changed_data
+    FOR EACH STATEMENT EXECUTE FUNCTION state_data_version_of_data();
+DROP TRIGGER IF EXISTS state_data_version_delete ON state_column_data;
+CREATE TRIGGER state_data_version_delete AFTER DELETE ON state_column_data
+    REFERENCING OLD TABLE AS changed_data
+    FOR EACH STATEMENT EXECUTE FUNCTION state_data_version_of_data();
+
+DROP TRIGGER IF EXISTS state_data_version ON state_column;
+CREATE TRIGGER state_data_version AFTER INSERT OR UPDATE OR DELETE ON state_column
+    FOR EACH ROW EXECUTE FUNCTION state_data_version_of_column();
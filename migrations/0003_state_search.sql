@@ -0,0 +1,69 @@
+-- Full text search of state data (see db/state_search_storage.py).
+--
+-- The text search vector of every value of a text (or json) column is stored, such that searches match it through
+-- a GIN index and rank the hits without computing their vectors again. Vectors are written by triggers in the
+-- transaction of every write of the data or of the type of a column, whichever service writes. Numeric and bool
+-- columns are not searched and have no vectors.
+--
+-- The triggers, the vectors of the existing data and their index are opt-in, a cost of every write of state data:
+-- they are installed by `python -m db.state_search_index enable` (and removed by disable), this only defines them.
+--
+-- The text search configuration and the indexed prefix of values are those of the queries (SEARCH_CONFIG and
+-- SEARCH_MAX_CHARS of the storage), changing either takes a migration recomputing the vectors.
+
+CREATE TABLE IF NOT EXISTS state_column_data_search (
+    column_id INT NOT NULL,
+    data_index INT NOT NULL,
+    search_vector TSVECTOR NOT NULL,
+    PRIMARY KEY (column_id, data_index)
+);
+
+-- longer values are searched by their prefix, a tsvector is limited to 1MB
+CREATE OR REPLACE FUNCTION state_search_vector(data_value TEXT, data_json_value JSONB) RETURNS TSVECTOR
+    LANGUAGE sql IMMUTABLE AS $$
+    SELECT to_tsvector('simple'::regconfig, left(COALESCE(data_value, data_json_value::text), 100000));
+$$;
+
+CREATE OR REPLACE FUNCTION state_search_searchable(data_type VARCHAR) RETURNS BOOLEAN
+    LANGUAGE sql IMMUTABLE AS $$
+    SELECT data_type IS NULL OR data_type NOT IN ('int', 'float', 'bool');
+$$;
+
+-- once per statement, the vectors of the rows written replace those of the rows they were (a bulk COPY computes
+-- the vectors of its rows in one insert)
+CREATE OR REPLACE FUNCTION state_search_of_data() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM state_column_data_search v
+         USING previous_data d
+         WHERE v.column_id = d.column_id AND v.data_index = d.data_index;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO state_column_data_search (column_id, data_index, search_vector)
+        SELECT d.column_id, d.data_index, state_search_vector(d.data_value, d.data_json_value)
+          FROM changed_data d
+          JOIN state_column c ON c.id = d.column_id
+         WHERE state_search_searchable(c.data_type)
+           AND COALESCE(d.data_value, d.data_json_value::text) IS NOT NULL
+            ON CONFLICT (column_id, data_index) DO UPDATE SET search_vector = EXCLUDED.search_vector;
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- a column changing between a searchable and a numeric type gets or drops the vectors of its values
+CREATE OR REPLACE FUNCTION state_search_of_column() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF state_search_searchable(OLD.data_type) = state_search_searchable(NEW.data_type) THEN
+        RETURN NULL;
+    END IF;
+
+    DELETE FROM state_column_data_search WHERE column_id = NEW.id;
+    IF state_search_searchable(NEW.data_type) THEN
+        INSERT INTO state_column_data_search (column_id, data_index, search_vector)
+        SELECT d.column_id, d.data_index, state_search_vector(d.data_value, d.data_json_value)
+          FROM state_column_data d
+         WHERE d.column_id = NEW.id
+           AND COALESCE(d.data_value, d.data_json_value::text) IS NOT NULL;
+    END IF;
+    RETURN NULL;
+END $$;
@@ -0,0 +1,21 @@
+-- Tombstones of the states whose data is being deleted in the background (see db/state_deletion_storage.py).
+--
+-- Kept apart from the state row, which saves of the state (merges, pipelines) write as a whole. The row of a
+-- deletion is the record of what was left to do for a deletion interrupted by a restart, and the claim of the
+-- worker running it (its owner, holding it while its heartbeat is within the lease).
+
+CREATE TABLE IF NOT EXISTS state_deletion (
+    state_id VARCHAR(36) PRIMARY KEY,
+    status VARCHAR(16) NOT NULL,
+    purge BOOLEAN NOT NULL DEFAULT FALSE,
+    total BIGINT NOT NULL DEFAULT 0,
+    deleted BIGINT NOT NULL DEFAULT 0,
+    started_date TIMESTAMP,
+    finished_date TIMESTAMP,
+    error TEXT,
+    owner VARCHAR(255),
+    heartbeat TIMESTAMPTZ
+);
+
+-- the deletions to resume
+CREATE INDEX IF NOT EXISTS state_deletion_status_idx ON state_deletion (status) WHERE status IN ('PENDING', 'RUNNING');
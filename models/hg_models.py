@@ -1,6 +1,8 @@
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from utils.parquet_shards import PARQUET_COMPRESSIONS
 
 
 class ImportHgDatasetRequest(BaseModel):
@@ -9,6 +11,7 @@ class ImportHgDatasetRequest(BaseModel):
     split: str = "train"
     revision: str | None = None
     vaultKeyId: str | None = None
+    deduplicate: bool = True  # skip rows whose primary key is repeated or already in the state
 
 
 class ExportHgDatasetRequest(BaseModel):
@@ -18,4 +21,9 @@ class ExportHgDatasetRequest(BaseModel):
     commit_message: str | None = None
     revision: str | None = None
     vaultKeyId: str | None = None
-    chunk_size: int = 5000
\ No newline at end of file
+    chunk_size: int = 5000
+    shard_rows: int | None = Field(None, ge=1)  # rows per shard, else shards are sized by shard_bytes
+    shard_bytes: int = Field(256 * 1024 * 1024, ge=1024 * 1024)
+    row_group_size: int = Field(100_000, ge=1000)
+    compression: str = Field("zstd", pattern=f"^({'|'.join(PARQUET_COMPRESSIONS)})$")
+    full: bool = False  # rewrite every row rather than append the rows added since the last push
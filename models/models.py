@@ -1,7 +1,7 @@
-from typing import Optional
+from typing import Optional, List, Dict, Literal, Union, Annotated
 
-from ismcore.model.base_model import ProcessorStatusCode
-from pydantic import BaseModel
+from ismcore.model.base_model import ProcessorStatusCode, WorkflowNode, WorkflowEdge, Processor, ProcessorState
+from pydantic import BaseModel, Field
 
 
 class WorkflowEdgeDelete(BaseModel):
@@ -22,4 +22,67 @@ class UserProfileCreateRequest(BaseModel):
 class BasicResponse(BaseModel):
     success: bool
     message: Optional[str] = None
-    data: Optional[dict] = None
\ No newline at end of file
+    data: Optional[dict] = None
+
+
+class CreateNodeOperation(BaseModel):
+    op: Literal["create_node"] = "create_node"
+    node: WorkflowNode
+
+
+class DeleteNodeOperation(BaseModel):
+    op: Literal["delete_node"] = "delete_node"
+    node_id: str
+
+
+class CreateEdgeOperation(BaseModel):
+    op: Literal["create_edge"] = "create_edge"
+    edge: WorkflowEdge
+
+
+class DeleteEdgeOperation(BaseModel):
+    op: Literal["delete_edge"] = "delete_edge"
+    source_node_id: str
+    target_node_id: str
+
+
+class CreateProcessorOperation(BaseModel):
+    op: Literal["create_processor"] = "create_processor"
+    processor: Processor
+
+
+class DeleteProcessorOperation(BaseModel):
+    op: Literal["delete_processor"] = "delete_processor"
+    processor_id: str
+
+
+class CreateRouteOperation(BaseModel):
+    op: Literal["create_route"] = "create_route"
+    route: ProcessorState
+
+
+class DeleteRouteOperation(BaseModel):
+    op: Literal["delete_route"] = "delete_route"
+    route_id: str
+
+
+WorkflowBatchOperation = Annotated[Union[
+    CreateNodeOperation, DeleteNodeOperation,
+    CreateEdgeOperation, DeleteEdgeOperation,
+    CreateProcessorOperation, DeleteProcessorOperation,
+    CreateRouteOperation, DeleteRouteOperation,
+], Field(discriminator="op")]
+
+
+class WorkflowBatchRequest(BaseModel):
+    project_id: str
+    operations: List[WorkflowBatchOperation]
+
+
+class WorkflowBatchResult(BaseModel):
+    nodes: List[WorkflowNode] = []
+    edges: List[WorkflowEdge] = []
+    processors: List[Processor] = []
+    routes: List[ProcessorState] = []
+    deleted: Dict[str, List[str]] = {}
+    change_version: Optional[int] = None
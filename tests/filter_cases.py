@@ -0,0 +1,57 @@
+"""
+The cases the evaluations of filters outside of the filter model (the SQL compiler and the batch filter) are
+checked against Filter.apply_filter_on_data with, over rows of their own.
+"""
+import itertools
+from typing import Callable, Dict, List
+
+from ismcore.model.filter import Filter, FilterItem, FilterOperator
+
+KEYS = ["text", "number", "doc", "doc.name", "doc.size", "doc.tags", "missing", "text.nested"]
+
+VALUES = [
+    ("apple", None), ("5", None), (5, None), (12.5, None), ("b", None), ("red", None), ("%_", None),
+    (True, None), (False, None), (" 5", None), ("true", None),
+    ("9007199254740992", None), (9007199254740993, None),
+    ("a", "c"), (0, 10), (True, 7), ("1", "6"), ("a", 10), (1, "z"), (None, None), ("^[a-c]", None),
+    (9007199254740992, 9007199254740993),
+    (["apple", "5", "red"], None), ([5, 12.5, "5"], None), ([None, "apple"], None), ([], None),
+    ([9007199254740993], None),
+]
+
+OPERATORS = [operator for operator in FilterOperator]
+
+
+def expected_match(item: FilterItem, row: dict) -> bool:
+    # the filter model raises on values it cannot compare (e.g. a string and a number), which match nothing
+    try:
+        return Filter(filter_items={item.key: item}).apply_filter_on_data(row)
+    except TypeError:
+        return False
+
+
+def filter_cases():
+    for key, (value, secondary_value), operator in itertools.product(KEYS, VALUES, OPERATORS):
+        # lists are the values of the collection operators only
+        if (operator in (FilterOperator.IN, FilterOperator.NOT_IN)) != isinstance(value, list):
+            continue
+        if secondary_value is not None and operator not in (FilterOperator.BETWEEN, FilterOperator.NOT_BETWEEN):
+            continue
+        yield FilterItem(key=key, operator=operator, value=value, secondary_value=secondary_value)
+
+
+def mismatches(rows: List[Dict], matches: Callable[[FilterItem], List[int]]) -> List[str]:
+    """The cases of which the data indexes matched differ from those the filter model matches."""
+    found = []
+    for item in filter_cases():
+        try:
+            matched = matches(item)
+        except ValueError:
+            # rejected filters (e.g. invalid regular expressions)
+            continue
+
+        expected = [data_index for data_index, row in enumerate(rows) if expected_match(item, row)]
+        if matched != expected:
+            found.append(f"{item.key} {item.operator.value} {item.value!r} {item.secondary_value!r}: "
+                         f"{matched} != {expected}")
+    return found
@@ -0,0 +1,70 @@
+import os
+
+from utils.artifact_cache import ArtifactCache
+
+
+def _cache(tmp_path, versions, max_bytes=1024):
+    return ArtifactCache(cache_dir=str(tmp_path / "cache"), max_bytes=max_bytes,
+                         version_loader=lambda state_id: versions[state_id],
+                         version_bumper=lambda state_id: versions.__setitem__(state_id, versions[state_id] + 1))
+
+
+def _artifact(tmp_path, name, content=b"data"):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_artifacts_are_keyed_by_the_data_version(tmp_path):
+    versions = {"s1": 3}
+    cache = _cache(tmp_path, versions)
+
+    key = cache.key("s1", cache.data_version("s1"), "xlsx")
+    assert cache.checkout(key) is None
+
+    source = _artifact(tmp_path, "export.xlsx")
+    cache.put(key, source)
+    assert os.path.exists(source)  # the source remains the caller's
+
+    checkout = cache.checkout(key)
+    assert open(checkout, "rb").read() == b"data"
+    assert cache.key("s1", cache.data_version("s1"), "xlsx", variant="other") != key
+
+    # a write elsewhere bumps the version, the artifact is not found by its new key
+    versions["s1"] += 1
+    assert cache.checkout(cache.key("s1", cache.data_version("s1"), "xlsx")) is None
+
+
+def test_checkouts_survive_eviction(tmp_path):
+    cache = _cache(tmp_path, {"s1": 1, "s2": 1}, max_bytes=6)
+    key = cache.key("s1", 1, "xlsx")
+    cache.put(key, _artifact(tmp_path, "a.xlsx", b"first"))
+    checkout = cache.checkout(key, directory=str(tmp_path))
+
+    # s1 is evicted by the artifact of s2, the checkout is still readable
+    cache.put(cache.key("s2", 1, "xlsx"), _artifact(tmp_path, "b.xlsx", b"second"))
+    assert not os.path.exists(key)
+    assert cache.checkout(key) is None
+    assert open(checkout, "rb").read() == b"first"
+
+
+def test_invalidate_bumps_the_version(tmp_path):
+    versions = {"s1": 1}
+    cache = _cache(tmp_path, versions)
+    key = cache.key("s1", 1, "xlsx")
+    cache.put(key, _artifact(tmp_path, "a.xlsx"))
+
+    cache.invalidate("s1")
+    assert versions["s1"] == 2
+    assert not os.path.exists(key)
+
+
+def test_unknown_versions_are_not_cached(tmp_path):
+    def _fail(state_id):
+        raise RuntimeError("no state_data_version table")
+
+    cache = ArtifactCache(cache_dir=str(tmp_path / "cache"), max_bytes=1024, version_loader=_fail)
+    assert cache.data_version("s1") is None
+    assert cache.key("s1", None, "xlsx") is None
+    cache.put(None, _artifact(tmp_path, "a.xlsx"))
+    assert os.listdir(tmp_path / "cache") == []
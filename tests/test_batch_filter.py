@@ -0,0 +1,51 @@
+import pyarrow as pa
+import pytest
+from ismcore.model.filter import Filter, FilterItem, FilterOperator
+
+from filter_cases import mismatches
+from utils.batch_filter import ColumnVectors, compile_filter, rows_to_vectors
+
+# rows of every kind of value, a missing key is a row without a value
+ROWS = [
+    {"text": "apple", "number": 5, "doc": {"name": "apple", "size": 5, "tags": ["red", "fruit"]}},
+    {"text": "Banana", "number": 12.5, "doc": {"name": "banana", "size": 12.5, "tags": ["yellow"]}},
+    {"text": "cherry pie", "number": "-3", "doc": {"name": "cherry", "tags": []}},
+    {"text": "5", "number": "abc", "doc": {"name": "5", "size": "7"}},
+    {"text": "50%_off", "number": " .5 ", "doc": ["red", 5]},
+    {"text": None, "number": True, "doc": "plain text"},
+    {"text": "Zebra", "number": None},
+    {"text": "9007199254740993", "number": 9007199254740993, "doc": {"size": " 9007199254740993 "}},
+    {"text": "true", "number": 9007199254740992, "doc": {"name": True, "size": -9007199254740993}},
+    {},
+]
+
+
+@pytest.mark.parametrize("data_value, matches", [
+    (5, False), (0, False), (11, True), (-1, True), ("12", True), ("x", False), (None, False), ([1], False),
+])
+def test_not_between_matches_comparable_values_only(data_value, matches):
+    compiled = compile_filter(Filter(filter_items={
+        "value": FilterItem(key="value", operator=FilterOperator.NOT_BETWEEN, value=0, secondary_value=10)}))
+
+    mask, _ = compiled.evaluate(rows_to_vectors(compiled, [{"value": data_value}]), 1)
+    assert mask.to_pylist() == [matches]
+
+
+def test_integers_beyond_float_precision_compare_exactly():
+    compiled = compile_filter(Filter(filter_items={
+        "id": FilterItem(key="id", operator=FilterOperator.EQ, value="9007199254740992")}))
+    table = pa.table({"id": pa.array([9007199254740992, 9007199254740993], type=pa.int64())})
+
+    mask, _ = compiled.evaluate({"id": ColumnVectors.from_arrow(table.column("id"))}, table.num_rows)
+    assert mask.to_pylist() == [True, False]
+
+
+def _matches(item: FilterItem):
+    compiled = compile_filter(Filter(filter_items={item.key: item}))
+    mask, _ = compiled.evaluate(rows_to_vectors(compiled, ROWS), len(ROWS))
+    return [data_index for data_index, matches in enumerate(mask.to_pylist()) if matches]
+
+
+def test_compiled_filters_match_the_filter_model():
+    found = mismatches(ROWS, _matches)
+    assert not found, "\n".join(found)
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from utils import envelope
+from utils.envelope import (COMPRESSION_ZSTD, ENCODING_ARROW, ENCODING_JSON, ENCODING_MSGPACK,
+                            decode_state_sync_message, encode_state_sync_message)
+
+# rows of scalar, mixed and nested values, the second row lacks a column
+ROWS = [
+    {"id": 1, "name": "apple", "score": 0.5, "ok": True, "mixed": "a", "doc": {"tags": ["red"]}},
+    {"id": 2, "score": None, "ok": False, "mixed": 2, "doc": [1, {"x": None}]},
+    {"id": 9007199254740993, "name": "cherry pie", "score": -1.25, "ok": None, "mixed": None, "doc": None},
+]
+
+COMPRESSIONS = [
+    None,
+    pytest.param(COMPRESSION_ZSTD, marks=pytest.mark.skipif(envelope.zstandard is None,
+                                                            reason="zstandard is not installed")),
+]
+
+
+def _columnar(rows):
+    # the columnar layout carries every column for every row, None where a row lacks it
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    return [{name: row.get(name) for name in names} for row in rows]
+
+
+def test_plain_json_messages_carry_the_rows():
+    message = json.loads(encode_state_sync_message("s1", ROWS))
+
+    assert "envelope" not in message
+    assert message["query_state"] == ROWS
+    assert decode_state_sync_message(message) == ROWS
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+@pytest.mark.parametrize("encoding", [ENCODING_JSON, ENCODING_MSGPACK, ENCODING_ARROW])
+def test_enveloped_messages_round_trip(encoding, compression):
+    text = encode_state_sync_message("s1", ROWS, encoding=encoding, compression=compression)
+    message = json.loads(text)
+
+    if encoding != ENCODING_JSON or compression:
+        assert message["envelope"]["encoding"] == encoding
+        assert message["envelope"]["compression"] == compression
+        assert message["envelope"]["count"] == len(ROWS)
+
+    assert message["state_id"] == "s1"
+    expected = _columnar(ROWS) if "envelope" in message else ROWS
+    assert decode_state_sync_message(message) == expected
+
+
+@pytest.mark.parametrize("encoding", [ENCODING_MSGPACK, ENCODING_ARROW])
+def test_empty_batches_round_trip(encoding):
+    message = json.loads(encode_state_sync_message("s1", [], encoding=encoding))
+    assert decode_state_sync_message(message) == []
+
+
+def test_unknown_envelope_versions_are_rejected():
+    message = json.loads(encode_state_sync_message("s1", ROWS, encoding=ENCODING_MSGPACK))
+    message["envelope"]["version"] = envelope.ENVELOPE_VERSION + 1
+
+    with pytest.raises(ValueError):
+        decode_state_sync_message(message)
@@ -0,0 +1,110 @@
+import datetime as dt
+
+import pyarrow as pa
+import pytest
+
+from utils.parquet_schema import ParquetColumnTypeError, columns_to_table, derive_parquet_schema, \
+    deserialize_schema, serialize_schema, text_columns_of
+
+
+def _types(schema: pa.Schema) -> dict:
+    return {field.name: field.type for field in schema}
+
+
+def test_scalar_columns_get_native_types():
+    schema, _ = derive_parquet_schema(
+        column_types={"n": "int", "x": "float", "b": "bool", "t": "datetime", "d": "date", "s": "str"},
+        sample={"n": [1, "2"], "x": [1.5, 2], "b": [True, "no"], "t": ["2024-01-02T03:04:05"],
+                "d": ["2024-01-02"], "s": ["a", "b"]})
+
+    assert _types(schema) == {"n": pa.int64(), "x": pa.float64(), "b": pa.bool_(), "t": pa.timestamp("us"),
+                              "d": pa.date32(), "s": pa.string()}
+
+
+def test_mixed_scalar_values_are_text():
+    schema, _ = derive_parquet_schema(column_types={"n": "int", "x": "float", "b": "bool"},
+                                      sample={"n": [1, "one"], "x": [True], "b": ["maybe"]})
+
+    assert _types(schema) == {"n": pa.string(), "x": pa.string(), "b": pa.string()}
+
+
+def test_columns_without_sample_values_keep_their_type():
+    schema, dictionary_columns = derive_parquet_schema(column_types={"n": "int", "j": "json", "s": None},
+                                                       sample={"n": [None, None]})
+
+    assert _types(schema) == {"n": pa.int64(), "j": pa.string(), "s": pa.string()}
+    assert dictionary_columns == []
+
+
+def test_json_columns_get_nested_types():
+    schema, _ = derive_parquet_schema(
+        column_types={"obj": "json", "items": "json"},
+        sample={"obj": [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}], "items": [[1, 2], [3]]})
+
+    assert _types(schema) == {"obj": pa.struct([("a", pa.int64()), ("b", pa.string())]),
+                              "items": pa.list_(pa.int64())}
+
+
+@pytest.mark.parametrize("values", [
+    [{"a": 1}, [1]],  # dicts and lists
+    [{"a": 1}, "text"],  # json and plain values
+    [{"a": []}],  # null typed children
+    [{}],
+    [[1, "a"]],  # no common type
+    [{"a": 1}, {"a": "x"}],
+])
+def test_mixed_json_values_are_text(values):
+    schema, _ = derive_parquet_schema(column_types={"j": "json"}, sample={"j": values})
+    assert schema.field("j").type == pa.string()
+
+
+def test_text_columns_are_text():
+    schema, _ = derive_parquet_schema(column_types={"n": "int", "j": "json"},
+                                      sample={"n": [1, 2], "j": [{"a": 1}]},
+                                      text_columns={"n", "j"})
+
+    assert _types(schema) == {"n": pa.string(), "j": pa.string()}
+
+
+def test_low_cardinality_text_columns_are_dictionary_encoded():
+    _, dictionary_columns = derive_parquet_schema(
+        column_types={"label": "str", "text": "str", "n": "int", "mixed": "int"},
+        sample={"label": ["a", "b", "a", "b"], "text": ["a", "b", "c", "d"], "n": [1, 1, 1, 1],
+                "mixed": [1, "x", 1, "x"]})
+
+    assert dictionary_columns == ["label", "mixed"]
+
+
+def test_sample_rows_convert_to_the_schema():
+    sample = {"n": [1, "2", None], "t": ["2024-01-02T03:04:05", dt.datetime(2024, 1, 3), None],
+              "obj": [{"a": 1}, None, {"a": 2}], "s": ["x", {"k": 1}, None]}
+    schema, _ = derive_parquet_schema(column_types={"n": "int", "t": "datetime", "obj": "json", "s": "str"},
+                                      sample=sample)
+
+    table = columns_to_table(sample, schema=schema, num_rows=3)
+    assert table.column("n").to_pylist() == [1, 2, None]
+    assert table.column("t").to_pylist() == [dt.datetime(2024, 1, 2, 3, 4, 5), dt.datetime(2024, 1, 3), None]
+    assert table.column("obj").to_pylist() == [{"a": 1}, None, {"a": 2}]
+    assert table.column("s").to_pylist() == ["x", '{"k": 1}', None]
+
+
+def test_values_beyond_the_sample_raise_the_column_type_error():
+    schema, _ = derive_parquet_schema(column_types={"n": "int", "obj": "json"},
+                                      sample={"n": [1], "obj": [{"a": 1}]})
+
+    with pytest.raises(ParquetColumnTypeError) as error:
+        columns_to_table({"n": [2, "two"]}, schema=schema, num_rows=2)
+    assert error.value.column == "n"
+
+    with pytest.raises(ParquetColumnTypeError) as error:
+        columns_to_table({"obj": [{"a": 1, "b": 2}]}, schema=schema, num_rows=1)
+    assert error.value.column == "obj"
+
+    assert text_columns_of([error.value, ValueError("other"), None]) == {"obj"}
+
+
+def test_schema_round_trips():
+    schema, _ = derive_parquet_schema(column_types={"n": "int", "obj": "json"},
+                                      sample={"n": [1], "obj": [{"a": [1.5]}]})
+
+    assert deserialize_schema(serialize_schema(schema)) == schema
@@ -0,0 +1,64 @@
+import pyarrow as pa
+
+from utils.parquet_shards import estimate_shard_rows, is_shard_path, plan_shards, shard_path_in_repo
+
+
+def test_plan_shards_covers_rows_without_overlap():
+    assert plan_shards(10, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert plan_shards(8, 4) == [(0, 4), (4, 8)]
+
+
+def test_plan_shards_unbounded_is_a_single_shard():
+    assert plan_shards(10, 0) == [(0, 10)]
+    assert plan_shards(10, 10) == [(0, 10)]
+    assert plan_shards(10, 25) == [(0, 10)]
+
+
+def test_plan_shards_from_start_row():
+    assert plan_shards(10, 4, start=3) == [(3, 7), (7, 10)]
+    assert plan_shards(10, 0, start=3) == [(3, 10)]
+
+
+def test_plan_shards_without_rows_is_an_empty_shard():
+    assert plan_shards(0, 4) == [(0, 0)]
+    assert plan_shards(5, 4, start=5) == [(5, 5)]
+    assert plan_shards(5, 4, start=7) == [(7, 7)]
+
+
+def test_plan_shards_ranges_are_contiguous():
+    for count in range(1, 40):
+        for shard_rows in range(1, 12):
+            for start in (0, 1, 5):
+                shards = plan_shards(count, shard_rows, start=start)
+                if count <= start:
+                    continue
+                assert shards[0][0] == start and shards[-1][1] == count
+                assert all(end == next_start for (_, end), (next_start, _) in zip(shards, shards[1:]))
+                assert all(0 < end - begin <= shard_rows for begin, end in shards)
+
+
+def test_estimate_shard_rows():
+    sample = pa.table({"value": pa.array(range(100), type=pa.int64())})
+    assert estimate_shard_rows(sample, target_bytes=8000) == 1000
+    assert estimate_shard_rows(sample, target_bytes=1) == 1
+    assert estimate_shard_rows(None, target_bytes=8000) == 0
+    assert estimate_shard_rows(sample.slice(0, 0), target_bytes=8000) == 0
+
+
+def test_shard_path_in_repo():
+    assert shard_path_in_repo("train", 1, 4) == "data/train-00001-of-00004.parquet"
+    # appended shards are kept out of data/ file names, the hub would take the start row as part of the split
+    assert shard_path_in_repo("train", 0, 2, start_row=120000) == "data/train/000000120000-00000-of-00002.parquet"
+
+
+def test_appended_shard_paths_sort_in_row_order():
+    paths = [shard_path_in_repo("train", index, 2, start_row=start) for start in (9, 120000) for index in (0, 1)]
+    assert sorted(paths) == paths
+
+
+def test_is_shard_path():
+    assert is_shard_path(shard_path_in_repo("train", 0, 1), "train")
+    assert is_shard_path(shard_path_in_repo("train", 0, 1, start_row=5), "train")
+    assert not is_shard_path("data/training-00000-of-00001.parquet", "train")
+    assert not is_shard_path("data/train/nested/00000.parquet", "train")
+    assert not is_shard_path("README.md", "train")
@@ -0,0 +1,105 @@
+import json
+import os
+import uuid
+
+import pytest
+from ismcore.model.filter import FilterItem, FilterOperator
+
+from db.state_query_storage import NEGATED_OPERATORS, FilterCompiler, StateColumnRef
+from filter_cases import OPERATORS, mismatches
+
+TEXT = StateColumnRef(id=1, name="text", data_type="str")
+NUMBER = StateColumnRef(id=2, name="number", data_type="float")
+DOC = StateColumnRef(id=3, name="doc", data_type="json")
+COLUMNS = {column.name: column for column in (TEXT, NUMBER, DOC)}
+
+# the values of the rows by column, a missing column is a row without a value
+ROWS = [
+    {"text": "apple", "number": "5", "doc": {"name": "apple", "size": 5, "tags": ["red", "fruit"]}},
+    {"text": "Banana", "number": "12.5", "doc": {"name": "banana", "size": 12.5, "tags": ["yellow"]}},
+    {"text": "cherry pie", "number": "-3", "doc": {"name": "cherry", "tags": []}},
+    {"text": "5", "number": "abc", "doc": {"name": "5", "size": "7"}},
+    {"text": "50%_off", "number": ".5", "doc": ["red", 5]},
+    {"number": "007", "doc": "plain text"},
+    {"text": "Zebra"},
+    {"text": "true", "number": " 7 ", "doc": {"name": True, "size": " 5"}},
+    {"text": "1", "number": "0", "doc": {"name": False, "size": 1}},
+    {"text": "9007199254740993", "number": " 9007199254740993", "doc": {"size": 9007199254740993}},
+    {},
+]
+
+
+@pytest.mark.parametrize("operator", OPERATORS)
+@pytest.mark.parametrize("key", ["text", "doc.name"])
+def test_every_operator_compiles(operator, key):
+    column, negated, condition, params = FilterCompiler(COLUMNS).compile_item(
+        FilterItem(key=key, operator=operator, value="a", secondary_value="b"))
+
+    assert column is COLUMNS[key.split(".")[0]]
+    assert negated == (operator in NEGATED_OPERATORS)
+    assert condition.count("%s") == len(params)
+
+
+def test_is_not_null_is_the_existence_of_a_value():
+    compiler = FilterCompiler(COLUMNS)
+    assert compiler.compile_item(FilterItem(key="text", operator=FilterOperator.IS_NOT_NULL, value=None)) == \
+        compiler.compile_item(FilterItem(key="text", operator=FilterOperator.EXISTS, value=None))
+
+
+def test_missing_columns_have_no_value():
+    compiler = FilterCompiler(COLUMNS)
+    assert compiler.compile_item(FilterItem(key="missing", operator=FilterOperator.EQ, value="a")) == \
+        (None, False, "FALSE", [])
+    assert compiler.compile_item(FilterItem(key="text.nested", operator=FilterOperator.NE, value="a")) == \
+        (None, True, "FALSE", [])
+
+
+def test_invalid_regular_expressions_are_rejected():
+    with pytest.raises(ValueError):
+        FilterCompiler(COLUMNS).compile_item(FilterItem(key="text", operator=FilterOperator.REGEX, value="("))
+
+
+@pytest.fixture(scope="module")
+def database():
+    """A schema of the state data tables with the rows, on the database of TEST_DATABASE_URL."""
+    database_url = os.environ.get("TEST_DATABASE_URL")
+    if not database_url:
+        pytest.skip("differential tests of the filter compiler require a TEST_DATABASE_URL")
+
+    psycopg2 = pytest.importorskip("psycopg2")
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    schema = f"filter_test_{uuid.uuid4().hex[:8]}"
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA {schema}")
+        cursor.execute(f"SET search_path TO {schema}")
+        cursor.execute("CREATE TABLE state_column_data (column_id INT, data_index INT, data_value TEXT, "
+                       "data_json_value JSONB)")
+        for data_index, row in enumerate(ROWS):
+            for name, value in row.items():
+                column = COLUMNS[name]
+                cursor.execute("INSERT INTO state_column_data VALUES (%s, %s, %s, %s)",
+                               [column.id, data_index, None if column.is_json else value,
+                                json.dumps(value) if column.is_json else None])
+    try:
+        yield conn
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.close()
+
+
+def test_compiled_filters_match_the_filter_model(database):
+    compiler = FilterCompiler(COLUMNS)
+
+    def matches(item: FilterItem):
+        column, negated, condition, params = compiler.compile_item(item)
+        predicate = condition if column is None else compiler.exists_sql(column, condition)
+        with database.cursor() as cursor:
+            cursor.execute(f"SELECT r.data_index FROM generate_series(0, %s) AS r(data_index) "
+                           f"WHERE {'NOT ' if negated else ''}{predicate} ORDER BY r.data_index",
+                           [len(ROWS) - 1] + params)
+            return [row[0] for row in cursor.fetchall()]
+
+    found = mismatches(ROWS, matches)
+    assert not found, "\n".join(found)
@@ -0,0 +1,164 @@
+import asyncio
+import logging as log
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from utils.metrics import Metric, Histogram, register_collector
+
+logging = log.getLogger(__name__)
+
+ADMISSION_REQUESTS = "requests"
+ADMISSION_BYTES = "bytes"
+ADMISSION_MESSAGES = "messages"
+
+# the identity of service callers (processors, pipelines), see token_service.verify_caller
+SERVICE_CALLER_PREFIX = "service:"
+
+
+class TokenBucket:
+    """
+    A token bucket that may go into debt: a take is admitted once the bucket is no longer in debt, and then
+    takes the full amount, such that a single large upload is admitted but delays the next one of the same key.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, rate_factor: float, max_delay: float) -> Optional[float]:
+        """Take the amount and return the delay before it may proceed, or None (nothing taken) if over max_delay."""
+        now = time.monotonic()
+        rate = self.rate * rate_factor
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+        delay = -self.tokens / rate if self.tokens < 0 else 0.0
+        if delay > max_delay:
+            return None
+
+        self.tokens -= amount
+        return delay
+
+    def retry_after(self, rate_factor: float) -> float:
+        return max(0.0, -self.tokens / (self.rate * rate_factor))
+
+
+class AdmissionController:
+    """
+    Per user and project admission control for the expensive endpoints (uploads, exports, triggers, forwards),
+    with separate token buckets for the request rate, bytes ingested and messages published.
+
+    Users over a usage tier cap (per the cached usage report) are rejected, users nearing a cap get a fraction
+    of the regular rates. Requests over the rate are delayed up to max_delay, so that heavy users mostly pay
+    with their own latency, and are rejected with a 429 beyond that.
+    """
+
+    def __init__(self,
+                 usage_loader: Callable[[str, Optional[str]], Awaitable],
+                 rates: Dict[str, Tuple[float, float]],
+                 max_delay: float = 2.0,
+                 usage_ttl: float = 30.0,
+                 warn_pct: float = 90.0,
+                 block_pct: float = 100.0,
+                 warn_rate_factor: float = 0.5,
+                 max_keys: int = 10000,
+                 enabled: bool = True):
+        self.enabled = enabled
+        self.usage_loader = usage_loader
+        self.rates = rates
+        self.max_delay = max_delay
+        self.usage_ttl = usage_ttl
+        self.warn_pct = warn_pct
+        self.block_pct = block_pct
+        self.warn_rate_factor = warn_rate_factor
+        self.max_keys = max_keys
+        self._buckets: OrderedDict = OrderedDict()
+        self._decisions: OrderedDict = OrderedDict()
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self.delays = Histogram()
+        register_collector(self.collect_metrics)
+
+    async def admit(self, kind: str, user_id: Optional[str], project_id: Optional[str] = None, amount: float = 1) -> None:
+        # anonymous callers (accepted while no caller identity is required) are not admission controlled, one
+        # shared bucket would throttle every one of them by the others; nor are service callers, whose pipelines
+        # of a project would throttle each other and which have no usage tier
+        if not self.enabled or user_id is None or user_id.startswith(SERVICE_CALLER_PREFIX):
+            return
+
+        decision, message = await self.fetch_decision(user_id, project_id)
+
+        # the bytes of a request are admitted after the request itself, which is where a block is enforced
+        if decision == "block" and kind != ADMISSION_BYTES:
+            self._count(kind, "blocked")
+            raise HTTPException(status_code=429, detail=f"usage limit reached: {message}")
+
+        rate_factor = self.warn_rate_factor if decision in ("warn", "block") else 1.0
+        bucket = self._bucket(kind, user_id, project_id)
+        delay = bucket.reserve(amount, rate_factor, self.max_delay)
+
+        if delay is None:
+            self._count(kind, "rejected")
+            retry_after = bucket.retry_after(rate_factor)
+            raise HTTPException(
+                status_code=429,
+                detail=f"{kind} rate limit exceeded, retry in {retry_after:.1f}s",
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+
+        if delay > 0:
+            self._count(kind, "delayed")
+            self.delays.observe(delay)
+            await asyncio.sleep(delay)
+        else:
+            self._count(kind, "admitted")
+
+    async def fetch_decision(self, user_id: str, project_id: Optional[str]) -> Tuple[str, str]:
+        """The usage decision (ok, warn or block) of the user and project, cached for the usage ttl."""
+        key = (user_id, project_id)
+        cached = self._decisions.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        try:
+            report = await self.usage_loader(user_id, project_id)
+            decision = report.is_allowed(warn_pct=self.warn_pct, block_pct=self.block_pct) if report \
+                else ("ok", "no usage")
+        except Exception as e:
+            # fail open, the usage report is an optimization on top of the rate limits
+            logging.warning(f'unable to fetch usage report of user {user_id}: {e}')
+            decision = ("ok", "usage unavailable")
+
+        self._decisions[key] = (time.monotonic() + self.usage_ttl, decision)
+        self._decisions.move_to_end(key)
+        while len(self._decisions) > self.max_keys:
+            self._decisions.popitem(last=False)
+
+        return decision
+
+    def _bucket(self, kind: str, user_id: str, project_id: Optional[str]) -> TokenBucket:
+        key = (kind, user_id, project_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, capacity = self.rates[kind]
+            bucket = self._buckets[key] = TokenBucket(rate=rate, capacity=capacity)
+
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+        return bucket
+
+    def _count(self, kind: str, outcome: str):
+        self._counters[(kind, outcome)] = self._counters.get((kind, outcome), 0) + 1
+
+    def collect_metrics(self):
+        decisions = Metric("admission_decisions_total", "counter",
+                           "Admission decisions by bucket kind and outcome (admitted, delayed, rejected, blocked)")
+        for (kind, outcome), count in list(self._counters.items()):
+            decisions.add(count, {"kind": kind, "outcome": outcome})
+
+        return [decisions, self.delays.to_metric("admission_delay_seconds", "Time delayed requests waited")]
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import logging as log
+import os
+import shutil
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+logging = log.getLogger(__name__)
+
+# checkouts are read within this time, even by the slowest download
+ABANDONED_TMP_SECONDS = 24 * 3600
+
+
+class ArtifactCache:
+    """
+    A size bounded LRU cache of generated export artifacts (xlsx exports, parquet shards) on local disk or a
+    volume, keyed by state id, format and the data version of the state along with a variant of any options the
+    artifact depends on. The data version is bumped in the database by every write of the state, on any host,
+    such that a state that changed gets new keys everywhere and its old artifacts age out.
+
+    Recency is the file modification time, touched on every hit, such that the worker processes sharing the
+    directory share the eviction order. Artifacts are read through a checkout, a private link that eviction
+    does not remove.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, enabled: bool = True,
+                 version_loader: Optional[Callable[[str], int]] = None,
+                 version_bumper: Optional[Callable[[str], None]] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.version_loader = version_loader
+        self.version_bumper = version_bumper
+        self.warmers: Dict[str, Callable[[str], None]] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        if enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def data_version(self, state_id: str) -> Optional[int]:
+        """
+        The current data version of the state, to be loaded before the data an artifact is built from (a write in
+        between then only makes the artifact newer than its key). None when it is unknown, nothing is cached then.
+        """
+        if not self.enabled or not self.version_loader:
+            return None
+
+        try:
+            return self.version_loader(state_id)
+        except Exception as e:
+            logging.warning(f'unable to load the data version of state {state_id}, not caching its artifacts: {e}')
+            return None
+
+    def key(self, state_id: str, version: Optional[int], artifact_format: str, variant: str = "") -> Optional[str]:
+        """The key (cached path) of the artifact of the data version of the state, None when not cached."""
+        if not self.enabled or version is None:
+            return None
+
+        digest = hashlib.sha256(f"{artifact_format}|{version}|{variant}".encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{state_id}-{digest}.{artifact_format}")
+
+    def checkout(self, key: Optional[str], directory: Optional[str] = None) -> Optional[str]:
+        """
+        A private hard link (or copy) of the cached artifact in the directory (the cache directory by default),
+        None on a miss. The caller reads it and removes it once done, the artifact may be evicted meanwhile.
+        """
+        if not key:
+            return None
+
+        checkout_path = os.path.join(directory or self.cache_dir, f"{os.path.basename(key)}.{uuid.uuid4().hex}.tmp")
+        try:
+            os.link(key, checkout_path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            # no hard links across devices (or on the volume)
+            try:
+                shutil.copyfile(key, checkout_path)
+            except FileNotFoundError:
+                return None
+
+        try:
+            os.utime(key)
+        except FileNotFoundError:
+            pass
+        return checkout_path
+
+    def put(self, key: Optional[str], source_path: str) -> None:
+        """Cache a copy (a link where possible) of the generated artifact, the source remains the caller's."""
+        if not key:
+            return
+
+        staging_path = f"{key}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(source_path, staging_path)
+        except OSError:
+            shutil.copyfile(source_path, staging_path)
+        os.replace(staging_path, key)
+
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Remove the least recently used artifacts until the cache is within its size, returns the bytes freed."""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+                # checkouts and staged artifacts, left behind by a process that did not get to remove them
+                if entry.name.endswith(".tmp"):
+                    if stat.st_mtime < now - ABANDONED_TMP_SECONDS:
+                        os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, path in sorted(entries):
+            if total - freed <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+
+            # a reader holding the file open keeps streaming it
+            try:
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                continue
+
+        if freed:
+            logging.debug(f'evicted {freed} bytes of export artifacts from {self.cache_dir}')
+        return freed
+
+    def invalidate(self, state_id: str) -> None:
+        """Invalidate the artifacts of the state on every host, ahead of a write (e.g. a deletion) to come."""
+        if not self.enabled:
+            return
+
+        if self.version_bumper:
+            try:
+                self.version_bumper(state_id)
+            except Exception as e:
+                logging.warning(f'unable to bump the data version of state {state_id}: {e}')
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith(f"{state_id}-") and not entry.name.endswith(".tmp"):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+
+    def register_warmer(self, artifact_format: str, build: Callable[[str], None]) -> None:
+        """A sync function building (and caching) the artifact of a state, run when the state is warmed."""
+        self.warmers[artifact_format] = build
+
+    def warm(self, state_ids: Iterable[str], run: Callable[..., Awaitable]) -> None:
+        """Build the artifacts of the states in the background, through run (e.g. an execution lane)."""
+        if not self.enabled:
+            return
+
+        for state_id in state_ids:
+            task = asyncio.create_task(self._warm(state_id, run))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _warm(self, state_id: str, run: Callable[..., Awaitable]) -> None:
+        for artifact_format, build in self.warmers.items():
+            try:
+                await run(build, state_id)
+            except Exception as e:
+                logging.warning(f'unable to warm the {artifact_format} export of state {state_id}: {e}')
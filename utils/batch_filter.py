@@ -0,0 +1,439 @@
+import logging as log
+import operator as operator_module
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from ismcore.model.filter import Filter, FilterItem, FilterOperator
+
+logging = log.getLogger(__name__)
+
+# the numeric strings the filter model compares as numbers (after trimming whitespace)
+NUMERIC_PATTERN = r'^[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)$'
+
+# integers from this magnitude on are not all representable by float64, they compare exactly in python instead
+EXACT_INTEGER_LIMIT = 2 ** 53
+
+# compiled filters kept per worker, keyed by their filter items
+COMPILED_FILTER_CACHE_SIZE = 256
+
+# operators evaluating the absence of the value themselves, every other one fails rows without a value
+PRESENCE_OPERATORS = (FilterOperator.EXISTS, FilterOperator.IS_NOT_NULL,
+                      FilterOperator.NOT_EXISTS, FilterOperator.IS_NULL)
+
+
+def _is_number(value: Any) -> bool:
+    # bools compare as 0 and 1, like python does
+    return isinstance(value, (int, float))
+
+
+def _to_number(value: Any) -> Optional[Any]:
+    """The numeric value of a filter value, as converted by the filter model, None if it is not numeric."""
+    if _is_number(value):
+        return value
+    if isinstance(value, str) and re.match(NUMERIC_PATTERN, value.strip()):
+        return int(value) if '.' not in value else float(value)
+    return None
+
+
+def _is_inexact(value: Any) -> bool:
+    """Whether the number is an integer float64 may not represent."""
+    return isinstance(value, int) and abs(value) >= EXACT_INTEGER_LIMIT
+
+
+class ColumnVectors:
+    """
+    The values of one filter key across all rows, split by kind: the strings, the (json) numbers and bools,
+    the numeric value (of numbers and numeric strings) and, sparse by row, the lists and objects. The numeric
+    values are float64, sparse by row the exact value of the integers it cannot represent is kept along.
+    """
+
+    def __init__(self, num_rows: int,
+                 text: Optional[pa.Array] = None,
+                 number: Optional[pa.Array] = None,
+                 other: Optional[Dict[int, Any]] = None,
+                 exact: Optional[Dict[int, int]] = None):
+        self.num_rows = num_rows
+        self.text = text if text is not None else pa.nulls(num_rows, type=pa.string())
+        self.number = number if number is not None else pa.nulls(num_rows, type=pa.float64())
+        self.other = other or {}
+        self.exact = exact or {}
+
+        trimmed = pc.utf8_trim_whitespace(self.text)
+        numeric_text = pc.cast(pc.if_else(pc.match_substring_regex(trimmed, NUMERIC_PATTERN), trimmed,
+                                          pa.scalar(None, type=pa.string())), pa.float64())
+        self.numeric = pc.coalesce(self.number, numeric_text)
+
+        # integer strings the filter model converts with int()
+        for index in _inexact_indices(numeric_text):
+            value = self.text[index].as_py()
+            if '.' not in value:
+                self.exact[index] = int(value)
+
+        present = pc.or_(pc.is_valid(self.text), pc.is_valid(self.number))
+        if self.other:
+            present = pc.or_(present, self.sparse_mask(lambda value: True))
+        self.present = present
+
+    def numeric_values(self) -> List[Any]:
+        """The numeric values as python numbers, integers exactly."""
+        values = self.numeric.to_pylist()
+        for index, value in self.exact.items():
+            values[index] = value
+        return values
+
+    def exact_mask(self, mask: pa.BooleanArray, predicate: Callable[[Any], bool],
+                   numbers_only: bool = False) -> pa.BooleanArray:
+        """The mask with the rows of inexact integers evaluated by the predicate on their exact value instead."""
+        if not self.exact:
+            return mask
+        mask = mask.to_pylist()
+        for index, value in self.exact.items():
+            if not numbers_only or self.number[index].is_valid:
+                mask[index] = bool(predicate(value))
+        return pa.array(mask, type=pa.bool_())
+
+    def sparse_mask(self, predicate: Callable[[Any], bool]) -> pa.BooleanArray:
+        """Evaluate the predicate on the lists and objects only, rows of other values are false."""
+        mask = [False] * self.num_rows
+        for index, value in self.other.items():
+            mask[index] = bool(predicate(value))
+        return pa.array(mask, type=pa.bool_())
+
+    @classmethod
+    def from_arrow(cls, array: pa.Array) -> "ColumnVectors":
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        if pa.types.is_dictionary(array.type):
+            array = array.dictionary_decode()
+
+        data_type = array.type
+        if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+            return cls(len(array), text=pc.cast(array, pa.string()))
+        if pa.types.is_integer(data_type):
+            number = pc.cast(array, pa.float64(), safe=False)
+            return cls(len(array), number=number,
+                       exact={index: array[index].as_py() for index in _inexact_indices(number)})
+        if pa.types.is_floating(data_type) or pa.types.is_decimal(data_type) or pa.types.is_boolean(data_type):
+            return cls(len(array), number=pc.cast(array, pa.float64()))
+        if pa.types.is_null(data_type):
+            return cls(len(array))
+        return cls.from_values(array.to_pylist())
+
+    @classmethod
+    def from_values(cls, values: List[Any]) -> "ColumnVectors":
+        try:
+            # a column of a single scalar kind converts natively, lists and objects stay python values
+            array = pa.array(values)
+            if not pa.types.is_nested(array.type):
+                return cls.from_arrow(array)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            pass
+
+        text, number, other, exact = [None] * len(values), [None] * len(values), {}, {}
+        for index, value in enumerate(values):
+            if isinstance(value, str):
+                text[index] = value
+            elif _is_number(value):
+                number[index] = float(value)
+                if _is_inexact(value):
+                    exact[index] = value
+            elif value is not None:
+                other[index] = value
+
+        return cls(len(values),
+                   text=pa.array(text, type=pa.string()),
+                   number=pa.array(number, type=pa.float64()),
+                   other=other,
+                   exact=exact)
+
+
+def _inexact_indices(numeric: pa.Array) -> List[int]:
+    """The rows of float64 values whose integer may not be represented exactly."""
+    inexact = pc.greater_equal(pc.abs(numeric), float(EXACT_INTEGER_LIMIT))
+    return pc.indices_nonzero(pc.fill_null(inexact, False)).to_pylist()
+
+
+def _false(vectors: ColumnVectors) -> pa.BooleanArray:
+    return pa.array([False] * vectors.num_rows, type=pa.bool_())
+
+
+def _mask(array: pa.Array) -> pa.BooleanArray:
+    return pc.fill_null(array, False)
+
+
+def _numeric(function: Callable[[pa.Array], pa.Array], predicate: Callable[[Any], bool],
+             bounds: List[Any]) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    """
+    A vectorised predicate of the numeric values (float64), with the predicate of python numbers evaluating the
+    integers float64 cannot represent, those of the data or, for every row, those of the bounds.
+    """
+    if any(_is_inexact(bound) for bound in bounds):
+        return lambda vectors: pa.array([value is not None and bool(predicate(value))
+                                         for value in vectors.numeric_values()], type=pa.bool_())
+    return lambda vectors: vectors.exact_mask(_mask(function(vectors.numeric)), predicate)
+
+
+def _compare(operator: FilterOperator, value: Any) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    """EQ, GT, GTE, LT and LTE of the converted values, numbers compare with numbers and strings with strings."""
+    function = {FilterOperator.EQ: pc.equal, FilterOperator.GT: pc.greater, FilterOperator.GTE: pc.greater_equal,
+                FilterOperator.LT: pc.less, FilterOperator.LTE: pc.less_equal}[operator]
+    python_operator = {FilterOperator.EQ: operator_module.eq, FilterOperator.GT: operator_module.gt,
+                       FilterOperator.GTE: operator_module.ge, FilterOperator.LT: operator_module.lt,
+                       FilterOperator.LTE: operator_module.le}[operator]
+
+    number = _to_number(value)
+    if number is not None:
+        return _numeric(lambda numeric: function(numeric, float(number)),
+                        lambda data_value: python_operator(data_value, number), [number])
+    if isinstance(value, str):
+        # numeric strings of the data are numbers, a string never equals (nor orders with) them
+        return lambda vectors: _mask(pc.and_(pc.is_null(vectors.numeric), function(vectors.text, value)))
+    if operator == FilterOperator.EQ and isinstance(value, (list, dict)):
+        return lambda vectors: vectors.sparse_mask(lambda data_value: data_value == value)
+    return _false
+
+
+def _between(value: Any, secondary_value: Any) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    low, high = _to_number(value), _to_number(secondary_value)
+    if low is not None and high is not None:
+        return _numeric(lambda numeric: pc.and_(pc.greater_equal(numeric, float(low)),
+                                                pc.less_equal(numeric, float(high))),
+                        lambda data_value: low <= data_value <= high, [low, high])
+    if isinstance(value, str) and isinstance(secondary_value, str) and low is None and high is None:
+        return lambda vectors: _mask(pc.and_(pc.is_null(vectors.numeric),
+                                             pc.and_(pc.greater_equal(vectors.text, value),
+                                                     pc.less_equal(vectors.text, secondary_value))))
+    return _false
+
+
+def _not_between(value: Any, secondary_value: Any) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    """Outside of the bounds, of the rows of values that order against them (numbers or strings)."""
+    low, high = _to_number(value), _to_number(secondary_value)
+    between = _between(value, secondary_value)
+    if low is not None and high is not None:
+        return lambda vectors: pc.and_(pc.is_valid(vectors.numeric), pc.invert(between(vectors)))
+    if isinstance(value, str) and isinstance(secondary_value, str) and low is None and high is None:
+        return lambda vectors: pc.and_(pc.and_(pc.is_valid(vectors.text), pc.is_null(vectors.numeric)),
+                                       pc.invert(between(vectors)))
+    # bounds of different kinds, the row by row evaluation only gets past the lower bound by failing it
+    return _compare(FilterOperator.LT, value)
+
+
+def _is_in(entries: List[Any]) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    """Membership without numeric conversion: numbers are in the numbers of the list, strings in its strings."""
+    texts = pa.array([entry for entry in entries if isinstance(entry, str)], type=pa.string())
+    # integers float64 cannot represent are only in the list as the exact value of a number of the data
+    number_entries = [entry for entry in entries if _is_number(entry)]
+    numbers = pa.array([float(entry) for entry in number_entries if not _is_inexact(entry)], type=pa.float64())
+    nested = [entry for entry in entries if isinstance(entry, (list, dict))]
+
+    def evaluate(vectors: ColumnVectors) -> pa.BooleanArray:
+        mask = pc.or_(_mask(pc.is_in(vectors.text, value_set=texts)),
+                      vectors.exact_mask(_mask(pc.is_in(vectors.number, value_set=numbers)),
+                                         lambda data_value: data_value in number_entries, numbers_only=True))
+        if nested and vectors.other:
+            mask = pc.or_(mask, vectors.sparse_mask(lambda data_value: data_value in nested))
+        return mask
+
+    return evaluate
+
+
+def _contains(value: Any) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    """Substrings of strings, elements of lists."""
+
+    def evaluate(vectors: ColumnVectors) -> pa.BooleanArray:
+        mask = _mask(pc.match_substring(vectors.text, value)) if isinstance(value, str) else _false(vectors)
+        if vectors.other:
+            mask = pc.or_(mask, vectors.sparse_mask(
+                lambda data_value: isinstance(data_value, list) and value in data_value))
+        return mask
+
+    return evaluate
+
+
+def _regex(pattern: Any, ignore_case: bool) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    if not isinstance(pattern, str):
+        return _false
+
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    except re.error:
+        return _false
+
+    def evaluate(vectors: ColumnVectors) -> pa.BooleanArray:
+        try:
+            return _mask(pc.match_substring_regex(vectors.text, pattern, ignore_case=ignore_case))
+        except pa.ArrowInvalid:
+            # constructs the arrow (re2) engine lacks, e.g. back references and lookarounds
+            return pa.array([value is not None and compiled.search(value) is not None
+                             for value in vectors.text.to_pylist()], type=pa.bool_())
+
+    return evaluate
+
+
+def _compile_item(item: FilterItem) -> Callable[[ColumnVectors], pa.BooleanArray]:
+    """The predicate of the item over the present values of the column, null handling is done by the caller."""
+    operator = item.operator or FilterOperator.EQ
+    value = item.value
+
+    if operator in (FilterOperator.EXISTS, FilterOperator.IS_NOT_NULL):
+        return lambda vectors: vectors.present
+    if operator in (FilterOperator.NOT_EXISTS, FilterOperator.IS_NULL):
+        return lambda vectors: pc.invert(vectors.present)
+
+    if operator in (FilterOperator.EQ, FilterOperator.GT, FilterOperator.GTE, FilterOperator.LT, FilterOperator.LTE):
+        return _compare(operator, value)
+    if operator == FilterOperator.NE:
+        equal = _compare(FilterOperator.EQ, value)
+        return lambda vectors: pc.invert(equal(vectors))
+
+    if operator == FilterOperator.IN:
+        return _is_in(value) if isinstance(value, list) else _false
+    if operator == FilterOperator.NOT_IN:
+        if not isinstance(value, list):
+            return lambda vectors: pa.array([True] * vectors.num_rows, type=pa.bool_())
+        is_in = _is_in(value)
+        return lambda vectors: pc.invert(is_in(vectors))
+
+    if operator == FilterOperator.CONTAINS:
+        return _contains(value)
+    if operator == FilterOperator.NOT_CONTAINS:
+        contains = _contains(value)
+        return lambda vectors: pc.invert(contains(vectors))
+
+    if operator in (FilterOperator.STARTS_WITH, FilterOperator.ENDS_WITH):
+        if not isinstance(value, str):
+            return _false
+        function = pc.starts_with if operator == FilterOperator.STARTS_WITH else pc.ends_with
+        return lambda vectors: _mask(function(vectors.text, value))
+
+    if operator in (FilterOperator.REGEX, FilterOperator.REGEX_CASE_INSENSITIVE):
+        return _regex(value, ignore_case=operator == FilterOperator.REGEX_CASE_INSENSITIVE)
+
+    if operator == FilterOperator.BETWEEN:
+        if item.secondary_value is None:
+            return _false
+        return _between(value, item.secondary_value)
+    if operator == FilterOperator.NOT_BETWEEN:
+        if item.secondary_value is None:
+            return lambda vectors: pa.array([True] * vectors.num_rows, type=pa.bool_())
+        return _not_between(value, item.secondary_value)
+
+    return _false
+
+
+class CompiledFilter:
+    """
+    A Filter compiled once into vectorised predicates (arrow compute kernels) over the columns of a batch of
+    rows, with the semantics of Filter.apply_filter_on_data per row. Where the row by row evaluation would
+    raise (ordering a number against a string), the row does not match.
+    """
+
+    def __init__(self, filter_items: Dict[str, FilterItem]):
+        # by key, the predicate and whether rows without a value pass (None if the predicate decides)
+        self.items: List[Tuple[str, Callable[[ColumnVectors], pa.BooleanArray], Optional[bool]]] = [
+            (key, _compile_item(item), self._null_passes(item)) for key, item in filter_items.items()
+        ]
+
+    @staticmethod
+    def _null_passes(item: FilterItem) -> Optional[bool]:
+        operator = item.operator or FilterOperator.EQ
+        if operator in PRESENCE_OPERATORS:
+            return None
+        if operator == FilterOperator.NE:
+            return item.value is not None
+        if operator == FilterOperator.NOT_IN:
+            return not isinstance(item.value, list) or None not in item.value
+        return operator == FilterOperator.NOT_CONTAINS
+
+    @property
+    def keys(self) -> List[str]:
+        return [key for key, _, _ in self.items]
+
+    def evaluate(self, columns: Dict[str, ColumnVectors], num_rows: int) -> Tuple[pa.BooleanArray, Dict[str, int]]:
+        """The mask of the rows matching all items and, by key, the number of rows matching each item."""
+        mask = pa.array([True] * num_rows, type=pa.bool_())
+        item_matches = {}
+
+        for key, predicate, null_passes in self.items:
+            vectors = columns.get(key) or ColumnVectors(num_rows)
+            item_mask = predicate(vectors)
+            if null_passes is True:
+                item_mask = pc.or_(pc.and_(item_mask, vectors.present), pc.invert(vectors.present))
+            elif null_passes is False:
+                item_mask = pc.and_(item_mask, vectors.present)
+
+            item_matches[key] = pc.sum(item_mask.cast(pa.int64())).as_py() or 0
+            mask = pc.and_(mask, item_mask)
+
+        return mask, item_matches
+
+
+@lru_cache(maxsize=COMPILED_FILTER_CACHE_SIZE)
+def _compile_cached(filter_items_json: str) -> CompiledFilter:
+    return CompiledFilter(Filter.model_validate_json(filter_items_json).filter_items or {})
+
+
+def compile_filter(filter: Filter) -> CompiledFilter:
+    """The compiled filter, cached by its items such that a changed filter compiles again."""
+    return _compile_cached(Filter(filter_items=filter.filter_items).model_dump_json())
+
+
+def _nested_value(value: Any, path: List[str]) -> Any:
+    for key in path:
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        else:
+            return None
+    return value
+
+
+def _key_values(values_of: Callable[[str], Optional[List[Any]]], key: str) -> Optional[List[Any]]:
+    """The values of a (dot notation) key, from the column of that name or nested in the column of its first part."""
+    values = values_of(key)
+    if values is not None or "." not in key:
+        return values
+
+    root, *path = key.split(".")
+    values = values_of(root)
+    return None if values is None else [_nested_value(value, path) for value in values]
+
+
+def rows_to_vectors(compiled: CompiledFilter, rows: List[Dict[str, Any]]) -> Dict[str, ColumnVectors]:
+    """The vectors of the filter keys from row dictionaries."""
+    vectors = {}
+    for key in compiled.keys:
+        values = [_nested_value(row, key.split(".")) if isinstance(row, dict) else None for row in rows]
+        vectors[key] = ColumnVectors.from_values(values)
+    return vectors
+
+
+def columns_to_vectors(compiled: CompiledFilter, columns: Dict[str, List[Any]]) -> Tuple[Dict[str, ColumnVectors], int]:
+    """The vectors of the filter keys from a columnar payload of equally long value lists, and the row count."""
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError(f'columns must have the same number of values, got lengths {sorted(lengths)}')
+    num_rows = lengths.pop() if lengths else 0
+
+    vectors = {}
+    for key in compiled.keys:
+        values = _key_values(columns.get, key)
+        vectors[key] = ColumnVectors.from_values(values) if values is not None else ColumnVectors(num_rows)
+    return vectors, num_rows
+
+
+def table_to_vectors(compiled: CompiledFilter, table: pa.Table) -> Dict[str, ColumnVectors]:
+    """The vectors of the filter keys from an arrow table, typed columns are used as they are."""
+    vectors = {}
+    for key in compiled.keys:
+        if key in table.column_names:
+            vectors[key] = ColumnVectors.from_arrow(table.column(key))
+            continue
+
+        values = _key_values(lambda name: table.column(name).to_pylist() if name in table.column_names else None,
+                             key)
+        vectors[key] = ColumnVectors.from_values(values) if values is not None else ColumnVectors(table.num_rows)
+    return vectors
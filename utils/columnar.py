@@ -0,0 +1,124 @@
+import io
+import json
+from typing import Optional, Dict, List, Any
+
+import msgpack
+import pyarrow as pa
+from ismcore.model.processor_state import State
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack", "application/vnd.msgpack")
+
+# string columns with fewer distinct values than this ratio of rows are dictionary encoded
+DICTIONARY_ENCODING_RATIO = 0.5
+
+
+def negotiate_media_type(accept: Optional[str]) -> Optional[str]:
+    """
+    Pick a binary columnar media type from an Accept header.
+    Returns None when the client prefers (or only accepts) the default json representation.
+    """
+    if not accept:
+        return None
+
+    candidates = []
+    for position, entry in enumerate(accept.split(",")):
+        parts = [part.strip() for part in entry.split(";")]
+        media_type = parts[0].lower()
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+
+        if quality <= 0:
+            continue
+
+        if media_type == ARROW_STREAM_MEDIA_TYPE:
+            candidates.append((-quality, position, ARROW_STREAM_MEDIA_TYPE))
+        elif media_type in MSGPACK_MEDIA_TYPES:
+            candidates.append((-quality, position, MSGPACK_MEDIA_TYPE))
+        elif media_type in ("application/json", "*/*", "application/*"):
+            candidates.append((-quality, position, None))
+
+    if not candidates:
+        return None
+
+    return sorted(candidates)[0][2]
+
+
+def _column_values(state: State) -> Dict[str, List[Any]]:
+    """Return the loaded data of a state as column name -> values, in column definition order."""
+    if not state.data:
+        return {}
+
+    names = [name for name in (state.columns or {}) if name in state.data]
+    names += [name for name in state.data if name not in names]
+    return {name: state.data[name].values if state.data[name] else [] for name in names}
+
+
+def _is_json_column(state: State, column_name: str) -> bool:
+    column = state.columns.get(column_name) if state.columns else None
+    return column is not None and column.data_type == 'json'
+
+
+def _to_arrow_array(values: List[Any], is_json: bool) -> pa.Array:
+    """Convert column values to an arrow string array, dictionary encoding repeated strings."""
+    values = [
+        json.dumps(value, ensure_ascii=False) if value is not None and (is_json or not isinstance(value, str))
+        else value
+        for value in values
+    ]
+
+    array = pa.array(values, type=pa.string())
+    if len(array) > 1:
+        encoded = array.dictionary_encode()
+        if len(encoded.dictionary) <= len(array) * DICTIONARY_ENCODING_RATIO:
+            return encoded
+
+    return array
+
+
+def _page_metadata(state: State, offset: Optional[int], limit: Optional[int]) -> Dict[str, Any]:
+    return {
+        "state_id": state.id,
+        "state_type": state.state_type,
+        "count": state.count,
+        "offset": offset,
+        "limit": limit,
+    }
+
+
+def state_page_to_arrow(state: State, offset: Optional[int] = None, limit: Optional[int] = None) -> bytes:
+    """Serialize a loaded state data page as a single arrow IPC stream record batch."""
+    columns = _column_values(state)
+    arrays = [_to_arrow_array(values, _is_json_column(state, name)) for name, values in columns.items()]
+
+    metadata = {key: json.dumps(value) for key, value in _page_metadata(state, offset, limit).items()}
+    if state.columns:
+        metadata["columns"] = json.dumps({
+            name: definition.manual_json() for name, definition in state.columns.items()
+        })
+
+    schema = pa.schema([pa.field(name, array.type) for name, array in zip(columns, arrays)], metadata=metadata)
+    batch = pa.record_batch(arrays, schema=schema)
+
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch)
+
+    return sink.getvalue()
+
+
+def state_page_to_msgpack(state: State, offset: Optional[int] = None, limit: Optional[int] = None) -> bytes:
+    """Serialize a loaded state data page as msgpack, with column names once and value arrays per column."""
+    columns = _column_values(state)
+    document = {
+        **_page_metadata(state, offset, limit),
+        "columns": list(columns.keys()),
+        "data": columns,
+    }
+    return msgpack.packb(document, default=str, use_bin_type=True)
@@ -0,0 +1,214 @@
+import zlib
+from typing import Optional, List, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Receive, Scope, Send, Message
+
+try:
+    import brotli
+except ImportError:  # optional, br is simply not offered when missing
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd is simply not offered when missing
+    zstandard = None
+
+# media types that are already compressed (or streamed as events) and gain nothing from another pass
+DEFAULT_EXCLUDED_MEDIA_TYPES = (
+    "application/vnd.openxmlformats-officedocument",  # xlsx, docx (zip containers)
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/zstd",
+    "application/vnd.apache.parquet",
+    "application/x-parquet",
+    "text/event-stream",
+    "image/",
+    "audio/",
+    "video/",
+)
+
+
+class _GzipEncoder:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliEncoder:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdEncoder:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def available_encodings() -> List[str]:
+    """Supported content encodings, in server preference order."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def select_encoding(accept_encoding: Optional[str], supported: List[str]) -> Optional[str]:
+    """Pick the best supported encoding from an Accept-Encoding header, honouring q-values."""
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for entry in accept_encoding.split(","):
+        parts = [part.strip() for part in entry.split(";")]
+        coding = parts[0].lower()
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            weights[coding] = quality
+
+    candidates: List[Tuple[float, int, str]] = []
+    for preference, coding in enumerate(supported):
+        quality = weights.get(coding, weights.get("*", 0.0))
+        if quality > 0:
+            candidates.append((-quality, preference, coding))
+
+    if not candidates:
+        return None
+
+    return sorted(candidates)[0][2]
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with zstd, brotli or gzip depending on the request Accept-Encoding.
+
+    Bodies are compressed incrementally as they are sent, so StreamingResponse generators keep
+    streaming without being buffered. Single-message responses smaller than minimum_size, responses
+    that already carry a Content-Encoding and already-compressed media types are passed through.
+    """
+
+    def __init__(self,
+                 app: ASGIApp,
+                 minimum_size: int = 1024,
+                 gzip_level: int = 6,
+                 brotli_level: int = 4,
+                 zstd_level: int = 3,
+                 excluded_media_types: tuple = DEFAULT_EXCLUDED_MEDIA_TYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": gzip_level, "br": brotli_level, "zstd": zstd_level}
+        self.excluded_media_types = excluded_media_types
+        self.supported = available_encodings()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = select_encoding(Headers(scope=scope).get("accept-encoding"), self.supported)
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+    def create_encoder(self, encoding: str):
+        level = self.levels[encoding]
+        if encoding == "zstd":
+            return _ZstdEncoder(level)
+        elif encoding == "br":
+            return _BrotliEncoder(level)
+        return _GzipEncoder(level)
+
+    def is_excluded(self, headers: Headers) -> bool:
+        if "content-encoding" in headers:
+            return True
+
+        content_type = headers.get("content-type", "").lower()
+        return any(content_type.startswith(media_type) for media_type in self.excluded_media_types)
+
+
+class _CompressionResponder:
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start_message: Optional[Message] = None
+        self.encoder = None
+        self.passthrough = False
+
+    async def send(self, message: Message) -> None:
+        message_type = message["type"]
+
+        if message_type == "http.response.start":
+            # hold the start message until the first body chunk tells us whether to compress
+            self.start_message = message
+            return
+
+        if message_type != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.encoder is None:
+            headers = Headers(raw=self.start_message["headers"])
+            if self.middleware.is_excluded(headers) or (not more_body and len(body) < self.middleware.minimum_size):
+                self.passthrough = True
+                await self._send(self.start_message)
+                await self._send(message)
+                return
+
+            self.encoder = self.middleware.create_encoder(self.encoding)
+
+            mutable_headers = MutableHeaders(raw=self.start_message["headers"])
+            mutable_headers["Content-Encoding"] = self.encoding
+            mutable_headers.add_vary_header("Accept-Encoding")
+            if "content-length" in mutable_headers:
+                del mutable_headers["content-length"]
+
+            if not more_body:
+                compressed = self.encoder.compress(body) + self.encoder.finish()
+                mutable_headers["Content-Length"] = str(len(compressed))
+                await self._send(self.start_message)
+                await self._send({"type": "http.response.body", "body": compressed})
+                return
+
+            await self._send(self.start_message)
+
+        compressed = self.encoder.compress(body)
+        if not more_body:
+            compressed += self.encoder.finish()
+
+        if compressed or not more_body:
+            await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
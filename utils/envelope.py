@@ -0,0 +1,153 @@
+import base64
+import io
+import json
+import logging as log
+from typing import Any, Dict, List, Optional, Tuple
+
+import msgpack
+import pyarrow as pa
+
+try:
+    import zstandard
+except ImportError:  # optional, envelopes are published uncompressed when missing
+    zstandard = None
+
+logging = log.getLogger(__name__)
+
+ENVELOPE_VERSION = 1
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODING_ARROW = "arrow"
+ENCODINGS = (ENCODING_JSON, ENCODING_MSGPACK, ENCODING_ARROW)
+
+COMPRESSION_ZSTD = "zstd"
+
+# arrow fields holding json text of values arrow could not type (mixed or nested python values)
+ARROW_JSON_FIELD_METADATA = {b"encoding": b"json"}
+
+
+def rows_to_columns(rows: List[Dict[str, Any]]) -> Tuple[List[str], List[List[Any]]]:
+    """Column names (in order of first appearance) and a value array per column, None where a row lacks it."""
+    names: Dict[str, None] = {}
+    for row in rows:
+        names.update(dict.fromkeys(row))
+
+    return list(names), [[row.get(name) for row in rows] for name in names]
+
+
+def columns_to_rows(names: List[str], values: List[List[Any]]) -> List[Dict[str, Any]]:
+    return [dict(zip(names, row_values)) for row_values in zip(*values)] if values else []
+
+
+def _arrow_field(name: str, column: List[Any]) -> Tuple[pa.Field, pa.Array]:
+    try:
+        array = pa.array(column)
+        return pa.field(name, array.type), array
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        array = pa.array([json.dumps(value, default=str) if value is not None else None for value in column],
+                         type=pa.string())
+        return pa.field(name, pa.string(), metadata=ARROW_JSON_FIELD_METADATA), array
+
+
+def _encode_columns(names: List[str], values: List[List[Any]], encoding: str) -> bytes:
+    if encoding == ENCODING_ARROW:
+        fields, arrays = zip(*[_arrow_field(name, column) for name, column in zip(names, values)]) \
+            if names else ((), ())
+        schema = pa.schema(list(fields))
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, schema) as writer:
+            writer.write_batch(pa.record_batch(list(arrays), schema=schema))
+        return sink.getvalue()
+
+    document = {"columns": names, "values": values}
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(document, default=str, use_bin_type=True)
+
+    return json.dumps(document, default=str).encode("utf-8")
+
+
+def _decode_columns(payload: bytes, encoding: str) -> Tuple[List[str], List[List[Any]]]:
+    if encoding == ENCODING_ARROW:
+        table = pa.ipc.open_stream(payload).read_all()
+        names, values = [], []
+        for field, column in zip(table.schema, table.columns):
+            column_values = column.to_pylist()
+            if field.metadata == ARROW_JSON_FIELD_METADATA:
+                column_values = [json.loads(value) if value is not None else None for value in column_values]
+            names.append(field.name)
+            values.append(column_values)
+        return names, values
+
+    document = msgpack.unpackb(payload, raw=False) if encoding == ENCODING_MSGPACK else json.loads(payload)
+    return document["columns"], document["values"]
+
+
+def validate_envelope_config(encoding: str, compression: Optional[str]) -> Tuple[str, Optional[str]]:
+    """The encoding and compression to use, compression is dropped (with a warning) when zstandard is missing."""
+    if encoding not in ENCODINGS:
+        raise ValueError(f'unsupported state sync encoding {encoding}, expected one of {ENCODINGS}')
+
+    if compression and compression != COMPRESSION_ZSTD:
+        raise ValueError(f'unsupported state sync compression {compression}, expected {COMPRESSION_ZSTD}')
+
+    if compression and zstandard is None:
+        logging.warning('zstandard is not installed, state sync messages are published uncompressed')
+        compression = None
+
+    return encoding, compression or None
+
+
+def encode_state_sync_message(state_id: str,
+                              rows: List[Dict[str, Any]],
+                              encoding: str = ENCODING_JSON,
+                              compression: Optional[str] = None,
+                              compression_level: int = 3) -> str:
+    """
+    Derive the query_state_direct message of the rows of a state.
+
+    With the json encoding and no compression this is the plain message of row dicts, which every consumer
+    understands. Otherwise the rows are carried in a versioned envelope: column names once and a value array
+    per column (None where a row lacks the column), encoded as json, msgpack or an arrow IPC stream, optionally
+    zstd compressed. The routes publish text, hence the payload is base64 encoded; the envelope header tells
+    consumers how to decode it.
+    """
+    if encoding == ENCODING_JSON and not compression:
+        return json.dumps({
+            "type": "query_state_direct",
+            "state_id": state_id,
+            "query_state": rows
+        })
+
+    payload = _encode_columns(*rows_to_columns(rows), encoding=encoding)
+    if compression == COMPRESSION_ZSTD:
+        payload = zstandard.ZstdCompressor(level=compression_level).compress(payload)
+
+    return json.dumps({
+        "type": "query_state_direct",
+        "state_id": state_id,
+        "envelope": {
+            "version": ENVELOPE_VERSION,
+            "layout": "columnar",
+            "encoding": encoding,
+            "compression": compression,
+            "count": len(rows),
+            "payload": base64.b64encode(payload).decode("ascii"),
+        }
+    })
+
+
+def decode_state_sync_message(message: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The rows of a query_state_direct message, either plain or enveloped."""
+    envelope = message.get("envelope")
+    if not envelope:
+        return message.get("query_state") or []
+
+    if envelope.get("version") != ENVELOPE_VERSION:
+        raise ValueError(f'unsupported state sync envelope version {envelope.get("version")}')
+
+    payload = base64.b64decode(envelope["payload"])
+    if envelope.get("compression") == COMPRESSION_ZSTD:
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+
+    return columns_to_rows(*_decode_columns(payload, encoding=envelope["encoding"]))
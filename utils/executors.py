@@ -0,0 +1,233 @@
+import asyncio
+import contextvars
+import logging as log
+import multiprocessing
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from utils.metrics import Metric, Histogram, register_collector
+
+logging = log.getLogger(__name__)
+
+LANE_EXPORT = "export"
+LANE_IMPORT = "import"
+LANE_SANDBOX = "sandbox"
+LANE_METADATA = "metadata"
+LANE_QUERY = "query"
+LANE_BACKGROUND = "background"
+
+# lanes running in worker processes instead of threads, their calls must be picklable top level functions
+PROCESS_LANES = (LANE_SANDBOX,)
+
+# (max workers, max queued calls) by lane
+DEFAULT_LANE_CONFIG = {
+    LANE_EXPORT: (2, 8),
+    LANE_IMPORT: (2, 8),
+    LANE_SANDBOX: (2, 16),
+    LANE_METADATA: (8, 64),
+    LANE_QUERY: (4, 32),
+    # best effort work nobody waits for (export pre-warming), rejected rather than queued behind the rest
+    LANE_BACKGROUND: (1, 4),
+}
+
+# seconds a call of a process lane may run before its worker processes are terminated, by lane
+DEFAULT_LANE_TIMEOUTS = {
+    LANE_SANDBOX: 30.0,
+}
+
+
+def _timed_call(func: Callable, args: tuple, kwargs: dict) -> Tuple[float, Optional[BaseException], Any]:
+    started = time.time()
+    try:
+        return started, None, func(*args, **kwargs)
+    except Exception as e:
+        return started, e, None
+
+
+class ExecutionLane:
+    """
+    A named, bounded executor. Calls beyond max_workers wait in the lane queue, calls beyond max_workers plus
+    max_queue are rejected with a 429 instead of piling up, such that one kind of work cannot starve the rest.
+
+    A process lane survives its workers: a call running past the timeout has the worker processes terminated,
+    and a pool broken by a dying worker (os._exit, out of memory kill, segfault) is replaced by a new one. The
+    calls in flight on the terminated or broken pool fail with a 503 (504 for the call that timed out).
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, process: bool = False,
+                 timeout: Optional[float] = None, initializer: Optional[Tuple[Callable, tuple]] = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.process = process
+        self.timeout = timeout if process else None  # threads cannot be terminated
+        self.initializer = initializer  # (function, args) run by each worker process as it starts
+        self.pending = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.queue_wait = Histogram()
+        self.run_time = Histogram()
+        self._slots = asyncio.Semaphore(max_workers)
+        self.executor: Executor = self._create_executor()
+
+    def _create_executor(self) -> Executor:
+        if self.process:
+            # spawned rather than forked, the workers must not inherit database connections or event loops
+            initializer, initargs = self.initializer or (None, ())
+            return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=initializer, initargs=initargs)
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"lane-{self.name}")
+
+    def _restart(self, executor: Executor, reason: str) -> None:
+        """Terminate the workers of the (broken or overrunning) executor and replace it, once per executor."""
+        if self.executor is not executor:
+            return
+
+        logging.warning(f'restarting the {self.name} lane workers, {reason}')
+        self.restarts += 1
+        self.executor = self._create_executor()
+
+        # the pending calls of the old pool fail with BrokenProcessPool once its workers are gone
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            if process.is_alive():
+                process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, loop: asyncio.AbstractEventLoop, func: Callable, args: tuple, kwargs: dict):
+        if not self.process:
+            # same as asyncio.to_thread, the call sees the context (e.g. read replica routing) of the caller
+            context = contextvars.copy_context()
+            return loop.run_in_executor(self.executor, context.run, _timed_call, func, args, kwargs)
+
+        executor = self.executor
+        try:
+            return executor, loop.run_in_executor(executor, _timed_call, func, args, kwargs)
+        except BrokenProcessPool:
+            self._restart(executor, "the pool was broken by a worker that died")
+            return self.executor, loop.run_in_executor(self.executor, _timed_call, func, args, kwargs)
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"the {self.name} lane is saturated, {self.pending} calls in flight, try again later",
+                headers={"Retry-After": "5"})
+
+        self.pending += 1
+        submitted = time.time()
+        executor = None
+        try:
+            loop = asyncio.get_running_loop()
+            if self.process:
+                # queued here rather than in the pool, such that the timeout of a call starts when it runs
+                await self._slots.acquire()
+                try:
+                    executor, future = self._submit(loop, func, args, kwargs)
+                except Exception:
+                    self._slots.release()
+                    raise
+                future.add_done_callback(lambda done: self._slots.release())
+            else:
+                future = self._submit(loop, func, args, kwargs)
+        except BaseException:
+            self.pending -= 1
+            raise
+
+        # the call occupies the lane until it completes, even when the caller is cancelled (disconnected)
+        future.add_done_callback(self._release)
+        try:
+            started, error, result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._restart(executor, f"a call exceeded the timeout of {self.timeout}s")
+            raise HTTPException(status_code=504, detail=f"the {self.name} call exceeded {self.timeout} seconds")
+        except BrokenProcessPool:
+            self._restart(executor, "the pool was broken by a worker that died")
+            raise HTTPException(
+                status_code=503,
+                detail=f"the {self.name} worker running the call died (or was terminated), try again later",
+                headers={"Retry-After": "1"})
+
+        self.queue_wait.observe(max(0.0, started - submitted))
+        self.run_time.observe(max(0.0, time.time() - started))
+
+        if error is not None:
+            raise error
+        return result
+
+    def _release(self, future: asyncio.Future):
+        self.pending -= 1
+        if not future.cancelled() and future.exception() is not None \
+                and not isinstance(future.exception(), BrokenProcessPool):
+            logging.error(f'{self.name} lane worker failed: {future.exception()}')
+
+    def collect_metrics(self):
+        labels = {"lane": self.name}
+        yield Metric("lane_in_flight", "gauge", "Calls running or queued in the lane").add(self.pending, labels)
+        yield Metric("lane_capacity", "gauge", "Workers plus queue slots of the lane").add(self.capacity, labels)
+        yield Metric("lane_rejected_total", "counter",
+                     "Calls rejected because the lane was saturated").add(self.rejected, labels)
+        yield Metric("lane_restarts_total", "counter",
+                     "Worker pools replaced after a worker died or a call timed out").add(self.restarts, labels)
+        yield self.queue_wait.to_metric("lane_queue_wait_seconds", "Time calls waited for a lane worker", labels)
+        yield self.run_time.to_metric("lane_run_seconds", "Time calls ran on a lane worker", labels)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ExecutionLanes:
+
+    def __init__(self,
+                 config: Dict[str, Tuple[int, int]] = None,
+                 timeouts: Dict[str, float] = None,
+                 initializers: Dict[str, Tuple[Callable, tuple]] = None):
+        timeouts = {**DEFAULT_LANE_TIMEOUTS, **(timeouts or {})}
+        initializers = initializers or {}
+        self.lanes = {
+            name: ExecutionLane(name, max_workers, max_queue, process=name in PROCESS_LANES,
+                                timeout=timeouts.get(name) or None, initializer=initializers.get(name))
+            for name, (max_workers, max_queue) in {**DEFAULT_LANE_CONFIG, **(config or {})}.items()
+        }
+
+        for lane in self.lanes.values():
+            register_collector(lane.collect_metrics)
+
+    def __getitem__(self, name: str) -> ExecutionLane:
+        return self.lanes[name]
+
+    async def run(self, lane: str, func: Callable, *args, **kwargs) -> Any:
+        return await self.lanes[lane].run(func, *args, **kwargs)
+
+    def shutdown(self):
+        for lane in self.lanes.values():
+            lane.shutdown()
+
+
+def parse_lane_timeouts(value: Optional[str]) -> Dict[str, float]:
+    """Parse lane=seconds entries, e.g. "sandbox=30", 0 is no timeout."""
+    timeouts = {}
+    for entry in (value or "").split(","):
+        if "=" in entry:
+            name, seconds = entry.split("=", 1)
+            timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+
+def parse_lane_config(value: Optional[str]) -> Dict[str, Tuple[int, int]]:
+    """Parse lane=workers:queue entries, e.g. "export=2:8,sandbox=2:16"."""
+    config = {}
+    for entry in (value or "").split(","):
+        if "=" in entry:
+            name, sizes = entry.split("=", 1)
+            max_workers, _, max_queue = sizes.partition(":")
+            config[name.strip()] = (int(max_workers), int(max_queue or 0))
+    return config
@@ -0,0 +1,99 @@
+import asyncio
+import logging as log
+import uuid
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Set
+
+from ismcore.model.processor_state import State
+
+logging = log.getLogger(__name__)
+
+
+def state_key_of(state: State, query_state: Dict) -> Optional[str]:
+    """
+    The state key (primary key hash) a row gets once applied to the state, derived with the same steps as
+    State.apply_query_state (without scope variables, there are none at ingest), or None when it has none.
+    """
+    query_state = state.pre_state_apply(query_state=query_state)
+    if not isinstance(query_state, dict):
+        return None
+
+    query_state = state.pre_state_apply_callable_and_constant_columns(query_state=query_state)
+    return state.post_state_primary_key_apply(query_state=query_state).get("state_key")
+
+
+def _digest(key: str) -> bytes:
+    try:
+        return uuid.UUID(key).bytes
+    except ValueError:
+        return key.encode("utf-8")
+
+
+class IngestDeduplicator:
+    """
+    Drops rows of an ingest whose primary key was already seen earlier in the same ingest, or already exists in
+    the state (by a bulk lookup of the keys of each block against the state key mappings), before they are
+    published or written. Keys seen are kept as 16 byte digests.
+
+    A state without a primary key passes every row through.
+    """
+
+    def __init__(self, state: State, fetch_existing_keys: Callable[[str, List[str]], Set[str]]):
+        self.state = state
+        self.fetch_existing_keys = fetch_existing_keys
+        self.enabled = bool(state and state.config and state.config.primary_key)
+        self.seen: Set[bytes] = set()
+        self.skipped_duplicates = 0
+        self.skipped_existing = 0
+        self.passed = 0
+
+    def filter(self, rows: Iterable[Dict]) -> List[Dict]:
+        rows = list(rows)
+        if not self.enabled:
+            self.passed += len(rows)
+            return rows
+
+        keyed = []
+        for row in rows:
+            try:
+                key = state_key_of(self.state, row)
+            except Exception as e:
+                logging.debug(f'unable to derive the state key of a row of state {self.state.id}: {e}')
+                key = None
+
+            if key is not None:
+                digest = _digest(key)
+                if digest in self.seen:
+                    self.skipped_duplicates += 1
+                    continue
+                self.seen.add(digest)
+            keyed.append((key, row))
+
+        keys = [key for key, _ in keyed if key is not None]
+        existing = self.fetch_existing_keys(self.state.id, keys) if keys else set()
+
+        output = []
+        for key, row in keyed:
+            if key in existing:
+                self.skipped_existing += 1
+            else:
+                output.append(row)
+
+        self.passed += len(output)
+        return output
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "rows": self.passed,
+            "skipped_duplicates": self.skipped_duplicates,
+            "skipped_existing": self.skipped_existing,
+        }
+
+
+async def deduplicate_blocks(blocks: AsyncIterator[List[Dict]],
+                             deduplicator: Optional[IngestDeduplicator]) -> AsyncIterator[List[Dict]]:
+    """The blocks without the duplicate rows, filtered in a worker thread (the key lookup is a query)."""
+    async for block in blocks:
+        if deduplicator:
+            block = await asyncio.to_thread(deduplicator.filter, block)
+        if block:
+            yield block
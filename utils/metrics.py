@@ -0,0 +1,89 @@
+import os
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# every worker process keeps its own metrics, the pid label tells the workers of a pod apart
+WORKER_ID = str(os.getpid())
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """A metric family in prometheus text exposition terms: a name, a type, a help text and its samples."""
+
+    def __init__(self, name: str, kind: str, help: str, samples: List[Tuple[str, Dict[str, str], float]] = None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.samples = samples or []
+
+    def add(self, value: float, labels: Dict[str, str] = None, suffix: str = ""):
+        self.samples.append((suffix, labels or {}, value))
+        return self
+
+
+class Histogram:
+    """A thread safe histogram of observed durations, in seconds."""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.maximum = max(self.maximum, value)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+
+    def to_metric(self, name: str, help: str, labels: Dict[str, str] = None) -> Metric:
+        labels = labels or {}
+        metric = Metric(name, "histogram", help)
+        with self._lock:
+            for bound, count in zip(self.buckets, self.counts):
+                metric.add(count, {**labels, "le": str(bound)}, suffix="_bucket")
+            metric.add(self.count, {**labels, "le": "+Inf"}, suffix="_bucket")
+            metric.add(self.total, labels, suffix="_sum")
+            metric.add(self.count, labels, suffix="_count")
+        return metric
+
+
+_collectors: List[Callable[[], Iterable[Metric]]] = []
+
+
+def register_collector(collector: Callable[[], Iterable[Metric]]) -> None:
+    """Register a callable that returns the current metrics of a component, it is invoked on every scrape."""
+    _collectors.append(collector)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    labels = {"worker": WORKER_ID, **labels}
+    escaped = (
+        f'{key}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metrics(collectors: Optional[List[Callable[[], Iterable[Metric]]]] = None) -> str:
+    # families of the same name (e.g. one per connection pool) are merged, names must be unique in the output
+    families: Dict[str, Metric] = {}
+    for collector in collectors or _collectors:
+        for metric in collector():
+            if metric.name in families:
+                families[metric.name].samples.extend(metric.samples)
+            else:
+                families[metric.name] = Metric(metric.name, metric.kind, metric.help, list(metric.samples))
+
+    lines = []
+    for metric in families.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples:
+            lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,208 @@
+import datetime as dt
+import json
+import logging as log
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import pyarrow as pa
+
+logging = log.getLogger(__name__)
+
+# text columns with at most this ratio of distinct values (in the sample) are dictionary encoded
+DICTIONARY_MAX_DISTINCT_RATIO = 0.5
+
+_TRUE = {"true", "t", "1", "yes", "y"}
+_FALSE = {"false", "f", "0", "no", "n"}
+
+
+class ParquetColumnTypeError(ValueError):
+    """A value of the column does not fit the type derived for it, the column has to be written as text."""
+
+    def __init__(self, column: str, value: Any):
+        super().__init__(f'value {str(value)[:100]!r} of column {column} does not fit its parquet type')
+        self.column = column
+
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in _TRUE:
+        return True
+    if text in _FALSE:
+        return False
+    raise ValueError(f'not a boolean: {value}')
+
+
+def _to_int(value: Any) -> int:
+    if isinstance(value, bool):
+        raise ValueError(f'not an integer: {value}')
+    return value if isinstance(value, int) else int(str(value).strip())
+
+
+def _to_float(value: Any) -> float:
+    if isinstance(value, bool):
+        raise ValueError(f'not a float: {value}')
+    return float(value)
+
+
+def _to_datetime(value: Any) -> dt.datetime:
+    return value if isinstance(value, dt.datetime) else dt.datetime.fromisoformat(str(value).strip())
+
+
+def _to_date(value: Any) -> dt.date:
+    if isinstance(value, dt.datetime):
+        return value.date()
+    return value if isinstance(value, dt.date) else dt.date.fromisoformat(str(value).strip())
+
+
+def _to_text(value: Any) -> str:
+    return value if isinstance(value, str) else json.dumps(value, default=str)
+
+
+# state column data types (as inferred by the state or configured) to arrow types and value converters
+SCALAR_TYPES: Dict[str, Tuple[pa.DataType, Callable[[Any], Any]]] = {
+    "int": (pa.int64(), _to_int),
+    "float": (pa.float64(), _to_float),
+    "bool": (pa.bool_(), _to_bool),
+    "datetime": (pa.timestamp("us"), _to_datetime),
+    "timestamp": (pa.timestamp("us"), _to_datetime),
+    "date": (pa.date32(), _to_date),
+}
+
+
+def _fits(value: Any, data_type: pa.DataType) -> bool:
+    """Whether the json value converts to the nested type without loss (arrow drops unknown struct keys)."""
+    if value is None:
+        return True
+    if pa.types.is_struct(data_type):
+        if not isinstance(value, dict):
+            return False
+        fields = {field.name: field.type for field in data_type}
+        return all(key in fields and _fits(item, fields[key]) for key, item in value.items())
+    if pa.types.is_list(data_type) or pa.types.is_large_list(data_type):
+        return isinstance(value, list) and all(_fits(item, data_type.value_type) for item in value)
+    if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+        return isinstance(value, str)
+    if pa.types.is_boolean(data_type):
+        return isinstance(value, bool)
+    if pa.types.is_integer(data_type):
+        return isinstance(value, int) and not isinstance(value, bool)
+    if pa.types.is_floating(data_type):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return False
+
+
+def _has_null_type(data_type: pa.DataType) -> bool:
+    # an empty struct (of empty dicts) has no type for the keys of later values either, nor can it be written
+    if pa.types.is_null(data_type) or (pa.types.is_struct(data_type) and not data_type.num_fields):
+        return True
+    return any(_has_null_type(data_type.field(index).type) for index in range(data_type.num_fields))
+
+
+def _json_type(values: List[Any]) -> Optional[pa.DataType]:
+    """The nested (struct or list) type of json values, None when they are mixed or have no common type."""
+    values = [value for value in values if value is not None]
+    if not values or not all(isinstance(value, (dict, list)) for value in values):
+        return None
+
+    try:
+        data_type = pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+
+    # empty lists and dicts give null typed (or no) children, which later values would not fit
+    if _has_null_type(data_type):
+        return None
+
+    return data_type if all(_fits(value, data_type) for value in values) else None
+
+
+def derive_parquet_schema(column_types: Dict[str, str],
+                          sample: Dict[str, List[Any]],
+                          text_columns: Iterable[str] = ()) -> Tuple[pa.Schema, List[str]]:
+    """
+    A typed schema of the state columns, by their data type: int, float, bool, datetime and date columns get
+    their native types, json columns a struct or list type derived from the sample. Columns whose sample values
+    do not convert, mixed json values and the text_columns (the fallback) are written as text.
+
+    Returns the schema and the text columns of low cardinality (in the sample), to dictionary encode.
+    """
+    text_columns = set(text_columns)
+    fields = []
+    dictionary_columns = []
+
+    for name, data_type in column_types.items():
+        values = [value for value in sample.get(name, []) if value is not None]
+        arrow_type = None
+
+        if name not in text_columns and data_type in SCALAR_TYPES:
+            arrow_type, convert = SCALAR_TYPES[data_type]
+            try:
+                for value in values:
+                    convert(value)
+            except (TypeError, ValueError):
+                logging.info(f'column {name} of type {data_type} has mixed values, writing it as text')
+                arrow_type = None
+        elif name not in text_columns and data_type == "json":
+            arrow_type = _json_type(values)
+
+        if arrow_type is None:
+            arrow_type = pa.string()
+            if values and len({_to_text(value) for value in values}) <= len(values) * DICTIONARY_MAX_DISTINCT_RATIO:
+                dictionary_columns.append(name)
+
+        fields.append(pa.field(name, arrow_type))
+
+    return pa.schema(fields), dictionary_columns
+
+
+def columns_to_table(values_by_column: Dict[str, List[Any]], schema: pa.Schema, num_rows: int) -> pa.Table:
+    """
+    A table of the column values converted to the schema types, raises a ParquetColumnTypeError naming the
+    column of the first value that does not fit.
+    """
+    arrays = []
+    for field in schema:
+        values = values_by_column.get(field.name)
+        if values is None:
+            arrays.append(pa.nulls(num_rows, type=field.type))
+            continue
+
+        if pa.types.is_string(field.type):
+            arrays.append(pa.array([_to_text(value) if value is not None else None for value in values],
+                                   type=field.type))
+            continue
+
+        if pa.types.is_struct(field.type) or pa.types.is_list(field.type):
+            converted = values
+            for value in converted:
+                if not _fits(value, field.type):
+                    raise ParquetColumnTypeError(field.name, value)
+        else:
+            convert = next(convert for arrow_type, convert in SCALAR_TYPES.values() if arrow_type == field.type)
+            converted = []
+            for value in values:
+                try:
+                    converted.append(convert(value) if value is not None else None)
+                except (TypeError, ValueError):
+                    raise ParquetColumnTypeError(field.name, value)
+
+        try:
+            arrays.append(pa.array(converted, type=field.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            raise ParquetColumnTypeError(field.name, next(value for value in converted if value is not None))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def serialize_schema(schema: pa.Schema) -> bytes:
+    return schema.serialize().to_pybytes()
+
+
+def deserialize_schema(data: bytes) -> pa.Schema:
+    return pa.ipc.read_schema(pa.py_buffer(data))
+
+
+def text_columns_of(errors: Iterable[BaseException]) -> Set[str]:
+    """The columns of the type errors among the errors."""
+    return {error.column for error in errors if isinstance(error, ParquetColumnTypeError)}
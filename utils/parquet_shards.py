@@ -0,0 +1,102 @@
+import logging as log
+from typing import Iterable, List, Optional, Tuple, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logging = log.getLogger(__name__)
+
+PARQUET_COMPRESSIONS = ("zstd", "snappy", "gzip", "lz4", "brotli", "none")
+
+
+def shard_path_in_repo(split: str, index: int, total: int, start_row: int = 0) -> str:
+    """
+    The shard file name of the datasets hub convention, e.g. data/train-00000-of-00004.parquet. Shards appended
+    from a start row go to a directory of the split, named by the start row such that they sort in row order,
+    e.g. data/train/000000120000-00000-of-00001.parquet (a start row in a data/ file name would be taken as part
+    of the split name). Both are data files of the split by the shard_patterns pinned in the dataset card.
+    """
+    if start_row:
+        return f"data/{split}/{start_row:012d}-{index:05d}-of-{total:05d}.parquet"
+    return f"data/{split}-{index:05d}-of-{total:05d}.parquet"
+
+
+def shard_patterns(split: str) -> List[str]:
+    """The data files of the split, the shards of a full push and then the shards appended to it."""
+    return [f"data/{split}-*.parquet", f"data/{split}/*.parquet"]
+
+
+def is_shard_path(path: str, split: str) -> bool:
+    directory, _, name = path.rpartition("/")
+    return name.endswith(".parquet") and (
+        (directory == "data" and name.startswith(f"{split}-")) or directory == f"data/{split}")
+
+
+def pin_shard_patterns(card_data, split: str):
+    """Pin the data files of the split in the metadata of a dataset card, keeping the card otherwise as is."""
+    configs = [config for config in (card_data.get("configs") or []) if config.get("config_name") != "default"]
+    card_data.configs = [{"config_name": "default",
+                          "data_files": [{"split": split, "path": shard_patterns(split)}]}] + configs
+    return card_data
+
+
+def estimate_shard_rows(sample: Optional[pa.Table], target_bytes: int) -> int:
+    """
+    Rows per shard such that a shard holds about target_bytes, estimated from the in memory size of a sample
+    of rows. Compression makes the files smaller than the estimate, never larger.
+    """
+    if sample is None or not sample.num_rows or not sample.nbytes:
+        return 0
+
+    return max(1, int(target_bytes // max(1, sample.nbytes // sample.num_rows)))
+
+
+def plan_shards(count: int, shard_rows: int, start: int = 0) -> List[Tuple[int, int]]:
+    """
+    Disjoint [start, end) row ranges of at most shard_rows rows covering the rows from start up to count,
+    a single one if unbounded.
+    """
+    if count <= start:
+        return [(start, start)]
+    if shard_rows <= 0 or shard_rows >= count - start:
+        return [(start, count)]
+
+    return [(offset, min(offset + shard_rows, count)) for offset in range(start, count, shard_rows)]
+
+
+def write_parquet_shard(path: str,
+                        schema: pa.Schema,
+                        tables: Iterable[pa.Table],
+                        row_group_size: int,
+                        compression: str = "zstd",
+                        use_dictionary: Union[bool, List[str]] = True) -> int:
+    """
+    Write the tables into a single parquet file, buffered into row groups of row_group_size rows rather than one
+    row group per table (the tables are the chunks loaded from the database). Returns the number of rows written.
+    """
+    rows = 0
+    buffer: List[pa.Table] = []
+    buffered = 0
+
+    with pq.ParquetWriter(path, schema, compression=None if compression == "none" else compression,
+                          use_dictionary=use_dictionary) as writer:
+        for table in tables:
+            buffer.append(table)
+            buffered += table.num_rows
+
+            if buffered >= row_group_size:
+                # whole row groups only, the remainder is carried over into the next one
+                combined = pa.concat_tables(buffer)
+                full = buffered - buffered % row_group_size
+                writer.write_table(combined.slice(0, full), row_group_size=row_group_size)
+                rows += full
+                buffer = [combined.slice(full)] if full < buffered else []
+                buffered -= full
+
+        if buffer or not rows:
+            # an empty shard still gets the schema
+            combined = pa.concat_tables(buffer) if buffer else schema.empty_table()
+            writer.write_table(combined, row_group_size=row_group_size)
+            rows += combined.num_rows
+
+    return rows
@@ -1,10 +1,38 @@
+import base64
 import csv
 import asyncio
-from io import StringIO
-from typing import List, Dict
-
+import datetime
+import decimal
+import json
+from concurrent.futures import Executor
+from io import StringIO, TextIOWrapper
+from typing import List, Dict, Iterator, Optional, BinaryIO, Any, AsyncIterator
+
+import openpyxl
+import pyarrow as pa
+import pyarrow.parquet as pq
 from ismcore.model.processor_state import State
 
+FORMAT_CSV = "csv"
+FORMAT_PARQUET = "parquet"
+FORMAT_ARROW = "arrow"
+FORMAT_JSONL = "jsonl"
+FORMAT_XLSX = "xlsx"
+UPLOAD_FORMATS = (FORMAT_CSV, FORMAT_PARQUET, FORMAT_ARROW, FORMAT_JSONL, FORMAT_XLSX)
+
+UPLOAD_FORMAT_EXTENSIONS = {
+    ".csv": FORMAT_CSV,
+    ".parquet": FORMAT_PARQUET,
+    ".pq": FORMAT_PARQUET,
+    ".arrow": FORMAT_ARROW,
+    ".arrows": FORMAT_ARROW,
+    ".feather": FORMAT_ARROW,
+    ".ipc": FORMAT_ARROW,
+    ".jsonl": FORMAT_JSONL,
+    ".ndjson": FORMAT_JSONL,
+    ".xlsx": FORMAT_XLSX,
+}
+
 
 async def process_file(state: State, filename: str):
     with open(filename, 'rb') as file:
@@ -30,17 +58,143 @@ async def process_csv_stream(state: State, io: StringIO):
     return state
 
 
-async def process_csv_state_sync_store(state: State, io: StringIO) -> List[Dict]:
-    if not state:
-        raise KeyError(f"unable to locate state id {state.id}")
-
-    csv_reader = csv.reader(io)
-    header = next(csv_reader)  # Read the header row
-
-    # Create a dictionary of key-value pairs for the current row
-    query_states = [{key: value for key, value in zip(header, row)} for row in csv_reader]
-
-    return query_states
+def detect_upload_format(filename: Optional[str], head: bytes) -> str:
+    """The format of an upload, by file extension or else by the magic bytes of its head, csv by default."""
+    name = (filename or "").lower()
+    for extension, upload_format in UPLOAD_FORMAT_EXTENSIONS.items():
+        if name.endswith(extension):
+            return upload_format
+
+    if head.startswith(b"PAR1"):
+        return FORMAT_PARQUET
+    if head.startswith(b"ARROW1") or head.startswith(b"\xff\xff\xff\xff"):
+        return FORMAT_ARROW
+    if head.startswith(b"PK\x03\x04"):
+        return FORMAT_XLSX
+    if head.lstrip().startswith(b"{"):
+        return FORMAT_JSONL
+
+    return FORMAT_CSV
+
+
+def _json_safe(value: Any) -> Any:
+    """Values of typed formats as json serializable values, the blocks are published as json."""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, dict):
+        return {key: _json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(item) for item in value]
+    return value
+
+
+def _blocks_of(rows: Iterator[Dict], block_size: int) -> Iterator[List[Dict]]:
+    block = []
+    for row in rows:
+        block.append(row)
+        if len(block) >= block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _csv_rows(file: BinaryIO) -> Iterator[Dict]:
+    text = TextIOWrapper(file, encoding="utf-8", newline="")
+    try:
+        csv_reader = csv.reader(text)
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        for row in csv_reader:
+            yield {key: value for key, value in zip(header, row)}
+    finally:
+        text.detach()
+
+
+def _jsonl_rows(file: BinaryIO) -> Iterator[Dict]:
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _xlsx_rows(file: BinaryIO) -> Iterator[Dict]:
+    # read only mode streams the worksheet xml instead of building the whole workbook in memory
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(name) if name is not None else f"column_{index}" for index, name in enumerate(header)]
+        for row in rows:
+            if any(value is not None for value in row):
+                yield {key: _json_safe(value) for key, value in zip(header, row)}
+    finally:
+        workbook.close()
+
+
+def _parquet_blocks(file: BinaryIO, block_size: int) -> Iterator[List[Dict]]:
+    # decoded a row group at a time, never the whole file
+    parquet_file = pq.ParquetFile(file)
+    for row_group in range(parquet_file.num_row_groups):
+        for batch in parquet_file.iter_batches(batch_size=block_size, row_groups=[row_group]):
+            yield [_json_safe(row) for row in batch.to_pylist()]
+
+
+def _arrow_blocks(file: BinaryIO, block_size: int) -> Iterator[List[Dict]]:
+    try:
+        reader = pa.ipc.open_file(file)
+        batches = (reader.get_batch(index) for index in range(reader.num_record_batches))
+    except pa.ArrowInvalid:
+        file.seek(0)
+        batches = iter(pa.ipc.open_stream(file))
+
+    for batch in batches:
+        for offset in range(0, batch.num_rows, block_size):
+            yield [_json_safe(row) for row in batch.slice(offset, block_size).to_pylist()]
+
+
+def iter_upload_blocks(file: BinaryIO, upload_format: str, block_size: int) -> Iterator[List[Dict]]:
+    """Read an uploaded (seekable, binary) file as blocks of at most block_size row dicts, with bounded memory."""
+    if upload_format == FORMAT_PARQUET:
+        return _parquet_blocks(file, block_size)
+    if upload_format == FORMAT_ARROW:
+        return _arrow_blocks(file, block_size)
+    if upload_format == FORMAT_JSONL:
+        return _blocks_of(_jsonl_rows(file), block_size)
+    if upload_format == FORMAT_XLSX:
+        return _blocks_of(_xlsx_rows(file), block_size)
+    if upload_format == FORMAT_CSV:
+        return _blocks_of(_csv_rows(file), block_size)
+
+    raise ValueError(f"unsupported upload format {upload_format}, expected one of {UPLOAD_FORMATS}")
+
+
+async def stream_upload_blocks(file: BinaryIO,
+                               upload_format: str,
+                               block_size: int,
+                               executor: Optional[Executor] = None) -> AsyncIterator[List[Dict]]:
+    """
+    iter_upload_blocks, reading and decoding each block in a worker thread rather than on the event loop, a
+    thread of the executor when given (readers that may block waiting for data must not hold default threads).
+    """
+    loop = asyncio.get_running_loop()
+
+    def in_thread(func, *args):
+        return loop.run_in_executor(executor, func, *args) if executor else asyncio.to_thread(func, *args)
+
+    blocks = await in_thread(iter_upload_blocks, file, upload_format, block_size)
+    while True:
+        block = await in_thread(next, blocks, None)
+        if block is None:
+            return
+        yield block
 
 
 async def main():
@@ -0,0 +1,350 @@
+import ast
+import hashlib
+import inspect
+import os
+import resource
+import statistics
+import time
+import tracemalloc
+import traceback
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from ismcore.compiler.secure_runnable import SecurityConfig, SecureRunnableBuilder, timeout_context
+
+# runs in the worker processes of the sandbox lane, hence must not import environment (database pools)
+
+# compiled mako templates of this worker process by content hash, least recently used evicted first
+MAKO_TEMPLATE_CACHE_SIZE = 128
+_mako_templates: OrderedDict = OrderedDict()
+
+# seconds a render preview (all of its rows) may take
+MAKO_RENDER_TIMEOUT = 10
+
+# seconds of a benchmark kept for returning its report (the rows and results travel back from the worker)
+BENCHMARK_TIMEOUT_MARGIN_SECONDS = 2
+
+# environment variables the sandbox workers keep, everything else (database urls, tokens, secrets) is removed
+SANDBOX_ENVIRONMENT = ("PATH", "HOME", "LANG", "LC_ALL", "TZ", "TMPDIR")
+
+# render previews are limited to the expressions, control lines and filters of mako, templates may not run
+# python blocks or reach the interpreter through names the template namespace and builtins provide
+MAKO_CONTROL_KEYWORDS = ("for", "if", "elif", "else")
+MAKO_ESCAPES = ("h", "u", "x", "n", "trim", "entity", "str", "unicode")
+MAKO_DENIED_NAMES = {
+    "open", "eval", "exec", "compile", "getattr", "setattr", "delattr", "globals", "locals", "vars", "dir",
+    "input", "breakpoint", "exit", "quit", "help", "memoryview", "type", "object", "super", "classmethod",
+    "staticmethod", "property", "self", "local", "parent", "next", "caller", "context", "runtime", "filters",
+    "capture", "pageargs", "UNDEFINED", "STOP_RENDERING",
+}
+MAKO_DENIED_ATTRIBUTES = {
+    "format", "format_map", "module", "modules", "environ", "sys", "os", "builtins", "mro",
+    "gi_frame", "gi_code", "cr_frame", "ag_frame", "f_back", "f_globals", "f_locals", "f_builtins", "tb_frame",
+}
+
+
+def init_sandbox_worker(memory_limit_mb: int = 0) -> None:
+    """
+    Initializer of the sandbox worker processes: drops the environment inherited from the api and limits the
+    address space of the worker, such that user code neither reads the secrets nor exhausts the host memory.
+    """
+    for name in list(os.environ):
+        if name not in SANDBOX_ENVIRONMENT:
+            del os.environ[name]
+
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _validation_config() -> SecurityConfig:
+    return SecurityConfig(
+        max_memory_mb=100,
+        max_cpu_time_seconds=5,
+        max_requests=50,
+        execution_timeout=10,
+        enable_resource_limits=False
+    )
+
+
+def run_python_validation(code_content: str, queries: Optional[List[Dict]]) -> Any:
+    """Compile the user code and run it with the queries, errors are returned (not raised) to the caller."""
+    config = _validation_config()
+
+    try:
+        # Create builder and compile the user code
+        builder = SecureRunnableBuilder(config)
+        runnable = builder.compile(code_content.lstrip())
+
+        # Run the user's code with queries
+        results = runnable.process(queries=queries)
+        return results
+
+    except SyntaxError as e:
+        # Capture syntax errors
+        return {
+            "error": "Syntax Error",
+            "message": str(e),
+            "traceback": traceback.format_exc()
+        }
+
+    except AttributeError as e:
+        # Capture attribute-related errors
+        return {
+            "error": "Attribute Error",
+            "message": str(e),
+            "traceback": traceback.format_exc()
+        }
+
+    except TypeError as e:
+        # Capture type errors, often from mismatched arguments
+        return {
+            "error": "Type Error",
+            "message": str(e),
+            "traceback": traceback.format_exc()
+        }
+
+    except Exception as e:
+        # General exception handler for unexpected errors
+        return {
+            "error": "Unexpected Error",
+            "message": str(e),
+            "traceback": traceback.format_exc()
+        }
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+
+def run_python_benchmark(code_content: str,
+                         rows: List[Dict],
+                         batch_size: int = 100,
+                         stream: bool = False,
+                         result_limit: int = 100,
+                         max_seconds: Optional[float] = None) -> Dict:
+    """
+    Compile the user code once and run it over the rows in batches of batch_size, through process or (with
+    stream) process_stream, reporting the timings, throughput and peak (python) memory of the runnable.
+
+    Each batch is bound by the execution timeout, a failing batch is reported and the remaining batches still
+    run. Batches which might not complete within max_seconds of the start (the timeout of the sandbox lane) are
+    not run, their rows are reported as skipped. At most result_limit results are returned. The per row timings
+    (batch_row_ms) are the time of each batch divided by its rows, their percentiles are over batches: a slow row
+    shows as a slow batch, not on its own.
+    """
+    config = _validation_config()
+    tracemalloc.start()
+    try:
+        run_started = started = time.perf_counter()
+        try:
+            runnable = SecureRunnableBuilder(config).compile(code_content.lstrip())
+        except Exception as e:
+            return {
+                "error": f"{type(e).__name__}",
+                "message": str(e),
+                "traceback": traceback.format_exc()
+            }
+        compile_ms = (time.perf_counter() - started) * 1000
+
+        results, errors, batches, batch_row_ms = [], [], [], []
+        skipped_rows = 0
+        for offset in range(0, len(rows), batch_size):
+            # a batch may run up to the execution timeout, one which might not complete in time is not started
+            if max_seconds and time.perf_counter() - run_started + config.execution_timeout \
+                    > max_seconds - BENCHMARK_TIMEOUT_MARGIN_SECONDS:
+                skipped_rows = len(rows) - offset
+                break
+
+            batch = rows[offset:offset + batch_size]
+            started = time.perf_counter()
+            try:
+                with timeout_context(config.execution_timeout):
+                    if stream:
+                        output = runnable.process_stream(queries=batch)
+                        # generators only do their work once consumed
+                        output = list(output) if inspect.isgenerator(output) else output
+                    else:
+                        output = runnable.process(queries=batch)
+            except Exception as e:
+                output = None
+                errors.append({"offset": offset, "error": type(e).__name__, "message": str(e)})
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            batches.append({"offset": offset, "rows": len(batch), "ms": elapsed_ms})
+            batch_row_ms.append(elapsed_ms / len(batch))
+
+            if output is not None and len(results) < result_limit:
+                output = output if isinstance(output, list) else [output]
+                results.extend(output[:result_limit - len(results)])
+
+        total_ms = sum(batch["ms"] for batch in batches)
+        return {
+            "results": results,
+            "errors": errors,
+            "rows": len(rows),
+            "skipped_rows": skipped_rows,
+            "batches": batches,
+            "compile_ms": compile_ms,
+            "total_ms": total_ms,
+            "rows_per_second": (len(rows) - skipped_rows) / (total_ms / 1000) if total_ms else None,
+            # the runnable processes a batch at once, rows are not timed individually
+            "batch_row_ms": {
+                "mean": statistics.fmean(batch_row_ms) if batch_row_ms else 0.0,
+                "p50": _percentile(batch_row_ms, 50),
+                "p95": _percentile(batch_row_ms, 95),
+                "max": max(batch_row_ms, default=0.0),
+            },
+            "peak_memory_bytes": tracemalloc.get_traced_memory()[1],
+        }
+    finally:
+        tracemalloc.stop()
+
+
+def _python_violations(code: str) -> List[str]:
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [f"invalid python: {e.msg}"]
+
+    violations = []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal)):
+            violations.append("imports are not allowed")
+        elif isinstance(node, ast.Name) and (node.id.startswith("_") or node.id in MAKO_DENIED_NAMES):
+            violations.append(f"name {node.id} is not allowed")
+        elif isinstance(node, ast.Attribute) and (node.attr.startswith("_") or node.attr in MAKO_DENIED_ATTRIBUTES):
+            violations.append(f"attribute {node.attr} is not allowed")
+    return violations
+
+
+def check_mako_template(content: str) -> List[str]:
+    """
+    The violations of the template against what a render preview allows: text, comments, ${expressions} with the
+    standard escape filters, % for / if control lines and <%text>, without python blocks (<% %>, <%! %>), other
+    tags, imports, private (underscore) names or attributes and the builtins and template namespace entries that
+    lead out of the template. Raises a mako SyntaxException for a template that does not parse.
+    """
+    from mako import parsetree
+    from mako.lexer import Lexer
+
+    violations, seen = [], set()
+
+    def visit(node):
+        for child in node.get_children():
+            if id(child) in seen:
+                continue
+            seen.add(id(child))
+
+            line = f"line {child.lineno}"
+            if isinstance(child, (parsetree.Text, parsetree.Comment, parsetree.TextTag)):
+                pass
+            elif isinstance(child, parsetree.Expression):
+                violations.extend(f"{line}: {v}" for v in _python_violations(child.text.strip()))
+                for escape in (e.strip() for e in (child.escapes or "").split(",")):
+                    if escape and escape not in MAKO_ESCAPES:
+                        violations.append(f"{line}: filter {escape} is not allowed")
+            elif isinstance(child, parsetree.ControlLine):
+                if child.keyword not in MAKO_CONTROL_KEYWORDS:
+                    violations.append(f"{line}: % {child.keyword} is not allowed")
+                elif not child.isend:
+                    # a control line is the header of a block, completed to parse it
+                    header = child.text.strip()
+                    code = f"if False:\n    pass\n{header}\n    pass" if child.keyword in ("elif", "else") \
+                        else f"{header}\n    pass"
+                    violations.extend(f"{line}: {v}" for v in _python_violations(code))
+            elif isinstance(child, parsetree.Code):
+                violations.append(f"{line}: python blocks are not allowed")
+            else:
+                violations.append(f"{line}: <%{getattr(child, 'keyword', type(child).__name__)}> is not allowed")
+
+            visit(child)
+
+    visit(Lexer(content).parse())
+    return list(dict.fromkeys(violations))
+
+
+def _compile_mako_template(content: str):
+    """The compiled template of the content and whether it came from the cache, compiled once per content hash."""
+    from mako.template import Template
+
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    template = _mako_templates.get(content_hash)
+    if template is not None:
+        _mako_templates.move_to_end(content_hash)
+        return content_hash, template, True
+
+    violations = check_mako_template(content)
+    if violations:
+        raise ValueError(f"template is not allowed in a render preview: {'; '.join(violations)}")
+
+    # undefined names fail the row instead of rendering as UNDEFINED
+    template = Template(content, strict_undefined=True)
+    _mako_templates[content_hash] = template
+    while len(_mako_templates) > MAKO_TEMPLATE_CACHE_SIZE:
+        _mako_templates.popitem(last=False)
+
+    return content_hash, template, False
+
+
+def _mako_error(e: Exception) -> Dict:
+    from mako import exceptions as mako_exceptions
+
+    try:
+        detail = mako_exceptions.text_error_template().render_unicode()
+    except Exception:
+        detail = traceback.format_exc()
+
+    return {"error": type(e).__name__, "message": str(e), "traceback": detail}
+
+
+def render_mako_template(content: str, rows: List[Dict], batch: bool = False) -> Dict:
+    """
+    Render the mako template against each of the rows (as keyword arguments, the same as a processor does for a
+    single query state entry), or once against all rows as items when batch is set. Errors of the compilation
+    or of a row are returned (not raised) to the caller, along with the compile and per row render timings.
+
+    The rendering of all rows is bound by the render timeout, rows not rendered by then fail with the timeout
+    (a render stuck in a single native call is not interrupted by it, the timeout of the sandbox lane ends it).
+    """
+    started = time.perf_counter()
+    try:
+        content_hash, template, cached = _compile_mako_template(content)
+    except Exception as e:
+        return {"compiled": False, "compile_ms": (time.perf_counter() - started) * 1000, **_mako_error(e)}
+
+    result = {
+        "content_hash": content_hash,
+        "compiled": True,
+        "cached": cached,
+        "compile_ms": (time.perf_counter() - started) * 1000,
+    }
+
+    outputs = []
+    contexts = [(None, {"items": rows})] if batch else list(enumerate(rows))
+    try:
+        with timeout_context(MAKO_RENDER_TIMEOUT):
+            for index, context in contexts:
+                started = time.perf_counter()
+                try:
+                    output = {"row": index, "output": template.render(**context)}
+                except TimeoutError:
+                    raise
+                except Exception as e:
+                    output = {"row": index, "output": None, **_mako_error(e)}
+
+                output["render_ms"] = (time.perf_counter() - started) * 1000
+                outputs.append(output)
+    except TimeoutError as e:
+        # the row being rendered ran out of time, the rows after it were not rendered
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for position, (index, _) in enumerate(contexts[len(outputs):]):
+            outputs.append({"row": index, "output": None, "error": "TimeoutError",
+                            "message": f"{e} after {MAKO_RENDER_TIMEOUT} seconds",
+                            "render_ms": elapsed_ms if position == 0 else 0.0})
+
+    result["outputs"] = outputs
+    result["render_ms"] = sum(output["render_ms"] for output in outputs)
+    return result
@@ -0,0 +1,87 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from db.read_replica import read_only_request, consistency_lsn
+from utils.executors import ExecutionLane
+from utils.metrics import Metric, register_collector
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent reads of a worker: the first caller of a (name, key) runs the call in a
+    worker thread (of the lane, when given) and every caller arriving while it is in flight awaits the same result (or exception).
+
+    With a ttl the result is also reused by callers arriving shortly after it completed, which flattens
+    polling herds further at the cost of up to ttl seconds of staleness.
+
+    A call runs with the read routing of the caller that started it, so only callers routed alike share it:
+    the routing (read only, replica eligible, or not) is part of the flight key, and callers with a consistency
+    token (which must see their own writes) never share a call or a cached result.
+    """
+
+    def __init__(self, ttl: float = 0.0, max_entries: int = 1024, lane: ExecutionLane = None):
+        self.ttl = ttl
+        self.lane = lane
+        self.max_entries = max_entries
+        self._inflight: Dict[Tuple[str, Hashable, bool], asyncio.Future] = {}
+        self._results: Dict[Tuple[str, Hashable, bool], Tuple[float, Any]] = {}
+        self._counters: Dict[str, Dict[str, int]] = defaultdict(lambda: {"executed": 0, "collapsed": 0, "cached": 0})
+        register_collector(self.collect_metrics)
+
+    async def run(self, name: str, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        counters = self._counters[name]
+        if consistency_lsn.get() is not None:
+            counters["executed"] += 1
+            return await (self.lane.run(func, *args, **kwargs) if self.lane else asyncio.to_thread(func, *args, **kwargs))
+
+        flight_key = (name, key, read_only_request.get())
+
+        if self.ttl > 0:
+            cached = self._results.get(flight_key)
+            if cached and cached[0] > time.monotonic():
+                counters["cached"] += 1
+                return cached[1]
+
+        future = self._inflight.get(flight_key)
+        if future:
+            counters["collapsed"] += 1
+        else:
+            counters["executed"] += 1
+
+            # the call runs as its own task, such that a cancelled (disconnected) caller does not fail the others
+            future = asyncio.ensure_future(
+                self.lane.run(func, *args, **kwargs) if self.lane else asyncio.to_thread(func, *args, **kwargs))
+            self._inflight[flight_key] = future
+            future.add_done_callback(lambda done: self._complete(flight_key, done))
+
+        return await asyncio.shield(future)
+
+    def _complete(self, flight_key: Tuple[str, Hashable, bool], future: asyncio.Future):
+        self._inflight.pop(flight_key, None)
+        if future.cancelled() or future.exception() is not None or self.ttl <= 0:
+            return
+
+        now = time.monotonic()
+        if len(self._results) >= self.max_entries:
+            self._results = {key: entry for key, entry in self._results.items() if entry[0] > now}
+            if len(self._results) >= self.max_entries:
+                self._results.clear()
+
+        self._results[flight_key] = (now + self.ttl, future.result())
+
+    def collect_metrics(self):
+        requests = Metric("singleflight_requests_total", "counter",
+                          "Coalesced read requests, by whether they executed, joined an in flight call or were cached")
+        ratio = Metric("singleflight_collapse_ratio", "gauge",
+                       "Share of requests served without a storage call of their own")
+
+        for name, counters in list(self._counters.items()):
+            for outcome, count in counters.items():
+                requests.add(count, {"flight": name, "outcome": outcome})
+
+            total = sum(counters.values())
+            ratio.add((counters["collapsed"] + counters["cached"]) / total if total else 0.0, {"flight": name})
+
+        return [requests, ratio]
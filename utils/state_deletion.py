@@ -0,0 +1,201 @@
+import asyncio
+import datetime as dt
+import logging as log
+import os
+import socket
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from ismdb.postgres_storage_class import PostgresDatabaseStorage
+
+from db.state_deletion_storage import (
+    StateDeletionDatabaseStorage,
+    StateDeletionProgress,
+    DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING, DELETION_STATUS_COMPLETED, DELETION_STATUS_FAILED)
+
+logging = log.getLogger(__name__)
+
+
+class StateDeletionReleased(Exception):
+    pass
+
+
+class StateDeletionLost(Exception):
+    pass
+
+
+class StateDeletionManager:
+    """
+    Runs state data deletions in the background, one task per state. Each data index range is deleted in a
+    worker thread followed by a throttle pause, such that pipelines writing to other states keep their share
+    of the database while a multi-million row state is being removed.
+
+    A deletion is run by the worker that claims it in the database, any worker of any pod may start or resume
+    it but only one runs it. A deletion whose owner stops renewing its heartbeat for the lease (a crashed pod)
+    is claimed by the next worker watching for pending deletions. Finished jobs are kept in memory for the
+    retention, for their final progress to be fetched, then evicted.
+    """
+
+    def __init__(self,
+                 storage: PostgresDatabaseStorage,
+                 deletion_storage: StateDeletionDatabaseStorage,
+                 batch_size: int = 5000,
+                 throttle_seconds: float = 0.1,
+                 lease_seconds: float = 300,
+                 retention_seconds: float = 600,
+                 on_purged: Optional[Callable[[List[int]], None]] = None):
+        self.storage = storage
+        self.deletion_storage = deletion_storage
+        self.batch_size = batch_size
+        self.throttle_seconds = throttle_seconds
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+        # cleanup of what refers to the columns of a purged state (filter indexes)
+        self.on_purged = on_purged
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.jobs: Dict[str, StateDeletionProgress] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def is_deleting(self, state_id: str) -> bool:
+        progress = self.jobs.get(state_id)
+        if progress:
+            return progress.status in (DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING)
+
+        progress = self.deletion_storage.fetch_deletion_progress(state_id=state_id)
+        return bool(progress) and progress.status in (DELETION_STATUS_PENDING, DELETION_STATUS_RUNNING)
+
+    def fetch_progress(self, state_id: str) -> Optional[StateDeletionProgress]:
+        return self.jobs.get(state_id) or self.deletion_storage.fetch_deletion_progress(state_id=state_id)
+
+    def exclude_purging(self, states: List) -> List:
+        """The states, without those being purged (deleted along with their data)."""
+        if not states:
+            return states or []
+        purging = self.deletion_storage.fetch_purging_state_ids([state.id for state in states])
+        return [state for state in states if state.id not in purging]
+
+    def start(self, state_id: str, purge: bool = False) -> Optional[StateDeletionProgress]:
+        """
+        Tombstone the state and schedule the deletion of its data, returns the progress (of the deletion already
+        pending or running, on this or another worker, if any). None if the state does not exist.
+        """
+        task = self.tasks.get(state_id)
+        if task and not task.done():
+            progress = self.jobs[state_id]
+            progress.purge = progress.purge or purge
+            return progress
+
+        progress = self.deletion_storage.begin_deletion(
+            StateDeletionProgress(state_id=state_id, purge=purge, started_date=dt.datetime.utcnow()))
+        if not progress:
+            return None
+
+        claimed = self.deletion_storage.claim_deletion(
+            state_id=state_id, owner=self.owner, lease_seconds=self.lease_seconds)
+        if claimed:
+            self._schedule(claimed)
+            return claimed
+        return progress
+
+    async def resume_pending(self) -> None:
+        """Resume deletions interrupted by a restart, the tombstone is the record of what was left to do."""
+        pending = await asyncio.to_thread(self.deletion_storage.fetch_pending_deletions)
+        for progress in pending:
+            if progress.state_id in self.tasks:
+                continue
+
+            claimed = await asyncio.to_thread(
+                self.deletion_storage.claim_deletion, progress.state_id, self.owner, self.lease_seconds)
+            if claimed:
+                logging.info(f'resuming deletion of state {progress.state_id}')
+                self._schedule(claimed)
+
+    async def watch_pending(self) -> None:
+        """Resume pending and abandoned deletions, every lease period, for as long as the worker runs."""
+        while True:
+            try:
+                await self.resume_pending()
+            except Exception as e:
+                logging.warning(f'unable to resume pending state deletions: {e}')
+            await asyncio.sleep(self.lease_seconds)
+
+    def _schedule(self, progress: StateDeletionProgress) -> None:
+        self.jobs[progress.state_id] = progress
+        self.tasks[progress.state_id] = asyncio.create_task(self._run(progress))
+
+    def _finish(self, progress: StateDeletionProgress) -> None:
+        self.tasks.pop(progress.state_id, None)
+
+        def evict():
+            # unless a later deletion of the state replaced the job
+            if self.jobs.get(progress.state_id) is progress:
+                del self.jobs[progress.state_id]
+
+        asyncio.get_running_loop().call_later(self.retention_seconds, evict)
+
+    async def _update(self, progress: StateDeletionProgress) -> None:
+        stored = await asyncio.to_thread(self.deletion_storage.update_deletion_progress, progress)
+        if stored:
+            progress.purge = stored.purge
+            return
+
+        # another worker took the deletion over once the lease expired, otherwise the tombstone is gone while
+        # the data is only partially deleted, which fails the deletion
+        current = await asyncio.to_thread(self.deletion_storage.fetch_deletion_progress, progress.state_id)
+        if current and current.owner != self.owner:
+            raise StateDeletionReleased(f'deletion of state {progress.state_id} is no longer held by {self.owner}')
+        raise StateDeletionLost(f'the deletion of state {progress.state_id} was removed while it was running')
+
+    async def _run(self, progress: StateDeletionProgress) -> None:
+        state_id = progress.state_id
+        try:
+            progress.status = DELETION_STATUS_RUNNING
+            column_ids = await asyncio.to_thread(self.deletion_storage.fetch_column_ids, state_id)
+            bounds = await asyncio.to_thread(self.deletion_storage.fetch_data_index_bounds, state_id, column_ids)
+
+            if bounds:
+                start, end = bounds
+                progress.total = progress.deleted + end - start + 1
+                await self._update(progress)
+
+                while start <= end:
+                    await asyncio.to_thread(
+                        self.deletion_storage.delete_data_index_range,
+                        state_id, column_ids, start, start + self.batch_size)
+
+                    start += self.batch_size
+                    progress.deleted = min(progress.total, progress.deleted + self.batch_size)
+                    await self._update(progress)
+                    await asyncio.sleep(self.throttle_seconds)
+
+            if progress.purge:
+                # the data is gone, what remains (columns, key definitions, config and the state) is small
+                await asyncio.to_thread(self.storage.delete_state_cascade, state_id)
+                await asyncio.to_thread(self.deletion_storage.delete_deletion_progress, state_id)
+                if self.on_purged and column_ids:
+                    try:
+                        await asyncio.to_thread(self.on_purged, column_ids)
+                    except Exception as e:
+                        logging.warning(f'unable to clean up after the columns of purged state {state_id}: {e}')
+            else:
+                await asyncio.to_thread(self.deletion_storage.clear_deletion_progress, state_id, self.owner)
+
+            progress.status = DELETION_STATUS_COMPLETED
+            progress.deleted = progress.total
+            progress.finished_date = dt.datetime.utcnow()
+            logging.info(f'deleted {progress.total} data positions of state {state_id}, purged: {progress.purge}')
+        except StateDeletionReleased as e:
+            # the lease expired and another worker took the deletion over
+            logging.warning(str(e))
+            self.jobs.pop(state_id, None)
+        except Exception as e:
+            logging.error(f'failed to delete data of state {state_id}: {e}')
+            progress.status = DELETION_STATUS_FAILED
+            progress.error = str(e)
+            progress.finished_date = dt.datetime.utcnow()
+            try:
+                await asyncio.to_thread(self.deletion_storage.update_deletion_progress, progress)
+            except Exception as update_error:
+                logging.error(f'failed to record deletion failure of state {state_id}: {update_error}')
+        finally:
+            self._finish(progress)
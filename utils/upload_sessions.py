@@ -0,0 +1,294 @@
+import asyncio
+import datetime as dt
+import io
+import json
+import logging as log
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+logging = log.getLogger(__name__)
+
+UPLOAD_STATUS_RECEIVING = "receiving"
+UPLOAD_STATUS_INGESTING = "ingesting"
+UPLOAD_STATUS_COMPLETED = "completed"
+UPLOAD_STATUS_FAILED = "failed"
+UPLOAD_STATUS_ABORTED = "aborted"
+UPLOAD_FINAL_STATUSES = (UPLOAD_STATUS_COMPLETED, UPLOAD_STATUS_FAILED, UPLOAD_STATUS_ABORTED)
+
+
+class UploadSession(BaseModel):
+    id: Optional[str] = None
+    state_id: str
+    user_id: Optional[str] = None
+    filename: Optional[str] = None
+    size: int
+    upload_format: str
+    mode: str
+    notify: bool = False
+    deduplicate: bool = True
+    created_date: Optional[dt.datetime] = None
+
+    # progress, maintained by the worker running the ingest
+    status: str = UPLOAD_STATUS_RECEIVING
+    received_ranges: List[Tuple[int, int]] = []
+    received_bytes: int = 0
+    contiguous_bytes: int = 0
+    summary: Optional[Dict] = None
+    error: Optional[str] = None
+
+
+class UploadSessionAborted(Exception):
+    pass
+
+
+def merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge [start, end) byte ranges into sorted, non overlapping and non adjacent ranges."""
+    merged: List[List[int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+class UploadSessionStore:
+    """
+    Resumable upload sessions spooled to local disk, one directory per session with its metadata, a sparse
+    data file the parts are written into at their offsets, and an append only log of the byte ranges received.
+
+    The session state is kept on disk rather than in memory such that every worker process of the host can
+    receive parts of any session; across hosts, the parts of a session must be routed to the same host.
+    """
+
+    def __init__(self, spool_dir: str, ttl_seconds: float = 86400, poll_interval: float = 0.2):
+        self.spool_dir = spool_dir
+        self.ttl_seconds = ttl_seconds
+        self.poll_interval = poll_interval
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def _path(self, session_id: str, name: str) -> str:
+        # session ids are generated uuids, anything else must not be turned into a path
+        return os.path.join(self.spool_dir, str(uuid.UUID(session_id)), name)
+
+    def create(self, session: UploadSession) -> UploadSession:
+        self.cleanup_expired()
+
+        session.id = str(uuid.uuid4())
+        session.created_date = dt.datetime.utcnow()
+        os.makedirs(os.path.dirname(self._path(session.id, "session.json")))
+
+        # sparse, parts are written at their offsets in any order
+        with open(self._path(session.id, "data"), "wb") as data:
+            data.truncate(session.size)
+        open(self._path(session.id, "ranges"), "a").close()
+
+        self.save(session)
+        return session
+
+    def save(self, session: UploadSession) -> None:
+        path = self._path(session.id, "session.json")
+        with open(f"{path}.tmp", "w") as file:
+            file.write(session.model_dump_json(exclude={"received_ranges", "received_bytes", "contiguous_bytes"}))
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, session_id: str) -> Optional[UploadSession]:
+        try:
+            with open(self._path(session_id, "session.json")) as file:
+                session = UploadSession(**json.load(file))
+        except (ValueError, FileNotFoundError):
+            return None
+
+        session.received_ranges = self.received_ranges(session.id)
+        session.received_bytes = sum(end - start for start, end in session.received_ranges)
+        session.contiguous_bytes = self.contiguous_bytes(session.id, ranges=session.received_ranges)
+        return session
+
+    def received_ranges(self, session_id: str) -> List[Tuple[int, int]]:
+        with open(self._path(session_id, "ranges")) as file:
+            ranges = [tuple(int(value) for value in line.split()) for line in file if line.strip()]
+        return merge_ranges(ranges)
+
+    def contiguous_bytes(self, session_id: str, ranges: List[Tuple[int, int]] = None) -> int:
+        ranges = self.received_ranges(session_id) if ranges is None else ranges
+        return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+    def data_path(self, session_id: str) -> str:
+        return self._path(session_id, "data")
+
+    async def write_part(self, session: UploadSession, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """Write the part at its offset, the range is recorded once the whole part is on disk."""
+        written = 0
+        try:
+            data = open(self.data_path(session.id), "r+b")
+        except FileNotFoundError:
+            # removed once the ingest finished or the session was aborted
+            raise UploadSessionAborted(f"upload session {session.id} no longer receives data")
+
+        with data:
+            data.seek(offset)
+            async for chunk in chunks:
+                if offset + written + len(chunk) > session.size:
+                    raise ValueError(f"part at offset {offset} exceeds the upload size of {session.size} bytes")
+                await asyncio.to_thread(data.write, chunk)
+                written += len(chunk)
+
+            await asyncio.to_thread(data.flush)
+            await asyncio.to_thread(os.fsync, data.fileno())
+
+        if written:
+            # a single small append, atomic with respect to the other worker processes
+            with open(self._path(session.id, "ranges"), "a") as ranges:
+                ranges.write(f"{offset} {offset + written}\n")
+
+        return written
+
+    def delete_data(self, session_id: str) -> None:
+        try:
+            os.remove(self.data_path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def cleanup_expired(self) -> None:
+        expire_before = time.time() - self.ttl_seconds
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.path.getmtime(path) < expire_before:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+
+
+class SpoolReader(io.RawIOBase):
+    """
+    A sequential reader of the session data file that only returns bytes from the contiguous range received
+    so far and waits for more to arrive, such that a streaming parser consumes the upload while it is uploaded.
+
+    Reads block their thread while waiting, for up to the idle timeout, hence are run on the reader executor of
+    the session manager and never on the default executor the parts are written with.
+    """
+
+    def __init__(self, store: UploadSessionStore, session_id: str, size: int, idle_timeout: float):
+        self.store = store
+        self.session_id = session_id
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.position = 0
+        self.available = 0
+        self.file = open(store.data_path(session_id), "rb")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+
+        waited_since = time.monotonic()
+        while self.available <= self.position:
+            self.available = self.store.contiguous_bytes(self.session_id)
+            if self.available > self.position:
+                break
+
+            session = self.store.load(self.session_id)
+            if not session or session.status == UPLOAD_STATUS_ABORTED:
+                raise UploadSessionAborted(f"upload session {self.session_id} was aborted")
+            if time.monotonic() - waited_since > self.idle_timeout:
+                raise TimeoutError(f"no data received for upload session {self.session_id} "
+                                   f"in {self.idle_timeout}s at byte {self.position}")
+            time.sleep(self.store.poll_interval)
+
+        self.file.seek(self.position)
+        data = self.file.read(min(len(buffer), self.available - self.position))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
+
+
+class UploadSessionManager:
+    """
+    Runs the ingest of upload sessions in the background, started when the session is created. Sequential
+    formats (csv, jsonl) are parsed from the contiguous bytes received so far, formats that need random access
+    (parquet, arrow, xlsx) once the whole file is received.
+
+    Ingests read and parse the spooled file on the threads of the reader executor, such that sessions waiting
+    for parts cannot take the threads the parts are written with. Sessions beyond its max readers wait for a
+    reader thread, their parts keep being received meanwhile.
+    """
+
+    def __init__(self, store: UploadSessionStore, idle_timeout: float = 3600, max_readers: int = 16):
+        self.store = store
+        self.idle_timeout = idle_timeout
+        self.reader_executor = ThreadPoolExecutor(max_workers=max_readers, thread_name_prefix="upload-reader")
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def start(self,
+              session: UploadSession,
+              ingest: Callable[[UploadSession, io.BufferedIOBase], Awaitable[Dict]],
+              streaming: bool) -> None:
+        self.tasks[session.id] = asyncio.create_task(self._run(session, ingest, streaming))
+
+    async def _wait_until_received(self, session: UploadSession) -> None:
+        waited_since = time.monotonic()
+        while self.store.contiguous_bytes(session.id) < session.size:
+            current = self.store.load(session.id)
+            if not current or current.status == UPLOAD_STATUS_ABORTED:
+                raise UploadSessionAborted(f"upload session {session.id} was aborted")
+            if time.monotonic() - waited_since > self.idle_timeout:
+                raise TimeoutError(f"upload session {session.id} did not complete in {self.idle_timeout}s")
+            await asyncio.sleep(self.store.poll_interval)
+
+    async def _run(self, session: UploadSession, ingest, streaming: bool) -> None:
+        reader = None
+        try:
+            if streaming:
+                reader = io.BufferedReader(
+                    SpoolReader(self.store, session.id, session.size, idle_timeout=self.idle_timeout))
+            else:
+                await self._wait_until_received(session)
+                reader = open(self.store.data_path(session.id), "rb")
+
+            session.status = UPLOAD_STATUS_INGESTING
+            self.store.save(session)
+
+            session.summary = await ingest(session, reader)
+            session.status = UPLOAD_STATUS_COMPLETED
+        except UploadSessionAborted:
+            session.status = UPLOAD_STATUS_ABORTED
+        except Exception as e:
+            logging.error(f'failed to ingest upload session {session.id} of state {session.state_id}: {e}')
+            session.status = UPLOAD_STATUS_FAILED
+            session.error = str(e)
+        finally:
+            if reader:
+                reader.close()
+
+            # an abort (possibly by another worker) is final
+            current = self.store.load(session.id)
+            if current and current.status == UPLOAD_STATUS_ABORTED:
+                session.status = UPLOAD_STATUS_ABORTED
+            self.store.save(session)
+            self.store.delete_data(session.id)
+            self.tasks.pop(session.id, None)
+
+    def abort(self, session: UploadSession) -> UploadSession:
+        session.status = UPLOAD_STATUS_ABORTED
+        self.store.save(session)
+
+        task = self.tasks.get(session.id)
+        if task and not task.done():
+            task.cancel()
+
+        self.store.delete_data(session.id)
+        return session